@@ -2,15 +2,29 @@
 import collections
 import json
 import os
+import random
 import sys
 import tempfile
+from concurrent.futures import as_completed
 from cps_sorter.services.model_evaluator import ModelEvaluator
-from cps_sorter.services.weka_helper import WekaHelper
+from cps_sorter.services.weka_helper import WekaHelper, DEFAULT_TRAINING_WORKERS
 from cps_sorter.services.real_time_experiments import RealTimeExperimentRunner
-from cps_sorter.services.performance_testing import split_data, PerformanceTester
+from cps_sorter.services.performance_testing import count_safe_unsafe, PerformanceTester
+from cps_sorter.services.split_manifest import split_corpus
 from cps_sorter.services.road_transformer import RoadTransformer
-from shutil import copy2
+from cps_sorter.services.feature_cache import FeatureCache
+from cps_sorter.services.corpus_index import CorpusIndex
+from cps_sorter.services.prediction_pool import PredictionPool, WORKER_COMMANDS, DEFAULT_WORKER
+from cps_sorter.services.native_models import NativeBackend
+from cps_sorter.services.model_registry import ModelRegistry
+from cps_sorter.services.simulator_pool import parse_endpoints
+from cps_sorter.services.incremental_models import DEFAULT_REFIT_EVERY
+from cps_sorter.services.test_prioritizer import DEFAULT_CANDIDATE_POOL
+from cps_sorter.services.active_learning import DEFAULT_TARGET_PRECISION
+from cps_sorter.services.novelty_filter import DEFAULT_NOVELTY_RADIUS
+from cps_sorter.services.retraining_policy import make_retraining_policy, RETRAIN_POLICIES, DEFAULT_DRIFT_THRESHOLD, DEFAULT_MAX_STALENESS, DEFAULT_MIN_TESTS
 import click
+import numpy as np
 
 from cps_sorter import __version__
 
@@ -18,6 +32,28 @@ from cps_sorter import __version__
 LOGISTIC_MODEL_BUILDING_JAR =  '{}/services/jars/buildLogisticModel.jar'.format(os.path.dirname(os.path.realpath(__file__)))
 DEFAULT_OUTPUT =  os.path.dirname(os.path.realpath(__file__))
 
+
+def open_feature_cache(feature_cache):
+    if not feature_cache:
+        return None
+    return FeatureCache(feature_cache)
+
+def open_model_registry(model_registry):
+    if not model_registry:
+        return None
+    return ModelRegistry(model_registry)
+
+def open_prediction_pool(prediction_workers, prediction_worker):
+    if not prediction_workers:
+        return None
+    # a worker that cannot start stops the command here instead of in the middle of a run
+    return PredictionPool(WORKER_COMMANDS[prediction_worker], size=int(prediction_workers)).start()
+
+def open_backend(backend, workers=1):
+    if backend == 'native':
+        return NativeBackend(workers=int(workers))
+    return None
+
 def version_msg():
     """Return the CPS-SORTER version, location and Python powering it."""
     python_version = sys.version[:3]
@@ -36,10 +72,16 @@ def cli():
 @click.option('-i','--input_dir', 'input_dir' )
 @click.option('-f','--featureset', 'featureset', default='fullroad')
 @click.option('-o','--output_dir', 'output_dir', default=DEFAULT_OUTPUT)
-def run_model_eval(datasetname, input_dir, featureset, output_dir):
-    model_evaluator = ModelEvaluator(output_dir)
+@click.option('-w','--workers', 'workers', default=1)
+@click.option('--feature-cache', 'feature_cache', default='')
+@click.option('--evaluation-workers', 'evaluation_workers', default=1)
+def run_model_eval(datasetname, input_dir, featureset, output_dir, workers, feature_cache, evaluation_workers):
+    model_evaluator = ModelEvaluator(output_dir, workers=int(workers), feature_cache=open_feature_cache(feature_cache),
+        evaluation_workers=int(evaluation_workers))
     model_evaluator.evaluate_models(datasetname, input_dir, featureset)
-    print('Finished: {}/{}_results.csv'.format(output_dir, datasetname))
+    for ratio, wall_time in model_evaluator.wall_times.items():
+        print('Split {}: {:.1f}s'.format(ratio, wall_time))
+    print('Finished: {}/{}_result.csv'.format(output_dir, datasetname))
 
 
 @cli.command()
@@ -47,46 +89,61 @@ def run_model_eval(datasetname, input_dir, featureset, output_dir):
 @click.option('-o','--output_dir', 'output_dir', default=DEFAULT_OUTPUT)
 @click.option('-r','--rounds', 'rounds', default=30)
 @click.option('-q','--ratio', 'ratio', default=0.5)
-def run_round_based_eval(input_dir, output_dir, rounds, ratio):
-    road_transformer = RoadTransformer()
+@click.option('-w','--workers', 'workers', default=1)
+@click.option('--feature-cache', 'feature_cache', default='')
+@click.option('-s','--seed', 'seed', default=None, type=int)
+@click.option('--prediction-workers', 'prediction_workers', default=0)
+@click.option('--prediction-worker', 'prediction_worker', default=DEFAULT_WORKER, type=click.Choice(list(WORKER_COMMANDS)))
+@click.option('--portable-models/--no-portable-models', default=False)
+@click.option('--backend', 'backend', default='weka', type=click.Choice(['weka', 'native']))
+@click.option('--training-workers', 'training_workers', default=DEFAULT_TRAINING_WORKERS)
+@click.option('--model-registry', 'model_registry', default='')
+def run_round_based_eval(input_dir, output_dir, rounds, ratio, workers, feature_cache, seed, prediction_workers, prediction_worker, portable_models, backend,
+    training_workers, model_registry):
+    road_transformer = RoadTransformer(open_feature_cache(feature_cache))
     rounds = int(rounds)
     with tempfile.TemporaryDirectory() as temp_dir:
-        safe_dir = '{}/safe'.format(temp_dir)
-        unsafe_dir = '{}/unsafe'.format(temp_dir)
-        os.mkdir(safe_dir)
-        os.mkdir(unsafe_dir)
-        for test_file in os.listdir(input_dir):
-            file_path = '{}/{}'.format(input_dir, test_file)
-            try:
-                with open(file_path) as json_file:
-                    test = json.load(json_file)
-                    if test['execution']['oobs'] > 0:
-                        copy2(file_path, '{}/unsafe/'.format(temp_dir, test_file))
-                    else:
-                        copy2(file_path, '{}/safe/{}'.format(temp_dir, test_file))
-            except Exception as e:
-                print('test file {}: {}'.format(test_file, e))
-                continue
-        training_dir, test_dir = split_data(safe_dir, unsafe_dir, temp_dir, 0.8, float(ratio))
-        
-        weka_helper = WekaHelper()
-        data_file = '{}/{}'.format(temp_dir, 'data_set.csv')
-        data_file = road_transformer.transform_to_training_data(training_dir, data_file, 'default')
+        corpus_index = CorpusIndex(input_dir, index_dir=output_dir).refresh()
+        for i in np.flatnonzero(~corpus_index.valid):
+            print('test file {}: {}'.format(os.path.basename(corpus_index.paths[i]), corpus_index.errors[i]))
+        split = split_corpus(corpus_index, 0.8, float(ratio), seed)
+        split.save('{}/{}_rounds_tests_ratio_{}_split.json'.format(output_dir, rounds, ratio))
+        print(count_safe_unsafe(split.test, corpus_index))
+
+        weka_helper = WekaHelper(prediction_pool=open_prediction_pool(prediction_workers, prediction_worker), portable_models=portable_models,
+            backend=open_backend(backend, workers), training_workers=int(training_workers),
+            model_registry=open_model_registry(model_registry))
+        data_file = '{}/{}'.format(temp_dir, 'data_set.cols')
+        data_file = road_transformer.transform_to_training_data(split.training, data_file, workers=int(workers))
         training_file = road_transformer.create_training_test(data_file, temp_dir)
-        weka_helper.build_models(trainings_file=training_file, temp_dir=temp_dir, models=['J48.model', 'RandomForest.model', 'Logistic.model'])
+        verification_file = None
+        if portable_models:
+            # the portable models are checked against the jar on held out tests of the pool
+            held_out = random.Random(split.seed).sample(split.test, min(len(split.test), 500))
+            verification_file, converted = road_transformer.convert_files_to_test_bulk(held_out)
+        trainings = weka_helper.build_models_async(trainings_file=training_file, temp_dir=temp_dir, models=['J48.model', 'RandomForest.model', 'Logistic.model'],
+            verification_file=verification_file)
         
-        tester = PerformanceTester(weka_helper)
+        tester = PerformanceTester(weka_helper, road_transformer, corpus_index, seed=split.seed)
         
-        result = {}
-        tests = ['{}/{}'.format(test_dir, f) for f in os.listdir(test_dir) if os.path.isfile(os.path.join(test_dir, f))]
+        result = {'split_seed': split.seed}
+        tests = split.test
+        # the random baselines run while the models train
         result['random_fix'] = tester.get_random_baseline_fixed_test_num(test_set=tests, num_tests=10, rounds=rounds)
         result['random_reach'] = tester.get_random_baseline_reach_unsafe_num(test_set=tests, num_unsafe=10, rounds=rounds)
        
-        models = weka_helper.get_models()
-        result['model_fix'] = tester.model_based_fixed_baseline(tests, num_tests=10, rounds=rounds, models=models)
-        result['model_reach'] = tester.get_model_baseline_reach_unsafe_num(tests, num_unsafe=10, rounds=rounds, models=models)
+        result['model_fix'] = {}
+        result['model_reach'] = {}
+        for training in as_completed(trainings):
+            models = training.result()
+            print('Trained {}'.format(', '.join(models)))
+            result['model_fix'].update(tester.model_based_fixed_baseline(tests, num_tests=10, rounds=rounds, models=models))
+            result['model_reach'].update(tester.get_model_baseline_reach_unsafe_num(tests, num_unsafe=10, rounds=rounds, models=models))
+        result['training_times'] = weka_helper.training_times
         with open('{}/{}_rounds_tests_ratio_{}.json'.format(output_dir, rounds, ratio), 'w') as outfile:
             outfile.write(json.dumps(result, sort_keys=True, indent=4))
+        if weka_helper.prediction_pool:
+            weka_helper.prediction_pool.close()
     print('{}/{}_rounds_tests_ratio_{}.json'.format(output_dir, rounds, ratio))
    
 
@@ -95,15 +152,47 @@ def run_round_based_eval(input_dir, output_dir, rounds, ratio):
 @click.option('-o','--output_dir', 'output_dir', default=DEFAULT_OUTPUT)
 @click.option('-t','--time-budget', 'time_budget', default='360')
 @click.option('--adaptive/--no-adaptive', default=True)
-def run_real_time_eval(init_data, output_dir, time_budget, adaptive):
+@click.option('--prediction-workers', 'prediction_workers', default=0)
+@click.option('--prediction-worker', 'prediction_worker', default=DEFAULT_WORKER, type=click.Choice(list(WORKER_COMMANDS)))
+@click.option('--portable-models/--no-portable-models', default=False)
+@click.option('--backend', 'backend', default='weka', type=click.Choice(['weka', 'native']))
+@click.option('--model-registry', 'model_registry', default='')
+@click.option('--pipeline/--no-pipeline', default=False)
+@click.option('--simulators', 'simulators', default='')
+@click.option('--generation-workers', 'generation_workers', default=0)
+@click.option('--precompute-features/--no-precompute-features', default=True)
+@click.option('--incremental/--no-incremental', default=False)
+@click.option('--refit-every', 'refit_every', default=DEFAULT_REFIT_EVERY)
+@click.option('--retrain-policy', 'retrain_policy', default='fixed', type=click.Choice(RETRAIN_POLICIES))
+@click.option('--drift-threshold', 'drift_threshold', default=DEFAULT_DRIFT_THRESHOLD)
+@click.option('--max-staleness', 'max_staleness', default=DEFAULT_MAX_STALENESS)
+@click.option('--drift-min-tests', 'drift_min_tests', default=DEFAULT_MIN_TESTS)
+@click.option('--prioritize/--no-prioritize', default=False)
+@click.option('--candidate-pool', 'candidate_pool', default=DEFAULT_CANDIDATE_POOL)
+@click.option('--active-learning', 'active_learning', default=0.0)
+@click.option('--target-precision', 'target_precision', default=DEFAULT_TARGET_PRECISION)
+@click.option('--novelty-radius', 'novelty_radius', default=DEFAULT_NOVELTY_RADIUS)
+def run_real_time_eval(init_data, output_dir, time_budget, adaptive, prediction_workers, prediction_worker, portable_models, backend, model_registry,
+    pipeline, simulators, generation_workers, precompute_features, incremental, refit_every, retrain_policy, drift_threshold, max_staleness, drift_min_tests,
+    prioritize, candidate_pool, active_learning, target_precision, novelty_radius):
     temp_dir = tempfile.TemporaryDirectory()
     output_dir = output_dir
 
-    weka = WekaHelper(model_building_jar=LOGISTIC_MODEL_BUILDING_JAR)
+    weka = WekaHelper(model_building_jar=LOGISTIC_MODEL_BUILDING_JAR, prediction_pool=open_prediction_pool(prediction_workers, prediction_worker),
+        portable_models=portable_models, backend=open_backend(backend), model_registry=open_model_registry(model_registry),
+        incremental={'refit_every': int(refit_every)} if incremental else None)
     
-    test_generator = RealTimeExperimentRunner(temp_dir=temp_dir, weka_helper=weka, output_dir=output_dir)
-    result = test_generator.run_experiment(time_budget=int(time_budget), weka_model='Logistic.model', bulk_size=2, init_data=init_data, adaptive=adaptive)
+    test_generator = RealTimeExperimentRunner(temp_dir=temp_dir, weka_helper=weka, output_dir=output_dir,
+        simulators=parse_endpoints(simulators) if simulators else None)
+    result = test_generator.run_experiment(time_budget=int(time_budget), weka_model='Logistic.model', bulk_size=2, init_data=init_data, adaptive=adaptive,
+        pipeline=pipeline, generation_workers=int(generation_workers), precompute_features=precompute_features,
+        retraining_policy=make_retraining_policy(retrain_policy, float(drift_threshold), int(max_staleness), int(drift_min_tests)),
+        prioritize=prioritize, candidate_pool=int(candidate_pool), active_learning=float(active_learning), target_precision=float(target_precision),
+        novelty_radius=float(novelty_radius))
     output_file = test_generator.write_result_to(result, output_dir)
+    test_generator.simulators.close()
+    if weka.prediction_pool:
+        weka.prediction_pool.close()
     print(output_file)
  
 
@@ -0,0 +1,64 @@
+import numpy as np
+from cps_sorter.services.native_models import standardization
+from cps_sorter.services.road_transformer import FULLROAD_FEATURES
+
+DEFAULT_ACTIVE_FRACTION = 0.2
+DEFAULT_DIVERSITY_WEIGHT = 0.5
+DEFAULT_TARGET_PRECISION = 0.8
+
+
+class ActiveSelector:
+    '''
+    spends a fraction of the simulator time on tests predicted as safe that teach the model the most. A candidate
+    scores by its uncertainty (1 - |2p - 1| of its unsafe probability p) and its diversity (distance of its
+    standardized features to the closest simulated test, relative to the other candidates), weighted by
+    diversity_weight. Without probabilities only the diversity counts
+    '''
+    def __init__(self, fraction=DEFAULT_ACTIVE_FRACTION, diversity_weight=DEFAULT_DIVERSITY_WEIGHT, features=FULLROAD_FEATURES):
+        self.fraction = fraction
+        self.diversity_weight = diversity_weight
+        self.features = features
+        self.simulated = []
+        self.explored_time = 0.0
+        self.total_time = 0.0
+
+    def _matrix(self, rows):
+        return np.array([[float(row[feature]) for feature in self.features] for row in rows])
+
+    def due(self):
+        '''
+        whether the exploration tests used less than their fraction of the simulator time
+        '''
+        return self.explored_time <= self.fraction * self.total_time
+
+    def diversity(self, rows):
+        if not self.simulated:
+            return np.zeros(len(rows))
+        simulated = self._matrix(self.simulated)
+        mean, std = standardization(simulated)
+        candidates = (self._matrix(rows) - mean) / std
+        simulated = (simulated - mean) / std
+        distances = np.sqrt(((candidates[:, None, :] - simulated[None, :, :]) ** 2).sum(axis=2)).min(axis=1)
+        return distances / distances.max() if distances.max() > 0 else distances
+
+    def pick(self, predictions, probabilities, rows):
+        '''
+        the index of the best test predicted as safe, None without such a test
+        '''
+        candidates = [c for c, prediction in enumerate(predictions) if prediction != 'unsafe' and rows[c] is not None]
+        if not candidates:
+            return None
+        uncertainty = np.array([0.0 if probabilities[c] is None else 1 - abs(2 * probabilities[c] - 1) for c in candidates])
+        weight = self.diversity_weight if any(probabilities[c] is not None for c in candidates) else 1.0
+        scores = (1 - weight) * uncertainty + weight * self.diversity([rows[c] for c in candidates])
+        return candidates[int(np.argmax(scores))]
+
+    def observe(self, row, seconds, explored):
+        if row is not None:
+            self.simulated.append(row)
+        self.total_time += seconds
+        if explored:
+            self.explored_time += seconds
+
+    def stats(self):
+        return {'fraction': self.fraction, 'explored_time': self.explored_time, 'total_time': self.total_time}
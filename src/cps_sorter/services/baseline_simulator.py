@@ -0,0 +1,138 @@
+import numpy as np
+
+PREDICTED_SAFE = 0
+PREDICTED_UNSAFE = 1
+NO_PREDICTION = -1
+
+# number of (round, test) cells drawn at once, bounds the memory of the permutation blocks
+BLOCK_CELLS = 4 * 1024 * 1024
+
+
+class BaselineSimulator:
+    '''
+    simulates the rounds of the PerformanceTester baselines for a fixed test pool with all rounds
+    drawn at once. costs and is_unsafe describe the pool, predictions are PREDICTED_SAFE,
+    PREDICTED_UNSAFE or NO_PREDICTION per test of the pool. Every test needs its cost, a pool with
+    tests without execution time is rejected.
+    '''
+    def __init__(self, costs, is_unsafe, seed=None):
+        self.costs = np.asarray(costs, dtype=np.float64)
+        self.is_unsafe = np.asarray(is_unsafe, dtype=bool)
+        missing = np.count_nonzero(~np.isfinite(self.costs))
+        if missing:
+            raise ValueError('{} tests of the pool have no execution time'.format(missing))
+        self.rng = np.random.default_rng(seed)
+
+    def _permutations(self, rounds):
+        '''
+        yields blocks of rows, every row a random order of the pool
+        '''
+        size = len(self.costs)
+        block_rounds = max(1, BLOCK_CELLS // max(size, 1))
+        for start in range(0, rounds, block_rounds):
+            num_rounds = min(block_rounds, rounds - start)
+            yield np.argsort(self.rng.random((num_rounds, size)), axis=1)
+
+    def _prefix_mask(self, hits, target, name):
+        '''
+        marks per row the draws up to and including the one where hits reaches target
+        '''
+        counts = np.cumsum(hits, axis=1)
+        reached = counts[:, -1] >= target
+        if not reached.all():
+            raise ValueError('{}: the test pool has fewer than {} matching tests'.format(name, target))
+        stop = np.argmax(counts >= target, axis=1)
+        return np.arange(hits.shape[1]) <= stop[:, None]
+
+    def _evaluation(self, costs, is_unsafe, drawn=None):
+        # costs, is_unsafe and drawn are (rounds, draws), drawn marks the draws that happened (all without drawn)
+        if drawn is None:
+            drawn = np.ones(costs.shape, dtype=bool)
+        costs = np.where(drawn, costs, 0.0)
+        num_unsafe = np.count_nonzero(is_unsafe & drawn, axis=1)
+        num_safe = np.count_nonzero(~is_unsafe & drawn, axis=1)
+        cost_unsafe = np.sum(np.where(is_unsafe, costs, 0.0), axis=1)
+        cost_safe = np.sum(np.where(is_unsafe, 0.0, costs), axis=1)
+        return [{
+            'total_cost': float(total),
+            'cost_safe': float(safe_cost),
+            'cost_unsafe': float(unsafe_cost),
+            'num_unsafe': int(unsafe),
+            'num_safe': int(safe),
+            'num_tests': int(safe + unsafe)
+        } for total, safe_cost, unsafe_cost, unsafe, safe in zip(np.sum(costs, axis=1), cost_safe, cost_unsafe, num_unsafe, num_safe)]
+
+    def random_fixed(self, num_tests, rounds):
+        '''
+        num_tests distinct random tests per round, like get_random_baseline_fixed_test_num
+        '''
+        if num_tests > len(self.costs):
+            raise ValueError('random_fixed: the test pool has fewer than {} tests'.format(num_tests))
+        results = []
+        for order in self._permutations(rounds):
+            drawn = order[:, :num_tests]
+            results.extend(self._evaluation(self.costs[drawn], self.is_unsafe[drawn]))
+        return results
+
+    def random_reach(self, num_unsafe, rounds):
+        '''
+        random draws with replacement until num_unsafe unsafe tests were drawn, like
+        get_random_baseline_reach_unsafe_num. The number of safe draws before the last unsafe one
+        follows a negative binomial distribution, the drawn tests are uniform within their class.
+        '''
+        unsafe_tests = np.flatnonzero(self.is_unsafe)
+        safe_tests = np.flatnonzero(~self.is_unsafe)
+        if not len(unsafe_tests):
+            raise ValueError('random_reach: the test pool has no unsafe tests')
+        num_safe = np.zeros(rounds, dtype=np.int64)
+        if len(safe_tests):
+            num_safe = self.rng.negative_binomial(num_unsafe, len(unsafe_tests) / len(self.costs), size=rounds)
+        unsafe_drawn = unsafe_tests[self.rng.integers(0, len(unsafe_tests), size=(rounds, num_unsafe))]
+        safe_costs = np.zeros((rounds, int(num_safe.max(initial=0))))
+        safe_slots = np.arange(safe_costs.shape[1]) < num_safe[:, None]
+        if safe_slots.any():
+            safe_costs[safe_slots] = self.costs[safe_tests[self.rng.integers(0, len(safe_tests), size=int(num_safe.sum()))]]
+        costs = np.concatenate([self.costs[unsafe_drawn], safe_costs], axis=1)
+        is_unsafe = np.concatenate([np.ones(unsafe_drawn.shape, dtype=bool), np.zeros(safe_costs.shape, dtype=bool)], axis=1)
+        drawn = np.concatenate([np.ones(unsafe_drawn.shape, dtype=bool), safe_slots], axis=1)
+        return self._evaluation(costs, is_unsafe, drawn)
+
+    def _model_result(self, order, predictions, mask):
+        costs = np.where(mask, self.costs[order], 0.0)
+        is_unsafe = self.is_unsafe[order]
+        predicted_safe = mask & (predictions[order] == PREDICTED_SAFE)
+        predicted_unsafe = mask & (predictions[order] == PREDICTED_UNSAFE)
+        columns = {
+            'num_missed_unsafe_tests': np.count_nonzero(predicted_safe & is_unsafe, axis=1),
+            'num_missed_safe_tests': np.count_nonzero(predicted_safe & ~is_unsafe, axis=1),
+            'saved_costs': np.sum(np.where(predicted_safe & ~is_unsafe, costs, 0.0), axis=1),
+            'total_costs': np.sum(np.where(predicted_unsafe, costs, 0.0), axis=1),
+            'num_safe_file_tested': np.count_nonzero(predicted_unsafe & ~is_unsafe, axis=1),
+            'num_unsafe_file_tested': np.count_nonzero(predicted_unsafe & is_unsafe, axis=1),
+            'cost_from_safe_file': np.sum(np.where(predicted_unsafe & ~is_unsafe, costs, 0.0), axis=1)
+        }
+        columns = {key: values.tolist() for key, values in columns.items()}
+        return [dict(zip(columns.keys(), values)) for values in zip(*columns.values())]
+
+    def model_fixed(self, predictions, num_tests, rounds):
+        '''
+        distinct random tests per round until num_tests predicted unsafe tests ran, like round_model_performance_test
+        '''
+        predictions = np.asarray(predictions)
+        results = []
+        for order in self._permutations(rounds):
+            mask = self._prefix_mask(predictions[order] == PREDICTED_UNSAFE, num_tests, 'model_fixed')
+            results.extend(self._model_result(order, predictions, mask))
+        return results
+
+    def model_reach(self, predictions, num_unsafe, rounds):
+        '''
+        distinct random tests per round until num_unsafe predicted unsafe tests were unsafe, like get_model_baseline_reach_unsafe_num
+        '''
+        predictions = np.asarray(predictions)
+        results = []
+        for order in self._permutations(rounds):
+            hits = (predictions[order] == PREDICTED_UNSAFE) & self.is_unsafe[order]
+            mask = self._prefix_mask(hits, num_unsafe, 'model_reach')
+            results.extend(self._model_result(order, predictions, mask))
+        return results
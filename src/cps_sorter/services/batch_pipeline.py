@@ -0,0 +1,132 @@
+import datetime
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_DEPTH = 2
+
+
+class Batch:
+    '''
+    generated tests with their predictions and unsafe probabilities (None when the predictor gives none),
+    generation is the version of the model that predicted them
+    '''
+    def __init__(self, to_predict, tests, predictions, probabilities, generation, time_generation, time_prediction):
+        self.to_predict = to_predict
+        self.tests = tests
+        self.predictions = predictions
+        self.probabilities = probabilities
+        self.generation = generation
+        self.time_generation = time_generation
+        self.time_prediction = time_prediction
+
+
+class SequentialBatches:
+    '''
+    generates and predicts a batch when it is asked for, the stages of the real-time experiment run one after another.
+    predict(to_predict, tests) returns the labels and the unsafe probabilities of the tests
+    '''
+    def __init__(self, generate, predict):
+        self.generate = generate
+        self.predict = predict
+        self.generation = 0
+        self.time_waiting = 0
+
+    def start(self):
+        return self
+
+    def _make_batch(self):
+        start = time.time()
+        to_predict, tests = self.generate()
+        generated = time.time()
+        predictions, probabilities = self.predict(to_predict, tests)
+        return Batch(to_predict, tests, predictions, probabilities, self.generation, generated - start, time.time() - generated)
+
+    def get(self, deadline=None):
+        return self._make_batch()
+
+    @contextmanager
+    def updating_model(self):
+        yield
+        self.generation += 1
+
+    def stop(self):
+        pass
+
+
+class PredictionPipeline(SequentialBatches):
+    '''
+    generates and predicts the next batches in a background thread while the caller simulates the current one.
+    At most depth batches wait in the queue, the thread blocks when it is full. Batches predicted before the
+    model was updated are predicted again when they are taken from the queue
+    '''
+    def __init__(self, generate, predict, depth=DEFAULT_DEPTH):
+        SequentialBatches.__init__(self, generate, predict)
+        self.batches = queue.Queue(maxsize=max(1, depth))
+        self.model_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _make_batch(self):
+        start = time.time()
+        to_predict, tests = self.generate()
+        generated = time.time()
+        with self.model_lock:
+            generation = self.generation
+            predictions, probabilities = self.predict(to_predict, tests)
+        return Batch(to_predict, tests, predictions, probabilities, generation, generated - start, time.time() - generated)
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                batch = self._make_batch()
+                while not self.stopped.is_set():
+                    try:
+                        self.batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self.error = e
+
+    def get(self, deadline=None):
+        '''
+        the next batch, None when deadline (a datetime) passed before a batch was ready
+        '''
+        start = time.time()
+        try:
+            while True:
+                if self.error:
+                    raise self.error
+                if deadline and datetime.datetime.now() > deadline:
+                    return None
+                try:
+                    batch = self.batches.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    continue
+        finally:
+            self.time_waiting += time.time() - start
+        with self.model_lock:
+            if batch.generation != self.generation:
+                predicted = time.time()
+                batch.predictions, batch.probabilities = self.predict(batch.to_predict, batch.tests)
+                batch.generation = self.generation
+                batch.time_prediction += time.time() - predicted
+        return batch
+
+    @contextmanager
+    def updating_model(self):
+        with self.model_lock:
+            yield
+            self.generation += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
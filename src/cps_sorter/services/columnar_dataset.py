@@ -0,0 +1,137 @@
+import csv
+import json
+import os
+import numpy as np
+
+DATASET_EXTENSION = '.cols'
+SCHEMA_FILE = 'schema.json'
+LABELS = ['unsafe', 'safe']
+
+
+def is_columnar(path):
+    return str(path).endswith(DATASET_EXTENSION)
+
+
+class ColumnarDataset:
+    '''
+    a dataset stored as a directory with one raw file per column and a small json schema.
+    Feature columns are typed int64/float64, the label column is stored as int8 codes into labels.
+    Columns are read through numpy.memmap, new row blocks are appended to the column files.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SCHEMA_FILE)) as schema_file:
+            self.schema = json.load(schema_file)
+
+    @classmethod
+    def create(cls, path, columns, label='safety', labels=LABELS):
+        '''
+        columns is a list of (name, dtype) of the feature columns
+        '''
+        os.makedirs(path, exist_ok=True)
+        schema = {
+            'columns': [[name, np.dtype(dtype).str] for name, dtype in columns],
+            'label': label,
+            'labels': list(labels),
+            'num_rows': 0
+        }
+        for name, dtype in columns + [(label, np.int8)]:
+            open(os.path.join(path, '{}.bin'.format(name)), 'wb').close()
+        with open(os.path.join(path, SCHEMA_FILE), 'w') as schema_file:
+            json.dump(schema, schema_file)
+        return cls(path)
+
+    def __len__(self):
+        return self.schema['num_rows']
+
+    @property
+    def feature_names(self):
+        return [name for name, dtype in self.schema['columns']]
+
+    @property
+    def fieldnames(self):
+        return self.feature_names + [self.schema['label']]
+
+    def _column_file(self, name):
+        return os.path.join(self.path, '{}.bin'.format(name))
+
+    def _dtype(self, name):
+        if name == self.schema['label']:
+            return np.dtype(np.int8)
+        return np.dtype(dict(self.schema['columns'])[name])
+
+    def append(self, block):
+        '''
+        appends a block of rows given as a dict of column name to sequence, labels as strings
+        '''
+        num_rows = len(block[self.schema['label']])
+        if not num_rows:
+            return
+        codes = {label: code for code, label in enumerate(self.schema['labels'])}
+        values = dict(block)
+        values[self.schema['label']] = [codes[label] for label in block[self.schema['label']]]
+        for name in self.fieldnames:
+            column = np.asarray(values[name], dtype=self._dtype(name))
+            if len(column) != num_rows:
+                raise ValueError('column {} has {} rows instead of {}'.format(name, len(column), num_rows))
+            with open(self._column_file(name), 'ab') as column_file:
+                column_file.write(column.tobytes())
+        self.schema['num_rows'] += num_rows
+        with open(os.path.join(self.path, SCHEMA_FILE), 'w') as schema_file:
+            json.dump(self.schema, schema_file)
+
+    def append_rows(self, rows):
+        self.append({name: [row[name] for row in rows] for name in self.fieldnames})
+
+    def column(self, name):
+        if not len(self):
+            return np.empty(0, dtype=self._dtype(name))
+        return np.memmap(self._column_file(name), dtype=self._dtype(name), mode='r', shape=(len(self),))
+
+    def features(self, names=None):
+        names = names or self.feature_names
+        return np.column_stack([self.column(name) for name in names]).astype(np.float64)
+
+    def label_codes(self):
+        return self.column(self.schema['label'])
+
+    def labels(self):
+        return np.array(self.schema['labels'], dtype=object)[self.label_codes()]
+
+    def take(self, indices, path):
+        '''
+        writes the rows at indices, in that order, to a new dataset at path
+        '''
+        subset = ColumnarDataset.create(path, [(name, dtype) for name, dtype in self.schema['columns']],
+            self.schema['label'], self.schema['labels'])
+        indices = np.asarray(indices, dtype=np.int64)
+        block = {name: self.column(name)[indices] for name in self.feature_names}
+        block[self.schema['label']] = self.labels()[indices]
+        subset.append(block)
+        return subset
+
+    def iter_rows(self):
+        columns = [self.column(name).tolist() for name in self.feature_names] + [self.labels().tolist()]
+        for values in zip(*columns):
+            yield dict(zip(self.fieldnames, values))
+
+    def to_csv(self, csv_path):
+        with open(csv_path, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.fieldnames)
+            writer.writeheader()
+            for row in self.iter_rows():
+                writer.writerow(row)
+        return csv_path
+
+
+def weka_file(path):
+    '''
+    the Weka jars read csv, columnar datasets are exported into the dataset directory when they are handed over
+    '''
+    if not is_columnar(path):
+        return path
+    csv_path = os.path.join(path, '{}.csv'.format(os.path.basename(path.rstrip('/\\'))[:-len(DATASET_EXTENSION)]))
+    schema_file = os.path.join(path, SCHEMA_FILE)
+    if not os.path.exists(csv_path) or os.path.getmtime(csv_path) < os.path.getmtime(schema_file):
+        ColumnarDataset(path).to_csv(csv_path)
+    return csv_path
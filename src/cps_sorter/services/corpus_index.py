@@ -0,0 +1,121 @@
+import hashlib
+import os
+import sqlite3
+import numpy as np
+import cps_sorter.services.utility as utility
+from cps_sorter.services.scenario_loader import load_scenario, EXECUTION, PATH
+
+IN_MEMORY = ':memory:'
+
+
+def index_file_name(directory):
+    '''
+    the name of the index file of a corpus, keyed by the absolute path of the corpus directory
+    '''
+    return 'corpus_index_{}.sqlite'.format(hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:16])
+
+
+class CorpusIndex:
+    '''
+    labels, costs and file metadata of every scenario file directly in a directory, kept in a sqlite
+    index in index_dir (in memory without index_dir), the corpus directory itself is only read.
+    refresh() only parses files whose size or mtime changed, afterwards lookups are indexing into the
+    arrays of the index.
+    '''
+    def __init__(self, directory, index_dir=None):
+        self.directory = os.path.abspath(directory)
+        self.index_file = os.path.join(index_dir, index_file_name(self.directory)) if index_dir else IN_MEMORY
+        self.connection = None
+        self.paths = []
+        self.position = {}
+
+    def _connect(self):
+        if self.connection is not None:
+            return self.connection
+        connection = sqlite3.connect(self.index_file, timeout=60)
+        self.connection = connection
+        connection.execute('CREATE TABLE IF NOT EXISTS scenarios (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, oobs INTEGER, '
+            'reason TEXT, execution_seconds REAL, num_segments INTEGER, ai_type TEXT, error TEXT)')
+        return connection
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.directory).replace(os.sep, '/')
+
+    def _scan(self, path):
+        try:
+            data = load_scenario(path, [EXECUTION, PATH])
+            execution = data['execution']
+            seconds = utility.get_execution_time(execution)
+            if not np.isfinite(seconds):
+                raise ValueError('no execution time')
+            return (execution['oobs'], execution['reason'], seconds, len(data.get('path', [])), None)
+        except Exception as e:
+            return (-1, None, np.nan, 0, '{}'.format(e) or type(e).__name__)
+
+    def refresh(self):
+        connection = self._connect()
+        known = {path: (size, mtime) for path, size, mtime in connection.execute('SELECT path, size, mtime FROM scenarios')}
+        found = set()
+        changed = []
+        # like the splits always did, only the files directly in the directory belong to the corpus
+        for filename in os.listdir(self.directory):
+            filepath = os.path.join(self.directory, filename)
+            if not utility.is_scenario_file(filename) or not os.path.isfile(filepath):
+                continue
+            stat = os.stat(filepath)
+            key = self._key(filepath)
+            found.add(key)
+            if known.get(key) != (stat.st_size, stat.st_mtime):
+                changed.append((key, stat.st_size, stat.st_mtime) + self._scan(filepath) + (utility.get_ai_type(filepath), ))
+        with connection:
+            connection.executemany('DELETE FROM scenarios WHERE path=?', [(path, ) for path in known if path not in found])
+            connection.executemany('INSERT OR REPLACE INTO scenarios (path, size, mtime, oobs, reason, execution_seconds, num_segments, error, ai_type) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', changed)
+        self._load(connection)
+        return self
+
+    def _load(self, connection):
+        rows = connection.execute('SELECT path, size, mtime, oobs, reason, execution_seconds, num_segments, ai_type, error '
+            'FROM scenarios ORDER BY path').fetchall()
+        columns = list(zip(*rows)) or [[]] * 9
+        self.paths = ['{}/{}'.format(self.directory, path) for path in columns[0]]
+        self.position = {path: i for i, path in enumerate(columns[0])}
+        self.sizes = np.array(columns[1], dtype=np.int64)
+        self.mtimes = np.array(columns[2], dtype=np.float64)
+        self.oobs = np.array(columns[3], dtype=np.int64)
+        self.reasons = np.array(columns[4], dtype=object)
+        self.costs = np.array(columns[5], dtype=np.float64)
+        self.num_segments = np.array(columns[6], dtype=np.int64)
+        self.ai_types = np.array(columns[7], dtype=object)
+        self.errors = np.array(columns[8], dtype=object)
+        self.valid = np.array([error is None for error in columns[8]], dtype=bool)
+        self.is_unsafe = self.valid & (self.oobs > 0)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return self._key(path) in self.position
+
+    def index_of(self, path):
+        return self.position[self._key(path)]
+
+    def indices(self, paths):
+        return np.array([self.position[self._key(path)] for path in paths], dtype=np.int64)
+
+    def evaluate(self, path):
+        i = self.index_of(path)
+        if not self.valid[i]:
+            raise ValueError(self.errors[i])
+        return {
+            'cost': float(self.costs[i]),
+            'is_safe': not bool(self.is_unsafe[i])
+        }
+
+    def count_safe_unsafe(self, indices=None):
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+        counted = indices[self.valid[indices] & (self.reasons[indices] != 'timeout')]
+        num_unsafe = int(np.count_nonzero(self.is_unsafe[counted]))
+        return {'unsafe': num_unsafe, 'safe': len(counted) - num_unsafe}
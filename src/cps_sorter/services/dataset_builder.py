@@ -0,0 +1,94 @@
+from cps_sorter.services.scenario_loader import load_scenario, EXECUTION, PATH, LANES
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+DEFAULT_CHUNK_SIZE = 200
+
+
+def extract_chunk(road_transformer, featureset, file_paths):
+    '''
+    extracts the rows of a chunk of scenario files, runs inside the worker processes. Files known to
+    the feature cache of road_transformer are not parsed. Returns (file_path, rows, error) per file,
+    rows is None for files without execution, and the new and the used cache entries.
+    '''
+    cache = road_transformer.feature_cache
+    entries = [None] * len(file_paths)
+    content_hashes = [None] * len(file_paths)
+    used_hashes = []
+    for i, file_path in enumerate(file_paths):
+        if not cache:
+            continue
+        try:
+            content_hashes[i] = cache.key(file_path)
+            entries[i] = cache.get(content_hashes[i], featureset)
+        except Exception as e:
+            entries[i] = {'error': '{}'.format(e)}
+        if entries[i] is not None:
+            used_hashes.append(content_hashes[i])
+
+    misses = [i for i, entry in enumerate(entries) if entry is None]
+    tests = []
+    parts = [EXECUTION, PATH] if featureset == 'fullroad' else [EXECUTION, LANES]
+    for i in misses:
+        try:
+            tests.append((i, load_scenario(file_paths[i], parts)))
+        except Exception as e:
+            entries[i] = {'error': '{}'.format(e)}
+    if featureset == 'fullroad':
+        rows = road_transformer.extract_training_rows([test for i, test in tests])
+        for (i, test), row in zip(tests, rows):
+            entries[i] = {'error': '{}'.format(row)} if isinstance(row, Exception) else row
+    elif featureset == 'roadsegment':
+        for i, test in tests:
+            try:
+                if not 'execution' in test.keys():
+                    entries[i] = {'rows': None}
+                    continue
+                block = road_transformer.extract_segment_features_rows(test)
+                entries[i] = {'rows': road_transformer.block_to_rows(block)}
+            except Exception as e:
+                entries[i] = {'error': '{}'.format(e)}
+
+    new_entries = [(content_hashes[i], entries[i]) for i in misses if content_hashes[i]]
+    results = [(file_path, ) + entry_to_rows(entry, featureset) for file_path, entry in zip(file_paths, entries)]
+    return results, new_entries, used_hashes
+
+
+def entry_to_rows(entry, featureset):
+    if 'error' in entry:
+        return None, entry['error']
+    if featureset == 'fullroad':
+        if entry['safety'] is None:
+            return None, None
+        return [entry], None
+    return entry['rows'], None
+
+
+class DatasetBuilder:
+    def __init__(self, road_transformer, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.road_transformer = road_transformer
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    def iter_rows(self, file_paths, featureset='fullroad'):
+        '''
+        yields (file_path, rows, error) in the order of file_paths, chunks are spread over a process pool
+        '''
+        chunks = [file_paths[i:i + self.chunk_size] for i in range(0, len(file_paths), self.chunk_size)]
+        extract = partial(extract_chunk, self.road_transformer, featureset)
+        if self.workers <= 1:
+            for chunk in chunks:
+                yield from self._store(featureset, *extract(chunk))
+            return
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for results in executor.map(extract, chunks):
+                yield from self._store(featureset, *results)
+
+    def _store(self, featureset, results, new_entries, used_hashes):
+        cache = self.road_transformer.feature_cache
+        if cache:
+            try:
+                cache.put_many(featureset, new_entries, used_hashes)
+            except Exception as e:
+                print('feature cache: {}'.format(e))
+        return results
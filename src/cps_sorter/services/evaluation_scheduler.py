@@ -0,0 +1,55 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EvaluationJob:
+    '''
+    one run of the model evaluator jar, it appends its result rows to its own shard
+    '''
+    def __init__(self, name, trainings_file, test_file, shard):
+        self.name = name
+        self.trainings_file = trainings_file
+        self.test_file = test_file
+        self.shard = shard
+        self.returncode = None
+        self.wall_time = None
+
+
+class EvaluationScheduler:
+    '''
+    runs evaluation jobs on at most concurrency jvms at the same time and waits for all of them.
+    Every job writes to its own shard, merge_shards joins them in job order
+    '''
+    def __init__(self, weka_helper, concurrency=1):
+        self.weka_helper = weka_helper
+        self.concurrency = max(1, concurrency)
+
+    def _run(self, job):
+        # the jar appends to the shard like it did to the shared result file
+        open(job.shard, 'w').close()
+        start = time.time()
+        job.returncode = self.weka_helper.evaluate_models(job.name, job.trainings_file, job.test_file, job.shard)
+        job.wall_time = time.time() - start
+        print('Evaluated {} in {:.1f}s'.format(job.name, job.wall_time))
+        if job.returncode != 0:
+            print('EvaluationScheduler: evaluation of {} failed with {}'.format(job.name, job.returncode))
+        return job
+
+    def run(self, jobs):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self._run, jobs))
+
+
+def merge_shards(jobs, result_file):
+    '''
+    appends the shards to result_file in the order of jobs and removes them
+    '''
+    with open(result_file, 'a', newline='') as outfile:
+        for job in jobs:
+            if not os.path.exists(job.shard):
+                continue
+            with open(job.shard, newline='') as shard:
+                for line in shard:
+                    outfile.write(line if line.endswith('\n') else line + '\n')
+            os.remove(job.shard)
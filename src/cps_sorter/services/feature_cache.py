@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+DEFAULT_FEATURE_CACHE = os.path.join(str(Path.home()), '.cps_sorter', 'feature_cache.sqlite')
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# bump whenever the features computed by RoadTransformer change, older entries are then ignored
+FEATURE_EXTRACTOR_VERSION = 1
+
+
+def file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as test_file:
+        for block in iter(lambda: test_file.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FeatureCache:
+    '''
+    extracted features of scenario files in a sqlite file, keyed by the hash of the file content,
+    the featureset and the version of the feature extraction. Least recently used entries are
+    evicted once the stored entries exceed max_bytes.
+    '''
+    def __init__(self, cache_file=DEFAULT_FEATURE_CACHE, version=FEATURE_EXTRACTOR_VERSION, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_file = cache_file
+        self.version = version
+        self.max_bytes = max_bytes
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    @property
+    def connection(self):
+        # sqlite connections must not cross a fork, every worker process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.cache_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.cache_file, timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS features (content_hash TEXT, featureset TEXT, version INTEGER, '
+                'entry TEXT, size INTEGER, last_used REAL, PRIMARY KEY (content_hash, featureset, version))')
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def key(self, file_path):
+        return file_hash(file_path)
+
+    def get(self, content_hash, featureset):
+        row = self.connection.execute('SELECT entry FROM features WHERE content_hash=? AND featureset=? AND version=?',
+            (content_hash, featureset, self.version)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, content_hash, featureset, entry):
+        self.put_many(featureset, [(content_hash, entry)])
+
+    def put_many(self, featureset, entries, used_hashes=[]):
+        '''
+        stores (content_hash, entry) pairs and marks used_hashes as recently used, in one transaction
+        '''
+        now = time.time()
+        with self.connection:
+            for content_hash, entry in entries:
+                value = json.dumps(entry)
+                self.connection.execute('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)',
+                    (content_hash, featureset, self.version, value, len(value), now))
+            self.connection.executemany('UPDATE features SET last_used=? WHERE content_hash=? AND featureset=? AND version=?',
+                [(now, content_hash, featureset, self.version) for content_hash in used_hashes])
+        if entries:
+            self.evict()
+
+    def size(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+
+    def evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        freed = 0
+        evicted = []
+        for rowid, size in self.connection.execute('SELECT rowid, size FROM features ORDER BY last_used'):
+            evicted.append((rowid,))
+            freed += size
+            if freed >= excess:
+                break
+        with self.connection:
+            self.connection.executemany('DELETE FROM features WHERE rowid=?', evicted)
+        return len(evicted)
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM features')
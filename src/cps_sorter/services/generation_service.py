@@ -0,0 +1,90 @@
+import multiprocessing
+import queue
+import numpy as np
+
+DEFAULT_DEPTH = 64
+
+
+def _generate(make_factory, seed, to_dict, features, tests, stopped):
+    try:
+        factory = make_factory(seed)
+        while not stopped.is_set():
+            test = factory.generate_random_test()
+            row = features(test) if features else None
+            data = to_dict(test)
+            while not stopped.is_set():
+                try:
+                    tests.put((data, row), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+    except Exception as e:
+        tests.put((None, '{}: {}'.format(type(e).__name__, e)))
+
+
+class GenerationError(Exception):
+    '''
+    a generation worker failed
+    '''
+
+
+class GenerationService:
+    '''
+    generates road tests in worker processes, every worker has its own factory made by make_factory(seed) with
+    an independent seed. Tests cross the process boundary as dicts (to_dict/from_dict), with features(test)
+    the workers also compute the feature row of every test. At most depth tests wait in the queue.
+    The service can stand in for a RoadTestFactory
+    '''
+    def __init__(self, make_factory, to_dict, from_dict, workers=2, seed=None, features=None, depth=DEFAULT_DEPTH):
+        self.make_factory = make_factory
+        self.to_dict = to_dict
+        self.from_dict = from_dict
+        self.workers = workers
+        self.seeds = [int(seed) for seed in np.random.SeedSequence(seed).generate_state(workers)]
+        self.features = features
+        self.tests = multiprocessing.Queue(maxsize=depth)
+        self.stopped = multiprocessing.Event()
+        self.processes = []
+
+    def start(self):
+        for seed in self.seeds:
+            process = multiprocessing.Process(target=_generate, args=(self.make_factory, seed, self.to_dict, self.features, self.tests, self.stopped), daemon=True)
+            process.start()
+            self.processes.append(process)
+        return self
+
+    def _get(self):
+        while True:
+            try:
+                data, row = self.tests.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    raise GenerationError('all generation workers stopped')
+                continue
+            if data is None:
+                raise GenerationError(row)
+            return self.from_dict(data), row
+
+    def get_batch(self, bulk_size):
+        '''
+        bulk_size tests and their feature rows, the rows are None when the workers do not compute features
+        '''
+        tests, rows = zip(*[self._get() for i in range(bulk_size)])
+        return list(tests), list(rows) if self.features else None
+
+    def generate_random_test(self):
+        return self._get()[0]
+
+    def stop(self):
+        self.stopped.set()
+        # the workers cannot finish while their last put waits on a full queue
+        while True:
+            try:
+                self.tests.get_nowait()
+            except queue.Empty:
+                break
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
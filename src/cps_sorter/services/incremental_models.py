@@ -0,0 +1,90 @@
+import math
+import numpy as np
+from cps_sorter.services.native_models import (MODEL_TYPES, NUM_TREES, load_training_data, standardization, fit_logistic_weights,
+    logistic_model, train_tree, train_forest, _grow_random_trees)
+from cps_sorter.services.portable_model import ForestModel
+
+DEFAULT_WINDOW = 2000
+DEFAULT_REFIT_EVERY = 10
+DEFAULT_TREES_PER_UPDATE = 10
+
+
+class IncrementalLearner:
+    '''
+    one native model with its training rows in memory, labelled batches are applied without training on all rows.
+    The logistic regression is fitted on the window of the most recent rows starting at the current weights
+    (standardized like at the last full refit), the forest grows trees_per_update trees on the window and drops
+    as many of its oldest trees, the tree is grown again on the window. Every refit_every updates the model is
+    trained on all rows.
+    '''
+    def __init__(self, model, features, classes, matrix, codes, window=DEFAULT_WINDOW, refit_every=DEFAULT_REFIT_EVERY,
+        trees_per_update=DEFAULT_TREES_PER_UPDATE, num_trees=NUM_TREES, seed=1):
+        self.model_type = MODEL_TYPES.get(model)
+        if self.model_type is None:
+            raise ValueError('no native model for {}'.format(model))
+        self.features = features
+        self.classes = list(classes)
+        self.matrix = matrix
+        self.codes = codes
+        self.window = window
+        self.refit_every = refit_every
+        self.trees_per_update = trees_per_update
+        self.num_trees = num_trees
+        self.rng = np.random.RandomState(seed)
+        self.updates = 0
+        self.full_refits = 0
+        self.refit()
+
+    @classmethod
+    def from_file(cls, model, trainings_file, **kwargs):
+        features, classes, matrix, codes = load_training_data(trainings_file)
+        return cls(model, features, classes, matrix, codes, **kwargs)
+
+    def _seed(self):
+        return int(self.rng.randint(0, 2**31 - 1))
+
+    def refit(self):
+        self.full_refits += 1
+        if self.model_type == 'logistic':
+            self.mean, self.std = standardization(self.matrix)
+            self.weights = fit_logistic_weights(self.matrix, self.codes, len(self.classes), self.mean, self.std)
+            self.model = logistic_model(self.features, self.classes, self.weights, self.mean, self.std)
+        elif self.model_type == 'tree':
+            self.model = train_tree(self.features, self.classes, self.matrix, self.codes)
+        else:
+            self.model = train_forest(self.features, self.classes, self.matrix, self.codes, self.num_trees, seed=self._seed())
+        return self.model
+
+    def update(self, rows, label='safety'):
+        '''
+        applies rows (dicts of feature values and label) and returns the updated model
+        '''
+        rows = [row for row in rows if row is not None]
+        if not rows:
+            return self.model
+        labels = [row[label] for row in rows]
+        refit = False
+        for value in labels:
+            if value not in self.classes:
+                # a class seen for the first time changes the shape of the model
+                self.classes.append(value)
+                refit = True
+        codes = {value: code for code, value in enumerate(self.classes)}
+        self.matrix = np.vstack([self.matrix, np.array([[float(row[feature]) for feature in self.features] for row in rows])])
+        self.codes = np.concatenate([self.codes, np.array([codes[value] for value in labels], dtype=np.int64)])
+        self.updates += 1
+        if refit or (self.refit_every and self.updates % self.refit_every == 0):
+            return self.refit()
+        matrix = self.matrix[-self.window:]
+        codes = self.codes[-self.window:]
+        if self.model_type == 'logistic':
+            self.weights = fit_logistic_weights(matrix, codes, len(self.classes), self.mean, self.std, initial=self.weights)
+            self.model = logistic_model(self.features, self.classes, self.weights, self.mean, self.std)
+        elif self.model_type == 'tree':
+            self.model = train_tree(self.features, self.classes, matrix, codes)
+        else:
+            max_features = int(math.log2(len(self.features))) + 1
+            seeds = [self._seed() for i in range(self.trees_per_update)]
+            trees = self.model.trees[len(seeds):] + _grow_random_trees(self.features, self.classes, matrix, codes, max_features, seeds)
+            self.model = ForestModel(self.features, self.classes, trees)
+        return self.model
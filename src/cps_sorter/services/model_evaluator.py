@@ -1,57 +1,56 @@
 import random
-import json
 import os
 import csv
-from cps_sorter.services.road_transformer import RoadTransformer
+import numpy as np
+from cps_sorter.services.road_transformer import RoadTransformer, FEATURESET_COLUMNS
+from cps_sorter.services.columnar_dataset import ColumnarDataset
+from cps_sorter.services.utility import is_scenario_file
+from cps_sorter.services.dataset_builder import DatasetBuilder
 from cps_sorter.services.weka_helper import WekaHelper
+from cps_sorter.services.evaluation_scheduler import EvaluationJob, EvaluationScheduler, merge_shards
 class ModelEvaluator():
-    def __init__(self, output_folder):
+    def __init__(self, output_folder, workers=1, feature_cache=None, evaluation_workers=1):
         self.output_folder = output_folder
-        self.road_transformer = RoadTransformer()
+        self.workers = workers
+        self.evaluation_workers = evaluation_workers
+        self.road_transformer = RoadTransformer(feature_cache)
         self.weka_helper = WekaHelper()
 
     def create_dataset(self, data_location, dataset_name, featureset):
-        dataset = []
         i = 0
-        for test_file in os.listdir(data_location):
-            try:
-                with open('{}/{}'.format(data_location, test_file)) as json_file:
-                    test = json.load(json_file)
-                    if not 'execution' in test.keys():
-                            continue
-                    if featureset == 'fullroad':
-                        features = self.road_transformer.extract_features(test)
-                        if test['execution']['oobs'] > 0:
-                            features['safety'] = 'unsafe'
-                        else:
-                            features['safety'] = 'safe'
-                        dataset.append(features)
-                    elif featureset == 'roadsegment':
-                        dataset.extend(self.road_transformer.extract_segment_features_rows(test))
-                    print('file {}'.format(i))
-                    i += 1
-
-            except Exception as e:
-                print('test file {}: {}'.format(test_file, e))
+        builder = DatasetBuilder(self.road_transformer, workers=self.workers)
+        file_paths = ['{}/{}'.format(data_location, test_file) for test_file in os.listdir(data_location) if is_scenario_file(test_file)]
+        dataset = ColumnarDataset.create('{}/{}_Complete.cols'.format(self.output_folder, dataset_name), FEATURESET_COLUMNS[featureset])
+        block = []
+        for file_path, rows, error in builder.iter_rows(file_paths, featureset):
+            if error:
+                print('test file {}: {}'.format(os.path.basename(file_path), error))
+                continue
+            if rows is None:
                 continue
-        self._write_data_file('{}/{}_Complete.csv'.format(self.output_folder, dataset_name), dataset, featureset=featureset)
+            block.extend(rows)
+            if len(block) >= builder.chunk_size:
+                dataset.append_rows(block)
+                block = []
+            print('file {}'.format(i))
+            i += 1
+        dataset.append_rows(block)
         return dataset
 
     def create_trainig_and_test_set(self, ratio, dataset_name, featureset='fullroad'):
-        num_sample = int(len(self.complete_dataset)*ratio)
         training_set, test_set = self.rebalancing(self.complete_dataset, ratio)
-        self.trainings_file = self._write_data_file('{}/{}_{}_training.csv'.format(self.output_folder, '{}-{}-split'.format(ratio, 1-ratio), dataset_name), training_set, featureset=featureset)
-        self.test_file = self._write_data_file('{}/{}_{}_test.csv'.format(self.output_folder, '{}-{}-split'.format(ratio, 1-ratio), dataset_name), test_set, featureset=featureset)
+        split = '{}-{}-split'.format(ratio, 1-ratio)
+        self.trainings_file = self.complete_dataset.take(training_set, '{}/{}_{}_training.cols'.format(self.output_folder, split, dataset_name)).path
+        self.test_file = self.complete_dataset.take(test_set, '{}/{}_{}_test.cols'.format(self.output_folder, split, dataset_name)).path
 
 
     def rebalancing(self, training_set, ratio):
-        safe = []
-        unsafe = []
-        for item in self.complete_dataset:
-            if item['safety'] == 'safe':
-                safe.append(item)
-            else:
-                unsafe.append(item)
+        '''
+        row indices of a balanced training set and of the remaining test set
+        '''
+        labels = self.complete_dataset.labels()
+        safe = np.flatnonzero(labels == 'safe').tolist()
+        unsafe = np.flatnonzero(labels != 'safe').tolist()
         if len(safe) < len(unsafe):
             num_safe_sample = int(ratio *len(safe))
             num_unsafe_sample = int(ratio *len(unsafe))
@@ -66,33 +65,8 @@ class ModelEvaluator():
             random.shuffle(unsafe)
             training_set = safe[:num_unsafe_sample] + unsafe[:num_unsafe_sample]
             test_set = safe[num_safe_sample:] + unsafe[num_unsafe_sample:]
-        random.shuffle(training_set[1:])
-        random.shuffle(test_set[1:])
         return training_set, test_set
 
-    def _write_data_file(self, filename, rows=[], featureset='fullroad'):
-        if featureset == 'fullroad':
-            with open(filename, 'w', newline='') as csv_file:
-                fieldnames = ['direct_distance', 'road_distance', 'num_l_turns','num_r_turns','num_straights','median_angle','total_angle','mean_angle','std_angle',
-                'max_angle','min_angle','median_pivot_off','mean_pivot_off','std_pivot_off','max_pivot_off','min_pivot_off', 'safety']
-                writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in rows:
-                    writer.writerow(row)
-            return filename
-        elif featureset == 'roadsegment':
-            with open(filename, 'w', newline='') as csv_file:
-                fieldnames = ['is_start_seg', 'is_last_seg','prev_is_right_turn', 'prev_is_left_turn', 'prev_is_straight', 'prev_angles', 'prev_pivot_off', 'prev_actual_length','prev_direct_length', 'prev_directed_hausdorff',
-                    'seg_is_right_turn', 'seg_is_left_turn', 'seg_is_straight','seg_angles', 'seg_pivot_off', 'seg_actual_length','seg_direct_length', 
-                    'next_is_right_turn', 'next_is_left_turn', 'next_is_straight', 'next_angles', 'next_pivot_off', 'next_actual_length','next_direct_length', 'next_directed_hausdorff',
-                    'safety']
-                writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in rows:
-                    writer.writerow(row)
-            return filename
-
-
     def evaluate_models(self, dataset_name, data_location, featureset='fullroad', ratios=[0.4,0.5,0.6,0.8]):
         result_file = '{}/{}_result.csv'.format(self.output_folder, dataset_name)
         with open(result_file, 'w', newline='') as csv_file:
@@ -105,7 +79,12 @@ class ModelEvaluator():
             writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
             writer.writeheader()
         self.complete_dataset = self.create_dataset(data_location, dataset_name, featureset)
+        jobs = []
         for ratio in ratios:
             self.create_trainig_and_test_set(ratio, dataset_name, featureset)
-            self.weka_helper.evaluate_models(str(ratio), self.trainings_file, self.test_file, result_file)
+            shard = '{}/{}_result_{}.part.csv'.format(self.output_folder, dataset_name, ratio)
+            jobs.append(EvaluationJob(str(ratio), self.trainings_file, self.test_file, shard))
+        jobs = EvaluationScheduler(self.weka_helper, self.evaluation_workers).run(jobs)
+        merge_shards(jobs, result_file)
+        self.wall_times = {job.name: job.wall_time for job in jobs}
         return '{}_result'.format(dataset_name)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from cps_sorter.services.columnar_dataset import is_columnar, SCHEMA_FILE
+from cps_sorter.services.feature_cache import file_hash
+
+DEFAULT_MODEL_REGISTRY = os.path.join(str(Path.home()), '.cps_sorter', 'models')
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+INDEX_FILE = 'registry.sqlite'
+
+
+def dataset_hash(path):
+    '''
+    the hash of the training data, for a columnar dataset of its schema and column files
+    '''
+    if not is_columnar(path):
+        return file_hash(path)
+    sha = hashlib.sha256()
+    sha.update(file_hash(os.path.join(path, SCHEMA_FILE)).encode())
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.bin'):
+            sha.update(name.encode())
+            sha.update(file_hash(os.path.join(path, name)).encode())
+    return sha.hexdigest()
+
+
+def jar_version(jar):
+    if os.path.exists(jar):
+        return file_hash(jar)
+    return os.path.basename(jar)
+
+
+class ModelRegistry:
+    '''
+    trained model files in a directory, keyed by the hash of the training data, the algorithm and the
+    version of the trainer. Least recently used models are evicted once the stored models exceed max_bytes.
+    '''
+    def __init__(self, registry_dir=DEFAULT_MODEL_REGISTRY, max_bytes=DEFAULT_MAX_BYTES):
+        self.registry_dir = registry_dir
+        self.max_bytes = max_bytes
+        os.makedirs(registry_dir, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS models (key TEXT PRIMARY KEY, size INTEGER, last_used REAL)')
+
+    def _connect(self):
+        # models are trained on several threads, every call opens its own connection
+        connection = sqlite3.connect(os.path.join(self.registry_dir, INDEX_FILE), timeout=60)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return closing(connection)
+
+    def key(self, trainings_file, model, trainer):
+        '''
+        trainer describes the algorithm and the version of what trains it, a json serializable dict
+        '''
+        description = {'data': dataset_hash(trainings_file), 'model': model, 'trainer': trainer}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.registry_dir, key)
+
+    def get(self, key, model_file):
+        '''
+        copies the stored model to model_file, returns model_file or None if the model is not stored
+        '''
+        with self._connect() as connection:
+            with connection:
+                found = connection.execute('UPDATE models SET last_used=? WHERE key=?', (time.time(), key)).rowcount
+        if not found or not os.path.exists(self._path(key)):
+            return None
+        shutil.copyfile(self._path(key), model_file)
+        return model_file
+
+    def put(self, key, model_file):
+        if not os.path.exists(model_file):
+            return
+        shutil.copyfile(model_file, self._path(key))
+        with self._connect() as connection:
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO models VALUES (?, ?, ?)', (key, os.path.getsize(model_file), time.time()))
+        self.evict()
+
+    def size(self):
+        with self._connect() as connection:
+            return connection.execute('SELECT COALESCE(SUM(size), 0) FROM models').fetchone()[0]
+
+    def evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        freed = 0
+        evicted = []
+        with self._connect() as connection:
+            for key, size in connection.execute('SELECT key, size FROM models ORDER BY last_used'):
+                evicted.append(key)
+                freed += size
+                if freed >= excess:
+                    break
+            with connection:
+                connection.executemany('DELETE FROM models WHERE key=?', [(key,) for key in evicted])
+        for key in evicted:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        return len(evicted)
+
+    def clear(self):
+        with self._connect() as connection:
+            with connection:
+                connection.execute('DELETE FROM models')
+        for name in os.listdir(self.registry_dir):
+            if name != INDEX_FILE and not name.startswith(INDEX_FILE):
+                os.remove(self._path(name))
@@ -0,0 +1,332 @@
+import csv
+import math
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from scipy.optimize import minimize
+from scipy.special import xlogy
+from scipy.stats import norm
+from cps_sorter.services.columnar_dataset import ColumnarDataset, is_columnar
+from cps_sorter.services.portable_model import LogisticModel, TreeModel, ForestModel
+
+# defaults of the weka classifiers the native models stand in for
+RIDGE = 1e-8
+CONFIDENCE = 0.25
+MIN_LEAF = 2
+NUM_TREES = 100
+LN2 = math.log(2)
+# bump whenever the native training changes, models stored in the model registry are then retrained
+NATIVE_MODELS_VERSION = 1
+MODEL_TYPES = {
+    'Logistic.model': 'logistic',
+    'J48.model': 'tree',
+    'RandomForest.model': 'forest'
+}
+
+
+def load_training_data(trainings_file, label='safety'):
+    '''
+    features, classes in order of appearance (as weka reads them), the feature matrix and the class codes
+    '''
+    if is_columnar(trainings_file):
+        dataset = ColumnarDataset(trainings_file)
+        features = dataset.feature_names
+        matrix = dataset.features()
+        labels = dataset.labels().tolist()
+    else:
+        with open(trainings_file, newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader)
+            rows = [row for row in reader if row]
+        position = header.index(label)
+        features = [name for name in header if name != label]
+        matrix = np.array([[float(value) for i, value in enumerate(row) if i != position] for row in rows], dtype=np.float64).reshape(-1, len(features))
+        labels = [row[position] for row in rows]
+    classes = list(dict.fromkeys(labels))
+    codes = {value: code for code, value in enumerate(classes)}
+    return features, classes, matrix, np.array([codes[value] for value in labels], dtype=np.int64)
+
+
+def train_logistic(features, classes, matrix, codes, ridge=RIDGE):
+    '''
+    ridge regularized multinomial logistic regression with the last class as reference, like weka's Logistic.
+    Fitted with L-BFGS on standardized features, the coefficients are returned for the raw features.
+    '''
+    mean, std = standardization(matrix)
+    weights = fit_logistic_weights(matrix, codes, len(classes), mean, std, ridge)
+    return logistic_model(features, classes, weights, mean, std)
+
+
+def standardization(matrix):
+    mean = matrix.mean(axis=0)
+    std = matrix.std(axis=0)
+    std[std == 0] = 1
+    return mean, std
+
+
+def fit_logistic_weights(matrix, codes, num_classes, mean, std, ridge=RIDGE, initial=None):
+    '''
+    the (1 + features, classes - 1) weights of the intercept and the standardized features, L-BFGS starts at initial
+    '''
+    standardized = np.column_stack([np.ones(len(matrix)), (matrix - mean) / std])
+    num_classes = max(num_classes, 2)
+    targets = np.eye(num_classes)[codes]
+
+    def loss(parameters):
+        weights = parameters.reshape(standardized.shape[1], num_classes - 1)
+        scores = np.zeros((len(matrix), num_classes))
+        scores[:, :-1] = standardized @ weights
+        scores -= scores.max(axis=1, keepdims=True)
+        log_probabilities = scores - np.log(np.exp(scores).sum(axis=1, keepdims=True))
+        penalty = ridge * np.sum(weights[1:] ** 2)
+        gradient = standardized.T @ (np.exp(log_probabilities) - targets)[:, :-1]
+        gradient[1:] += 2 * ridge * weights[1:]
+        return -np.sum(targets * log_probabilities) + penalty, gradient.ravel()
+
+    if initial is None:
+        initial = np.zeros(standardized.shape[1] * (num_classes - 1))
+    result = minimize(loss, np.ravel(initial), jac=True, method='L-BFGS-B')
+    return result.x.reshape(standardized.shape[1], num_classes - 1)
+
+
+def logistic_model(features, classes, weights, mean, std):
+    coefficients = weights[1:] / std[:, None]
+    intercepts = weights[0] - mean @ coefficients
+    return LogisticModel(features, classes if len(classes) > 1 else classes + ['unsafe' if classes[0] == 'safe' else 'safe'],
+        coefficients, intercepts)
+
+
+def _xlogx(values):
+    return xlogy(values, values) / LN2
+
+
+def _info(counts, totals):
+    # total * entropy of the class counts, summed over the last axis
+    return _xlogx(totals) - _xlogx(counts).sum(axis=-1)
+
+
+def _feature_splits(values, codes, num_classes, min_leaf, midpoint):
+    '''
+    the best binary split by information gain of every column of values, as arrays of the gain (-inf for columns
+    without a valid split), the threshold, the size of the left branch and the number of candidate thresholds
+    '''
+    total, num_features = values.shape
+    order = np.argsort(values, axis=0, kind='mergesort')
+    values = np.take_along_axis(values, order, axis=0)
+    left_counts = np.cumsum(codes[order][..., None] == np.arange(num_classes), axis=0)[:-1]
+    left_sizes = np.arange(1, total)[:, None]
+    valid = (values[:-1] < values[1:]) & (left_sizes >= min_leaf) & (total - left_sizes >= min_leaf)
+    class_counts = np.bincount(codes, minlength=num_classes)
+    child_info = _info(left_counts, left_sizes) + _info(class_counts - left_counts, total - left_sizes)
+    best = np.argmin(np.where(valid, child_info, np.inf), axis=0)
+    columns = np.arange(num_features)
+    num_candidates = valid.sum(axis=0)
+    gain = np.where(num_candidates > 0, (_info(class_counts, total) - child_info[best, columns]) / total, -np.inf)
+    threshold = values[best, columns]
+    if midpoint:
+        threshold = (threshold + values[best + 1, columns]) / 2
+    return gain, threshold, best + 1, num_candidates
+
+
+class TreeGrower:
+    '''
+    grows binary trees on numeric features. criterion 'gain_ratio' with pruning gives a C4.5/J48 like tree,
+    'gain' with a random feature subset per node and no pruning a RandomTree as used in weka's RandomForest
+    '''
+    def __init__(self, num_classes, criterion='gain_ratio', min_leaf=MIN_LEAF, max_features=None, midpoint=False, prune=True,
+        confidence=CONFIDENCE, rng=None):
+        self.num_classes = num_classes
+        self.criterion = criterion
+        self.min_leaf = min_leaf
+        self.max_features = max_features
+        self.midpoint = midpoint
+        self.prune = prune
+        self.confidence = confidence
+        self.rng = rng or np.random.RandomState(1)
+
+    def _candidate_features(self, num_features):
+        if not self.max_features:
+            return list(range(num_features)), num_features
+        return list(self.rng.permutation(num_features)), self.max_features
+
+    def _best_split(self, matrix, codes):
+        total = len(codes)
+        if total < 2:
+            return None
+        min_leaf = self.min_leaf
+        if self.criterion == 'gain_ratio':
+            # C4.5 asks every branch for 10% of the instances per class, between min_leaf and 25
+            min_leaf = max(min_leaf, min(0.1 * total / self.num_classes, 25))
+        features, wanted = self._candidate_features(matrix.shape[1])
+        # a random tree looks at the other features when none of its random choice is informative
+        for chosen in [features[:wanted], features[wanted:]]:
+            if not chosen:
+                break
+            gain, threshold, left_size, num_candidates = _feature_splits(matrix[:, chosen], codes, self.num_classes, min_leaf, self.midpoint)
+            if self.criterion == 'gain_ratio':
+                # C4.5 release 8 charges numeric splits for the number of thresholds tried
+                gain = gain - np.log2(np.maximum(num_candidates, 1)) / total
+            if (gain > 0).any():
+                break
+        informative = np.flatnonzero(gain > 0)
+        if not len(informative):
+            return None
+        if self.criterion == 'gain':
+            best = informative[np.argmax(gain[informative])]
+            return chosen[best], threshold[best]
+        # C4.5 takes the best gain ratio among the splits with at least average gain
+        candidates = informative[gain[informative] >= gain[informative].mean() - 1e-3]
+        sizes = np.column_stack([left_size[candidates], total - left_size[candidates]])
+        ratio = gain[candidates] / (_info(sizes, total) / total)
+        best = candidates[np.argmax(ratio)]
+        return chosen[best], threshold[best]
+
+    def grow(self, features, classes, matrix, codes):
+        feature, threshold, left, right, distribution = [], [], [], [], []
+
+        def add_node(rows):
+            feature.append(-1)
+            threshold.append(0.0)
+            left.append(-1)
+            right.append(-1)
+            distribution.append(np.bincount(codes[rows], minlength=self.num_classes).astype(np.float64))
+            return len(feature) - 1
+
+        stack = [(add_node(np.arange(len(codes))), np.arange(len(codes)))]
+        while stack:
+            node, rows = stack.pop()
+            if distribution[node].max() == len(rows) or len(rows) < 2 * self.min_leaf:
+                continue
+            split = self._best_split(matrix[rows], codes[rows])
+            if split is None:
+                continue
+            feature[node], threshold[node] = split
+            goes_left = matrix[rows, feature[node]] <= threshold[node]
+            left[node] = add_node(rows[goes_left])
+            right[node] = add_node(rows[~goes_left])
+            stack.append((left[node], rows[goes_left]))
+            stack.append((right[node], rows[~goes_left]))
+
+        tree = TreeModel(features, classes, feature, threshold, left, right, distribution)
+        if self.prune:
+            self._prune(tree, 0)
+        return compact_tree(tree)
+
+    def _estimated_errors(self, counts):
+        total = counts.sum()
+        errors = total - counts.max()
+        return errors + added_errors(total, errors, self.confidence)
+
+    def _prune(self, tree, node):
+        '''
+        C4.5 subtree replacement: a subtree becomes a leaf when the pessimistic error estimate of the leaf
+        is not worse than the estimate of the subtree. Returns the estimate of the (pruned) node.
+        '''
+        leaf_errors = self._estimated_errors(tree.distribution[node])
+        if tree.feature[node] < 0:
+            return leaf_errors
+        subtree_errors = self._prune(tree, tree.left[node]) + self._prune(tree, tree.right[node])
+        if leaf_errors <= subtree_errors + 0.1:
+            tree.feature[node] = -1
+            return leaf_errors
+        return subtree_errors
+
+
+def added_errors(total, errors, confidence):
+    '''
+    the pessimistic number of additional errors of a leaf, weka.classifiers.trees.j48.Stats.addErrs
+    '''
+    if total <= 0:
+        return 0.0
+    if errors < 1:
+        base = total * (1 - math.pow(confidence, 1 / total))
+        if errors == 0:
+            return base
+        return base + errors * (added_errors(total, 1, confidence) - base)
+    if errors + 0.5 >= total:
+        return max(total - errors, 0.0)
+    z = norm.ppf(1 - confidence)
+    f = (errors + 0.5) / total
+    r = (f + z * z / (2 * total) + z * math.sqrt(f / total - f * f / total + z * z / (4 * total * total))) / (1 + z * z / total)
+    return r * total - errors
+
+
+def compact_tree(tree):
+    '''
+    drops the nodes below pruned subtrees
+    '''
+    keep = []
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        keep.append(node)
+        if tree.feature[node] >= 0:
+            stack.extend([tree.right[node], tree.left[node]])
+    keep.sort()
+    position = {node: i for i, node in enumerate(keep)}
+    inner = tree.feature[keep] >= 0
+    left = np.where(inner, [position.get(node, -1) for node in tree.left[keep]], -1)
+    right = np.where(inner, [position.get(node, -1) for node in tree.right[keep]], -1)
+    return TreeModel(tree.features, tree.classes, tree.feature[keep], tree.threshold[keep], left, right, tree.distribution[keep])
+
+
+def train_tree(features, classes, matrix, codes):
+    grower = TreeGrower(len(classes), criterion='gain_ratio', min_leaf=MIN_LEAF, prune=True)
+    return grower.grow(features, classes, matrix, codes)
+
+
+def _grow_random_trees(features, classes, matrix, codes, max_features, seeds):
+    trees = []
+    for seed in seeds:
+        rng = np.random.RandomState(seed)
+        bag = rng.randint(0, len(codes), len(codes))
+        grower = TreeGrower(len(classes), criterion='gain', min_leaf=1, max_features=max_features, midpoint=True, prune=False, rng=rng)
+        trees.append(grower.grow(features, classes, matrix[bag], codes[bag]))
+    return trees
+
+
+def train_forest(features, classes, matrix, codes, num_trees=NUM_TREES, workers=1, seed=1):
+    '''
+    bagged random trees with int(log2(features)) + 1 features per split, the trees are grown on workers processes
+    '''
+    max_features = int(math.log2(len(features))) + 1
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, num_trees).tolist()
+    grow = partial(_grow_random_trees, features, classes, matrix, codes, max_features)
+    if workers <= 1:
+        return ForestModel(features, classes, grow(seeds))
+    chunks = [seeds[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        grown = list(executor.map(grow, chunks))
+    # the trees are put back into seed order, the forest does not depend on the number of workers
+    trees = [None] * num_trees
+    for i, chunk in enumerate(grown):
+        trees[i::workers] = chunk
+    return ForestModel(features, classes, trees)
+
+
+class NativeBackend:
+    '''
+    trains the models in process with numpy/scipy instead of the weka jars, the models are portable models
+    '''
+    def __init__(self, workers=1, seed=1, num_trees=NUM_TREES):
+        self.workers = workers
+        self.seed = seed
+        self.num_trees = num_trees
+
+    def train(self, model, training_data):
+        features, classes, matrix, codes = training_data
+        model_type = MODEL_TYPES.get(model)
+        if model_type == 'logistic':
+            return train_logistic(features, classes, matrix, codes)
+        if model_type == 'tree':
+            return train_tree(features, classes, matrix, codes)
+        if model_type == 'forest':
+            return train_forest(features, classes, matrix, codes, self.num_trees, self.workers, self.seed)
+        raise ValueError('no native model for {}'.format(model))
+
+    def fingerprint(self, model):
+        return {'backend': 'native', 'version': NATIVE_MODELS_VERSION, 'model': MODEL_TYPES.get(model), 'seed': self.seed, 'num_trees': self.num_trees}
+
+    def build_models(self, trainings_file, models):
+        training_data = load_training_data(trainings_file)
+        return {model: self.train(model, training_data) for model in models}
@@ -0,0 +1,73 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from cps_sorter.services.native_models import standardization
+from cps_sorter.services.road_transformer import FULLROAD_FEATURES
+
+DEFAULT_NOVELTY_RADIUS = 0.0
+DEFAULT_REBUILD_EVERY = 50
+
+
+class NoveltyFilter:
+    '''
+    the outcomes of the simulated tests by their feature rows. A test within radius of a simulated test
+    (euclidean distance of the features standardized with the simulated tests) gets the outcome of the closest
+    one instead of being simulated. The KD-tree is rebuilt lazily once rebuild_every tests were added since the
+    last build, the tests added in between are searched directly
+    '''
+    def __init__(self, radius, features=FULLROAD_FEATURES, rebuild_every=DEFAULT_REBUILD_EVERY):
+        self.radius = radius
+        self.features = features
+        self.rebuild_every = rebuild_every
+        self.rows = []
+        self.outcomes = []
+        self.tree = None
+        self.built = 0
+        self.rebuilds = 0
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+        self.reused_unsafe = 0
+
+    def _vector(self, row):
+        return (np.array([float(row[feature]) for feature in self.features]) - self.mean) / self.std
+
+    def _rebuild(self):
+        matrix = np.array([[float(row[feature]) for feature in self.features] for row in self.rows])
+        self.mean, self.std = standardization(matrix)
+        self.tree = cKDTree((matrix - self.mean) / self.std)
+        self.built = len(self.rows)
+        self.rebuilds += 1
+
+    def add(self, row, unsafe, seconds):
+        if row is None:
+            return
+        self.rows.append(row)
+        self.outcomes.append((unsafe, seconds))
+
+    def lookup(self, row):
+        '''
+        the outcome (unsafe, seconds) of the closest simulated test within radius, None when the test is new
+        '''
+        if row is None or not self.rows:
+            return None
+        if self.tree is None or len(self.rows) - self.built >= self.rebuild_every:
+            self._rebuild()
+        vector = self._vector(row)
+        distance, closest = self.tree.query(vector, distance_upper_bound=self.radius)
+        closest = int(closest) if np.isfinite(distance) else None
+        for i in range(self.built, len(self.rows)):
+            pending = np.sqrt(((self._vector(self.rows[i]) - vector) ** 2).sum())
+            if pending <= self.radius and pending < distance:
+                distance, closest = pending, i
+        if closest is None:
+            self.misses += 1
+            return None
+        unsafe, seconds = self.outcomes[closest]
+        self.hits += 1
+        self.time_saved += seconds
+        self.reused_unsafe += int(unsafe)
+        return unsafe, seconds
+
+    def stats(self):
+        return {'radius': self.radius, 'hits': self.hits, 'misses': self.misses, 'time_saved': self.time_saved,
+            'reused_unsafe': self.reused_unsafe, 'known_tests': len(self.rows), 'rebuilds': self.rebuilds}
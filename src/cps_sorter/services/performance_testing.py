@@ -1,19 +1,102 @@
-import json
-import datetime
 import random
 import tempfile
 import os.path
+import zlib
+import numpy as np
 import pandas as pd
 from os import listdir
 from shutil import copyfile
 from cps_sorter.services.weka_helper import WekaHelper
 from cps_sorter.services.road_transformer import RoadTransformer
+import cps_sorter.services.utility as utility
+from cps_sorter.services.scenario_loader import load_scenario, EXECUTION
+from cps_sorter.services.corpus_index import CorpusIndex
+from cps_sorter.services.feature_cache import file_hash
+from cps_sorter.services.split_manifest import sample_split
+from cps_sorter.services.baseline_simulator import BaselineSimulator, PREDICTED_SAFE, PREDICTED_UNSAFE, NO_PREDICTION
 
 
 class PerformanceTester:
-    def __init__(self, weka_helper):
+    def __init__(self, weka_helper, road_transformer=None, corpus_index=None, seed=None):
         self.weka_helper = weka_helper
-        self.road_transformer = RoadTransformer()
+        if not road_transformer:
+            road_transformer = RoadTransformer()
+        self.road_transformer = road_transformer
+        self.corpus_index = corpus_index
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+        self.predictions = {}
+
+    def _is_indexed(self, tests):
+        return self.corpus_index is not None and all(test in self.corpus_index for test in tests)
+
+    def _simulator(self, test_set, stream=None):
+        '''
+        all rounds of a baseline are simulated at once when the labels and costs of the test set are indexed.
+        With a seed, a named stream draws from its own generator, so the model baselines give the same
+        results in whatever order the models finish training
+        '''
+        if not self._is_indexed(test_set):
+            return None
+        indices = self.corpus_index.indices(test_set)
+        rng = self.rng
+        if stream is not None and self.seed is not None:
+            rng = np.random.default_rng([self.seed, zlib.crc32(stream.encode())])
+        return BaselineSimulator(self.corpus_index.costs[indices], self.corpus_index.is_unsafe[indices], rng)
+
+    def predict_test_set(self, test_set, model):
+        '''
+        the prediction of model for every test of test_set as a dict of test to 'safe', 'unsafe' or None.
+        Tests not predicted before are predicted with one call of the bulk prediction jar, predictions are
+        kept by the hashes of the model file and the scenario file, in memory and in the feature cache
+        '''
+        cache = self.road_transformer.feature_cache
+        model_hash = file_hash(self.weka_helper.get_models()[model])
+        namespace = 'prediction:{}'.format(model_hash)
+        content_hashes = {test: file_hash(test) for test in test_set}
+        predictions = {}
+        used_hashes = []
+        for test, content_hash in content_hashes.items():
+            key = (model_hash, content_hash)
+            if key not in self.predictions and cache:
+                entry = cache.get(content_hash, namespace)
+                if entry is not None:
+                    self.predictions[key] = entry['prediction']
+                    used_hashes.append(content_hash)
+            if key in self.predictions:
+                predictions[test] = self.predictions[key]
+
+        missing = [test for test in content_hashes if test not in predictions]
+        new_entries = []
+        if missing:
+            print('Predicting {} tests with {}'.format(len(missing), model))
+            to_predict, converted = self.road_transformer.convert_files_to_test_bulk(missing)
+            # tests without features are not predicted again during this run
+            for test in set(missing) - set(converted):
+                self.predictions[(model_hash, content_hashes[test])] = None
+            labels = self.weka_helper.make_bulk_predictions(model, to_predict, len(converted)) if converted else []
+            if labels is None or len(labels) != len(converted):
+                print('Bulk prediction with {} returned {} of {} predictions'.format(model, len(labels or []), len(converted)))
+                labels = [None] * len(converted)
+            for test, label in zip(converted, labels):
+                predictions[test] = label
+                if label is not None:
+                    self.predictions[(model_hash, content_hashes[test])] = label
+                    new_entries.append((content_hashes[test], {'prediction': label}))
+        if cache:
+            cache.put_many(namespace, new_entries, used_hashes)
+        return {test: predictions.get(test) for test in test_set}
+
+    def _prediction_codes(self, predictions, test_set):
+        codes = {'safe': PREDICTED_SAFE, 'unsafe': PREDICTED_UNSAFE}
+        return np.array([codes.get(predictions[test], NO_PREDICTION) for test in test_set], dtype=np.int8)
+
+    def is_unsafe(self, test):
+        if self._is_indexed([test]):
+            return bool(self.corpus_index.is_unsafe[self.corpus_index.index_of(test)])
+        data = load_scenario(test, [EXECUTION])
+        return data['execution']['oobs'] > 0
 
 
     def offline_testing(self, dataset_path):
@@ -31,6 +114,10 @@ class PerformanceTester:
         return avg_results
 
     def get_random_baseline_fixed_test_num(self, test_set, num_tests, rounds):
+        simulator = self._simulator(test_set)
+        if simulator:
+            print('Random_fixed. {} rounds'.format(rounds))
+            return self.get_avg_results(simulator.random_fixed(num_tests, rounds))
         results = []
         for i in range(0, rounds):
             test_files = self.random_test_selection(test_set, num_tests)
@@ -47,7 +134,7 @@ class PerformanceTester:
         random_selected_tests = []
         sampled_test = 0
         while sampled_test < num_tests:
-            random_num = random.randint(0, (len(tests)-1))
+            random_num = self.random.randint(0, (len(tests)-1))
             if tests[random_num] not in random_selected_tests:
                 random_selected_tests.append(tests[random_num])
                 sampled_test += 1
@@ -55,6 +142,10 @@ class PerformanceTester:
 
 
     def get_random_baseline_reach_unsafe_num(self, test_set, num_unsafe, rounds):
+        simulator = self._simulator(test_set)
+        if simulator:
+            print('Random_reached. {} rounds'.format(rounds))
+            return self.get_avg_results(simulator.random_reach(num_unsafe, rounds))
         results = []
         for i in range(0, rounds):
             print('Random_reached. round: {}'.format(i))
@@ -62,12 +153,10 @@ class PerformanceTester:
             test_files = []
             max_index = len(test_set)-1
             while(count_unsafe < num_unsafe):
-                test = test_set[random.randint(0, max_index)]
+                test = test_set[self.random.randint(0, max_index)]
                 test_files.append(test)
-                with open(test) as json_file:
-                    data = json.load(json_file)
-                    if data['execution']['oobs'] > 0:
-                        count_unsafe += 1
+                if self.is_unsafe(test):
+                    count_unsafe += 1
             results.append(self.evaluate_tests(test_files))
         return self.get_avg_results(results)
    
@@ -79,33 +168,53 @@ class PerformanceTester:
             'num_unsafe':0,
             'num_safe': 0
         }
+        if self._is_indexed(tests):
+            indices = self.corpus_index.indices(tests)
+            costs = self.corpus_index.costs[indices]
+            is_unsafe = self.corpus_index.is_unsafe[indices]
+            # python sums keep the summation order of the per file loop
+            result['total_cost'] += sum(costs.tolist())
+            result['cost_unsafe'] += sum(costs[is_unsafe].tolist())
+            result['cost_safe'] += sum(costs[~is_unsafe].tolist())
+            result['num_unsafe'] = int(np.count_nonzero(is_unsafe))
+            result['num_safe'] = len(tests) - result['num_unsafe']
+            result['num_tests'] = result['num_safe'] + result['num_unsafe']
+            return result
         for test in tests:
-            with open(test) as json_file:
-                data = json.load(json_file)
-                execution_time = (datetime.datetime.strptime(data['execution']['end_time'], '%Y-%m-%dT%H:%M:%S.%f') - datetime.datetime.strptime(data['execution']['start_time'], '%Y-%m-%dT%H:%M:%S.%f')).total_seconds()
-                if data['execution']['oobs'] > 0:
-                    result['num_unsafe'] += 1
-                    result['cost_unsafe'] += execution_time
+            data = load_scenario(test, [EXECUTION])
+            execution_time = utility.get_execution_time(data['execution'])
+            if data['execution']['oobs'] > 0:
+                result['num_unsafe'] += 1
+                result['cost_unsafe'] += execution_time
 
-                else:
-                    result['cost_safe'] += execution_time
-                    result['num_safe'] += 1
-                result['total_cost'] += execution_time
+            else:
+                result['cost_safe'] += execution_time
+                result['num_safe'] += 1
+            result['total_cost'] += execution_time
         result['num_tests'] = result['num_safe'] + result['num_unsafe']
         return result
 
     def model_based_fixed_baseline(self, test_set, num_tests, rounds, models=[]):
         model_to_result = {}
         for model in models:
+            predictions = self.predict_test_set(test_set, model)
+            simulator = self._simulator(test_set, 'model_fixed:{}'.format(model))
+            if simulator:
+                print('Model_fixed. {} rounds'.format(rounds))
+                codes = self._prediction_codes(predictions, test_set)
+                model_to_result[model] = self.get_avg_results(simulator.model_fixed(codes, num_tests, rounds))
+                continue
             results = []
             for i in range(0, rounds):
                 print('Model_fixed. round: {}'.format(i))
-                results.append(self.round_model_performance_test(test_set, num_tests, model))
+                results.append(self.round_model_performance_test(test_set, num_tests, model, predictions))
             model_to_result[model] = self.get_avg_results(results)
 
         return model_to_result
 
-    def round_model_performance_test(self, test_set, num_tests, model):
+    def round_model_performance_test(self, test_set, num_tests, model, predictions=None):
+        if predictions is None:
+            predictions = self.predict_test_set(test_set, model)
         result = {
                 'num_missed_unsafe_tests': 0,
                 'num_missed_safe_tests': 0,
@@ -123,9 +232,7 @@ class PerformanceTester:
                 if file not in already_tested_files:
                     already_tested_files.append(file)
                     break
-            test_file = self.road_transformer.convert_to_test(file, is_file=True)
-            safety_prediction = self.weka_helper.make_prediction(model, test_file)
-            # os.remove(test_file)
+            safety_prediction = predictions[file]
 
             ev = self.evaluate_test(file)
             if safety_prediction == 'safe':
@@ -148,6 +255,13 @@ class PerformanceTester:
     def get_model_baseline_reach_unsafe_num(self, test_set, num_unsafe, rounds, models):
         model_to_result = {}
         for model in models:
+            predictions = self.predict_test_set(test_set, model)
+            simulator = self._simulator(test_set, 'model_reach:{}'.format(model))
+            if simulator:
+                print('Model_reached. {} rounds'.format(rounds))
+                codes = self._prediction_codes(predictions, test_set)
+                model_to_result[model] = self.get_avg_results(simulator.model_reach(codes, num_unsafe, rounds))
+                continue
             results = []
             for i in range(0, rounds):
                 print('Model_reached. round: {}'.format(i))
@@ -165,15 +279,12 @@ class PerformanceTester:
                 }
                 while(count_unsafe < num_unsafe):
                     while True:
-                        test = test_set[random.randint(0, max_index)]
+                        test = test_set[self.random.randint(0, max_index)]
                         if test not in test_files:
                             test_files.append(test)
                             break
 
-                    test_file = self.road_transformer.convert_to_test(test, is_file=True)
-
-                    safety_prediction = self.weka_helper.make_prediction(model, test_file)
-                    # os.remove(test_file)
+                    safety_prediction = predictions[test]
 
                     ev = self.evaluate_test(test)
                     if safety_prediction == 'safe':
@@ -203,63 +314,28 @@ class PerformanceTester:
             'cost': 0,
             'is_safe': True,
         }
-        with open(test) as json_file:
-            data = json.load(json_file)
-            execution_time = (datetime.datetime.strptime(data['execution']['end_time'], '%Y-%m-%dT%H:%M:%S.%f') - datetime.datetime.strptime(data['execution']['start_time'], '%Y-%m-%dT%H:%M:%S.%f')).total_seconds()
-            if data['execution']['oobs'] > 0:
-                result['is_safe'] = False
-            result['cost'] += execution_time
+        if self._is_indexed([test]):
+            return self.corpus_index.evaluate(test)
+        data = load_scenario(test, [EXECUTION])
+        execution_time = utility.get_execution_time(data['execution'])
+        if data['execution']['oobs'] > 0:
+            result['is_safe'] = False
+        result['cost'] += execution_time
         return result
 
 
 def split_data(safe_dir, unsafe_dir, out_dir, train_test_ratio, unsafe_ratio):
-    counter = 0
-    safe_files = ['{}/{}'.format(safe_dir, f) for f in listdir(safe_dir) if os.path.isfile(os.path.join(safe_dir, f))]
-    unsafe_files = ['{}/{}'.format(unsafe_dir, f) for f in listdir(unsafe_dir) if os.path.isfile(os.path.join(unsafe_dir, f))]
-
-    if len(safe_files) < len(unsafe_files):
-        num_to_sample = int(train_test_ratio * len(safe_files))
-    else:
-        num_to_sample = int(train_test_ratio * len(unsafe_files))
+    '''
+    copies a split into out_dir/training and out_dir/test, split_corpus gives the same split as a manifest without copies
+    '''
+    safe_files = ['{}/{}'.format(safe_dir, f) for f in listdir(safe_dir) if os.path.isfile(os.path.join(safe_dir, f)) and utility.is_scenario_file(f)]
+    unsafe_files = ['{}/{}'.format(unsafe_dir, f) for f in listdir(unsafe_dir) if os.path.isfile(os.path.join(unsafe_dir, f)) and utility.is_scenario_file(f)]
 
     training_dir_path = '{}/training'.format(out_dir)
     test_dir_path = '{}/test'.format(out_dir)
     os.mkdir(training_dir_path)
     os.mkdir(test_dir_path)
-    safe_training = random.sample(safe_files, num_to_sample)
-    
-    for safe_sample in safe_training:
-        safe_files.remove(safe_sample)
-
-    unsafe_training  = random.sample(unsafe_files, num_to_sample)
-
-    for unsafe_sample in unsafe_training:
-        unsafe_files.remove(unsafe_sample)
-    training_set = safe_training + unsafe_training
-    
-    total_sum = len(unsafe_files) + len(safe_files)
-    len_unsafe = len(unsafe_files)
-    len_safe = len(safe_files)
-    num_unsafe_sample = int(unsafe_ratio * total_sum)
-    num_safe_sample = int((1-unsafe_ratio)*total_sum)
-
-    if num_safe_sample > len_safe:
-        num_safe_sample  = len_safe
-        num_unsafe_sample = int(num_safe_sample / (1-unsafe_ratio) * unsafe_ratio)
-        if num_unsafe_sample > len_unsafe:
-            num_unsafe_sample = len_unsafe
-            num_safe_sample = int(len_safe / unsafe_ratio * (1-unsafe_ratio))
-
-    if num_unsafe_sample > len(unsafe_files):
-        num_unsafe_sample = len_unsafe
-        num_safe_sample  = int(num_unsafe_sample / unsafe_ratio * (1-unsafe_ratio))
-        if num_safe_sample > len_safe:
-            num_safe_sample = len_safe
-            num_unsafe_sample = int(len_safe /  (1-unsafe_ratio) * unsafe_ratio)
-
-    safe_test = random.sample(safe_files,num_safe_sample)
-    unsafe_test = random.sample(unsafe_files,num_unsafe_sample)
-    test_set = safe_test + unsafe_test
+    training_set, test_set = sample_split(safe_files, unsafe_files, train_test_ratio, unsafe_ratio)
     for training in training_set:
         filename = training.split('/')[-1]
         copyfile(training, '{}/{}'.format(training_dir_path, filename))
@@ -270,28 +346,30 @@ def split_data(safe_dir, unsafe_dir, out_dir, train_test_ratio, unsafe_ratio):
     print(count_safe_unsafe(test_dir_path))
     return training_dir_path, test_dir_path
 
-def count_safe_unsafe(folder):
-    result = {'unsafe':0, 'safe':0}
-    for subdir, dirs, files in os.walk(folder):
-        for c, filename in enumerate(files):
-            is_timeout = False
-            splited_subdir = subdir.split('\\')
-            dir_name = splited_subdir[-1]
-            filepath = subdir + os.sep + filename
-            with open(filepath) as json_file:
-                try:
-                    data = json.load(json_file)
-                    execution = data.pop('execution', {})
-                    if execution['reason'] == 'timeout':
-                        continue
-                    if execution['oobs'] > 0:
-                        result['unsafe'] += 1
-                    else:
-                        result['safe'] += 1
-                
-                except Exception as e:
-                    print(e)
-    return result
+def count_safe_unsafe(folder, corpus_index=None):
+    '''
+    folder is a scenario directory or a list of scenario files, e.g. one side of a SplitManifest
+    '''
+    if isinstance(folder, (list, tuple)):
+        if corpus_index is not None and all(test in corpus_index for test in folder):
+            return corpus_index.count_safe_unsafe(corpus_index.indices(folder))
+        result = {'unsafe':0, 'safe':0}
+        for filepath in folder:
+            try:
+                execution = load_scenario(filepath, [EXECUTION])['execution']
+                if execution['reason'] == 'timeout':
+                    continue
+                if execution['oobs'] > 0:
+                    result['unsafe'] += 1
+                else:
+                    result['safe'] += 1
+            except Exception as e:
+                print(e)
+        return result
+    if corpus_index is None:
+        corpus_index = CorpusIndex(folder).refresh()
+    return corpus_index.count_safe_unsafe()
+
 
 # if __name__ == '__main__':
 #     # dataset = 'D:/MasterThesis/DataSet/performance_test/beamng'
@@ -0,0 +1,357 @@
+import json
+import re
+import decimal
+import numpy as np
+
+PORTABLE_EXTENSION = '.json'
+# rows where the two most probable classes are closer than this may be labelled differently than by weka
+DEFAULT_PROBABILITY_TOLERANCE = 0.02
+
+TREE_LINE = re.compile(r'^((?:\|\s{3})*)(\S+) (<=|>=|<|>|=) (\S+?)\s*(?::\s*(\S+) \(([^/)]+)(?:/([^)]+))?\))?\s*$')
+
+
+class PortableModel:
+    '''
+    a trained classifier as plain arrays that can be stored as json and scored on whole feature matrices.
+    The columns of a feature matrix follow self.features, the columns of the probabilities self.classes.
+    '''
+    def __init__(self, features, classes):
+        self.features = list(features)
+        self.classes = list(classes)
+
+    def matrix(self, rows):
+        return np.array([[row[feature] for feature in self.features] for row in rows], dtype=np.float64).reshape(-1, len(self.features))
+
+    def predict_proba(self, features):
+        raise NotImplementedError
+
+    def predict(self, features):
+        probabilities = self.predict_proba(features)
+        return np.array(self.classes, dtype=object)[np.argmax(probabilities, axis=1)], probabilities
+
+    def uncertain(self, features, tolerance=DEFAULT_PROBABILITY_TOLERANCE):
+        '''
+        rows whose label may differ from the one of the weka model the portable model was read from, because
+        the printed model is rounded: the two most probable classes are within tolerance
+        '''
+        probabilities = np.sort(self.predict_proba(features), axis=1)
+        if probabilities.shape[1] < 2:
+            return np.zeros(len(features), dtype=bool)
+        return probabilities[:, -1] - probabilities[:, -2] <= tolerance
+
+    def predict_rows(self, rows):
+        '''
+        labels and class probabilities of rows (dicts of feature values) in the format of the prediction workers
+        '''
+        labels, probabilities = self.predict(self.matrix(rows))
+        return labels.tolist(), [dict(zip(self.classes, values)) for values in probabilities.tolist()]
+
+    def to_dict(self):
+        return {'type': self.TYPE, 'features': self.features, 'classes': self.classes}
+
+    def save(self, model_file):
+        with open(model_file, 'w') as outfile:
+            json.dump(self.to_dict(), outfile)
+        return model_file
+
+
+class LogisticModel(PortableModel):
+    '''
+    multinomial logistic regression with the last class as reference class, as weka.classifiers.functions.Logistic.
+    coefficients is (features, classes - 1), intercepts (classes - 1)
+    '''
+    TYPE = 'logistic'
+
+    def __init__(self, features, classes, coefficients, intercepts):
+        PortableModel.__init__(self, features, classes)
+        self.coefficients = np.asarray(coefficients, dtype=np.float64).reshape(len(self.features), len(self.classes) - 1)
+        self.intercepts = np.asarray(intercepts, dtype=np.float64).reshape(len(self.classes) - 1)
+
+    def predict_proba(self, features):
+        scores = np.zeros((len(features), len(self.classes)))
+        scores[:, :-1] = features @ self.coefficients + self.intercepts
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def to_dict(self):
+        data = PortableModel.to_dict(self)
+        data.update({'coefficients': self.coefficients.tolist(), 'intercepts': self.intercepts.tolist()})
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['features'], data['classes'], data['coefficients'], data['intercepts'])
+
+
+class TreeModel(PortableModel):
+    '''
+    a binary decision tree as node arrays, a row goes to the left child when its value of feature is <= threshold.
+    Leaves have feature -1, distribution holds the class distribution of every node. rounding is how far the
+    threshold of a node read from a printed tree may be from the exact one, 0 for trees trained in process.
+    '''
+    TYPE = 'tree'
+
+    def __init__(self, features, classes, feature, threshold, left, right, distribution, rounding=None):
+        PortableModel.__init__(self, features, classes)
+        self.feature = np.asarray(feature, dtype=np.int64)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int64)
+        self.right = np.asarray(right, dtype=np.int64)
+        self.distribution = np.asarray(distribution, dtype=np.float64).reshape(len(self.feature), len(self.classes))
+        self.rounding = np.zeros(len(self.feature)) if rounding is None else np.asarray(rounding, dtype=np.float64)
+
+    def leaves(self, features, near_split=None):
+        '''
+        the leaf of every row, near_split (a boolean array) marks the rows passing a split within its rounding
+        '''
+        node = np.zeros(len(features), dtype=np.int64)
+        rows = np.arange(len(features))
+        while True:
+            inner = self.feature[node] >= 0
+            if not inner.any():
+                return node
+            active = rows[inner]
+            current = node[active]
+            values = features[active, self.feature[current]]
+            if near_split is not None:
+                near_split[active] |= np.abs(values - self.threshold[current]) <= self.rounding[current]
+            goes_left = values <= self.threshold[current]
+            node[active] = np.where(goes_left, self.left[current], self.right[current])
+
+    def near_split(self, features):
+        near_split = np.zeros(len(features), dtype=bool)
+        self.leaves(features, near_split)
+        return near_split
+
+    def uncertain(self, features, tolerance=DEFAULT_PROBABILITY_TOLERANCE):
+        return PortableModel.uncertain(self, features, tolerance) | self.near_split(features)
+
+    def predict_proba(self, features):
+        distribution = self.distribution[self.leaves(features)]
+        totals = distribution.sum(axis=1, keepdims=True)
+        return distribution / np.where(totals > 0, totals, 1)
+
+    def to_dict(self):
+        data = PortableModel.to_dict(self)
+        data.update({'feature': self.feature.tolist(), 'threshold': self.threshold.tolist(), 'left': self.left.tolist(),
+            'right': self.right.tolist(), 'distribution': self.distribution.tolist(), 'rounding': self.rounding.tolist()})
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['features'], data['classes'], data['feature'], data['threshold'], data['left'], data['right'], data['distribution'],
+            data.get('rounding'))
+
+
+class ForestModel(PortableModel):
+    '''
+    an ensemble of TreeModels, the class probabilities are the mean of the tree probabilities like weka's RandomForest
+    '''
+    TYPE = 'forest'
+
+    def __init__(self, features, classes, trees):
+        PortableModel.__init__(self, features, classes)
+        self.trees = list(trees)
+
+    def predict_proba(self, features):
+        return np.mean([tree.predict_proba(features) for tree in self.trees], axis=0)
+
+    def uncertain(self, features, tolerance=DEFAULT_PROBABILITY_TOLERANCE):
+        uncertain = PortableModel.uncertain(self, features, tolerance)
+        for tree in self.trees:
+            uncertain |= tree.near_split(features)
+        return uncertain
+
+    def to_dict(self):
+        data = PortableModel.to_dict(self)
+        data['trees'] = [tree.to_dict() for tree in self.trees]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['features'], data['classes'], [TreeModel.from_dict(tree) for tree in data['trees']])
+
+
+MODEL_TYPES = {model_type.TYPE: model_type for model_type in [LogisticModel, TreeModel, ForestModel]}
+
+
+def from_dict(data):
+    return MODEL_TYPES[data['type']].from_dict(data)
+
+
+def load_portable_model(model_file):
+    with open(model_file) as json_file:
+        return from_dict(json.load(json_file))
+
+
+def is_portable_model(model_file):
+    return str(model_file).endswith(PORTABLE_EXTENSION)
+
+
+def portable_model_file(model_file):
+    '''
+    the portable description exported next to a weka model file
+    '''
+    if is_portable_model(model_file):
+        return model_file
+    return '{}{}'.format(model_file, PORTABLE_EXTENSION)
+
+
+def parse_logistic(text, features, classes):
+    '''
+    reads the coefficients table printed by weka.classifiers.functions.Logistic. The table has a column for
+    every class but the reference class, the order of the classes is taken from it
+    '''
+    lines = text.splitlines()
+    start = next(i for i, line in enumerate(lines) if line.strip().startswith('Coefficients'))
+    header = next(i for i in range(start, len(lines)) if lines[i].strip().startswith('Variable'))
+    columns = lines[header].split()[1:]
+    reference = [value for value in classes if value not in columns]
+    if len(reference) != 1 or len(columns) != len(classes) - 1:
+        raise ValueError('coefficients for classes {} do not match {}'.format(columns, classes))
+    classes = columns + reference
+    coefficients = np.zeros((len(features), len(classes) - 1))
+    intercepts = None
+    for line in lines[header + 1:]:
+        if line.startswith('='):
+            continue
+        values = line.split()
+        if not values:
+            break
+        name, numbers = values[0], [float(value) for value in values[1:]]
+        if name == 'Intercept':
+            intercepts = numbers
+            break
+        coefficients[features.index(name)] = numbers
+    if intercepts is None:
+        raise ValueError('no intercept in the logistic model')
+    return LogisticModel(features, classes, coefficients, intercepts)
+
+
+def _leaf_distribution(label, weight, errors, classes):
+    distribution = np.zeros(len(classes))
+    weight = float(weight)
+    errors = float(errors) if errors else 0.0
+    if weight <= 0:
+        # an empty leaf predicts its class like the parent majority
+        distribution[classes.index(label)] = 1.0
+        return distribution
+    others = len(classes) - 1
+    for i, value in enumerate(classes):
+        distribution[i] = weight - errors if value == label else errors / others
+    return distribution
+
+
+def _rounding(value):
+    # half a unit of the last printed digit of value
+    return 0.5 * 10.0 ** decimal.Decimal(value).as_tuple().exponent
+
+
+def parse_tree(lines, features, classes):
+    '''
+    reads the tree printed by J48 ("feature <= x", "feature > x") or RandomTree ("feature < x", "feature >= x"),
+    one condition per line with "|   " per level and "label (weight/errors)" at the leaves
+    '''
+    parsed = []
+    for line in lines:
+        match = TREE_LINE.match(line.rstrip())
+        if not match:
+            continue
+        depth, name, operator, value, label, weight, errors = match.groups()
+        if operator == '=':
+            raise ValueError('nominal split on {} is not supported'.format(name))
+        parsed.append((len(depth) // 4, name, operator, value, label, weight, errors))
+    if not parsed:
+        raise ValueError('no tree found')
+    # weka drops the trailing zeros of the numbers it prints, the finest printed digit is the precision of the tree
+    half_digit = min(_rounding(value) for level, name, operator, value, label, weight, errors in parsed)
+
+    feature, threshold, left, right, distribution, rounding = [], [], [], [], [], []
+
+    def add_node():
+        feature.append(-1)
+        threshold.append(0.0)
+        rounding.append(0.0)
+        left.append(-1)
+        right.append(-1)
+        distribution.append(np.zeros(len(classes)))
+        return len(feature) - 1
+
+    def branch(i, depth):
+        # the node for the condition at line i, returns the node and the line after its subtree
+        level, name, operator, value, label, weight, errors = parsed[i]
+        node = add_node()
+        if label is not None:
+            distribution[node] = _leaf_distribution(label, weight, errors, classes)
+            return node, i + 1
+        return split(i + 1, depth + 1, node)
+
+    def split(i, depth, node=None):
+        if node is None:
+            node = add_node()
+        level, name, operator, value, label, weight, errors = parsed[i]
+        if level != depth or operator not in ('<=', '<'):
+            raise ValueError('unexpected tree line {}'.format(i))
+        feature[node] = features.index(name)
+        # the exact threshold is within half a printed digit of x. J48 splits on a training value, which has to
+        # stay on the left of "<= x", "< x" is "<= the largest double below x"
+        threshold[node] = float(value) + half_digit if operator == '<=' else np.nextafter(float(value), -np.inf)
+        rounding[node] = 2 * half_digit
+        left[node], i = branch(i, depth)
+        if i >= len(parsed) or parsed[i][0] != depth or parsed[i][1] != name or parsed[i][2] not in ('>', '>='):
+            raise ValueError('missing right branch of {} at line {}'.format(name, i))
+        right[node], i = branch(i, depth)
+        distribution[node] = distribution[left[node]] + distribution[right[node]]
+        return node, i
+
+    if len(parsed) == 1 or parsed[0][0] != 0:
+        raise ValueError('unexpected tree layout')
+    root, end = split(0, 0)
+    if end != len(parsed):
+        raise ValueError('unparsed tree lines after line {}'.format(end))
+    return TreeModel(features, classes, feature, threshold, left, right, distribution, rounding)
+
+
+def _single_leaf(text, features, classes):
+    # a tree without splits is printed as ": label (weight/errors)"
+    match = re.search(r'^\s*:\s*(\S+) \(([^/)]+)(?:/([^)]+))?\)', text, re.MULTILINE)
+    if not match:
+        return None
+    return TreeModel(features, classes, [-1], [0.0], [-1], [-1], [_leaf_distribution(match.group(1), match.group(2), match.group(3), classes)])
+
+
+def parse_j48(text, features, classes):
+    lines = text.splitlines()
+    start = next(i for i, line in enumerate(lines) if line.startswith('---')) + 1
+    end = next(i for i in range(start, len(lines)) if lines[i].startswith('Number of Leaves'))
+    body = '\n'.join(lines[start:end])
+    return _single_leaf(body, features, classes) or parse_tree(body.splitlines(), features, classes)
+
+
+def parse_random_forest(text, features, classes):
+    '''
+    needs the trees in the model text, i.e. a forest trained with -print
+    '''
+    blocks = re.split(r'^RandomTree\s*\n=+\s*$', text, flags=re.MULTILINE)[1:]
+    if not blocks:
+        raise ValueError('the forest text has no trees, train the forest with -print')
+    trees = []
+    for block in blocks:
+        body = block.split('Size of the tree')[0]
+        trees.append(_single_leaf(body, features, classes) or parse_tree(body.splitlines(), features, classes))
+    return ForestModel(features, classes, trees)
+
+
+def parse_weka_model(text, features, classes):
+    '''
+    the portable model of the text weka prints for a Logistic, J48 or RandomForest model, classes are the values
+    of the class attribute in the order of the header of the training data
+    '''
+    if 'Logistic Regression' in text:
+        return parse_logistic(text, features, classes)
+    if 'J48' in text:
+        return parse_j48(text, features, classes)
+    if 'RandomTree' in text or 'Random forest' in text:
+        return parse_random_forest(text, features, classes)
+    raise ValueError('unknown weka model text')
@@ -0,0 +1,200 @@
+import itertools
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+# the java server is not part of the package, it has to be built into jars/ to be used
+PREDICTION_SERVER_JAR = '{}/jars/predictionServer.jar'.format(os.path.dirname(os.path.realpath(__file__)))
+WORKER_COMMANDS = {
+    'python': [sys.executable, '-m', 'cps_sorter.services.prediction_worker'],
+    'java': ['java', '-jar', PREDICTION_SERVER_JAR]
+}
+DEFAULT_WORKER = 'python'
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_RESTARTS = 3
+
+
+class PredictionWorkerError(Exception):
+    '''
+    the worker process died, did not answer in time or could not be started
+    '''
+
+
+class PredictionWorker:
+    '''
+    one long-lived prediction server process, requests and responses are json lines over its stdin/stdout,
+    see prediction_worker for the protocol
+    '''
+    def __init__(self, command, timeout=DEFAULT_TIMEOUT):
+        self.command = command
+        self.timeout = timeout
+        self.ids = itertools.count()
+        self.responses = queue.Queue()
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+        except OSError as e:
+            raise PredictionWorkerError('cannot start {}: {}'.format(' '.join(command), e))
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            self.responses.put(line)
+        self.responses.put(None)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def request(self, message):
+        message = dict(message, id=next(self.ids))
+        try:
+            self.process.stdin.write(json.dumps(message) + '\n')
+            self.process.stdin.flush()
+        except (OSError, ValueError) as e:
+            raise PredictionWorkerError('worker stopped: {}'.format(e))
+        while True:
+            try:
+                line = self.responses.get(timeout=self.timeout)
+            except queue.Empty:
+                raise PredictionWorkerError('no response within {}s'.format(self.timeout))
+            if line is None:
+                raise PredictionWorkerError('worker exited with {}'.format(self.process.wait()))
+            try:
+                response = json.loads(line)
+            except ValueError:
+                # log output of the server
+                print('prediction worker: {}'.format(line.rstrip()))
+                continue
+            # answers to requests that timed out before are dropped
+            if not isinstance(response, dict) or response.get('id') != message['id']:
+                continue
+            if not response.get('ok'):
+                raise ValueError(response.get('error'))
+            return response
+
+    def ping(self):
+        try:
+            self.request({'op': 'ping'})
+            return True
+        except (PredictionWorkerError, ValueError):
+            return False
+
+    def close(self, kill=False):
+        if kill:
+            self.process.kill()
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+
+
+class PredictionPool:
+    '''
+    a pool of warm prediction workers that keep their models loaded between calls. A worker that dies or
+    stops answering is restarted and the request is sent once more; after max_restarts restarts the pool
+    gives up and every call raises PredictionWorkerError, callers then fall back to the prediction jars.
+    start() raises PredictionWorkerError when a new worker does not answer a ping.
+    '''
+    def __init__(self, command=WORKER_COMMANDS[DEFAULT_WORKER], size=1, timeout=DEFAULT_TIMEOUT, max_restarts=DEFAULT_MAX_RESTARTS):
+        self.command = command
+        self.size = size
+        self.timeout = timeout
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.workers = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return self
+            self.started = True
+        try:
+            for i in range(self.size):
+                worker = self._spawn()
+                if not worker.ping():
+                    raise PredictionWorkerError('{} does not answer, exit code {}'.format(' '.join(self.command), worker.process.poll()))
+                self.idle.put(worker)
+        except PredictionWorkerError:
+            self.close()
+            raise
+        return self
+
+    def _spawn(self):
+        worker = PredictionWorker(self.command, self.timeout)
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def _restart(self, worker):
+        with self.lock:
+            self.restarts += 1
+            if worker in self.workers:
+                self.workers.remove(worker)
+            restarts = self.restarts
+        # a worker that stopped answering is not asked to shut down
+        worker.close(kill=True)
+        if restarts > self.max_restarts:
+            raise PredictionWorkerError('gave up after {} restarts'.format(self.max_restarts))
+        print('prediction pool: restarting worker ({}/{})'.format(restarts, self.max_restarts))
+        return self._spawn()
+
+    @property
+    def broken(self):
+        return self.restarts > self.max_restarts
+
+    def predict(self, model_file, rows):
+        '''
+        labels and class probabilities of rows (dicts of feature values) for the model stored in model_file
+        '''
+        if self.broken:
+            raise PredictionWorkerError('gave up after {} restarts'.format(self.max_restarts))
+        self.start()
+        worker = self.idle.get()
+        try:
+            for attempt in range(2):
+                try:
+                    response = worker.request({'op': 'predict', 'model': model_file, 'rows': rows})
+                    return response['labels'], response['probabilities']
+                except PredictionWorkerError as e:
+                    print('prediction pool: {}'.format(e))
+                    worker = self._restart(worker)
+            raise PredictionWorkerError('no prediction after a restart')
+        finally:
+            self.idle.put(worker)
+
+    def health_check(self):
+        '''
+        pings the idle workers and restarts those that do not answer, returns the number of restarts
+        '''
+        restarted = 0
+        checked = []
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if not worker.alive() or not worker.ping():
+                try:
+                    worker = self._restart(worker)
+                    restarted += 1
+                except PredictionWorkerError as e:
+                    print('prediction pool: {}'.format(e))
+            checked.append(worker)
+        for worker in checked:
+            self.idle.put(worker)
+        return restarted
+
+    def close(self):
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = []
+        for worker in workers:
+            worker.close()
@@ -0,0 +1,84 @@
+'''
+python stand-in for the prediction server behind PredictionPool, it speaks the same line protocol.
+Every request and every response is one json object on one line:
+
+    {"id": 1, "op": "ping"}
+    {"id": 1, "ok": true}
+
+    {"id": 2, "op": "predict", "model": "/path/Logistic.model", "rows": [{"direct_distance": 1.0, ...}, ...]}
+    {"id": 2, "ok": true, "labels": ["safe", ...], "probabilities": [{"safe": 0.8, "unsafe": 0.2}, ...]}
+
+Failed requests are answered with {"id": .., "ok": false, "error": "message"}. Models are loaded once
+per file and loaded again when the file changes. The stand-in reads portable models (see portable_model),
+also the one exported next to a weka model file, and linear models stored as json, {"intercept": b, "weights": {"feature": w, ...}}, where the unsafe
+probability is the logistic function of the score.
+'''
+import json
+import math
+import os
+import sys
+from cps_sorter.services.portable_model import PortableModel, from_dict, is_portable_model, portable_model_file
+
+
+def load_model(model_file):
+    if not is_portable_model(model_file) and os.path.exists(portable_model_file(model_file)):
+        model_file = portable_model_file(model_file)
+    with open(model_file) as json_file:
+        data = json.load(json_file)
+    if 'type' in data:
+        return from_dict(data)
+    return data
+
+
+def score_model(model, rows):
+    if isinstance(model, PortableModel):
+        return model.predict_rows(rows)
+    labels = []
+    probabilities = []
+    for row in rows:
+        score = model['intercept'] + sum(weight * row[feature] for feature, weight in model['weights'].items())
+        unsafe = 1 / (1 + math.exp(-score)) if score > -500 else 0.0
+        labels.append('unsafe' if unsafe > 0.5 else 'safe')
+        probabilities.append({'safe': 1 - unsafe, 'unsafe': unsafe})
+    return labels, probabilities
+
+
+class ModelStore:
+    def __init__(self, loader=load_model):
+        self.loader = loader
+        self.models = {}
+
+    def get(self, model_file):
+        mtime = os.path.getmtime(model_file)
+        if model_file not in self.models or self.models[model_file][0] != mtime:
+            self.models[model_file] = (mtime, self.loader(model_file))
+        return self.models[model_file][1]
+
+
+def handle(request, models, scorer=score_model):
+    if request['op'] == 'ping':
+        return {'ok': True}
+    if request['op'] == 'predict':
+        labels, probabilities = scorer(models.get(request['model']), request['rows'])
+        return {'ok': True, 'labels': labels, 'probabilities': probabilities}
+    raise ValueError('unknown op {}'.format(request['op']))
+
+
+def serve(infile, outfile, loader=load_model, scorer=score_model):
+    models = ModelStore(loader)
+    for line in infile:
+        if not line.strip():
+            continue
+        request = {}
+        try:
+            request = json.loads(line)
+            response = handle(request, models, scorer)
+        except Exception as e:
+            response = {'ok': False, 'error': '{}'.format(e) or type(e).__name__}
+        response['id'] = request.get('id')
+        outfile.write(json.dumps(response) + '\n')
+        outfile.flush()
+
+
+if __name__ == '__main__':
+    serve(sys.stdin, sys.stdout)
@@ -1,6 +1,13 @@
 import datetime
 from cps_sorter.services.weka_helper import WekaHelper
 from cps_sorter.services.road_transformer import RoadTransformer
+from cps_sorter.services.batch_pipeline import PredictionPipeline, SequentialBatches
+from cps_sorter.services.simulator_pool import SimulatorPool
+from cps_sorter.services.generation_service import GenerationService
+from cps_sorter.services.retraining_policy import FixedRetraining
+from cps_sorter.services.test_prioritizer import CostAwarePrioritizer
+from cps_sorter.services.active_learning import ActiveSelector, DEFAULT_TARGET_PRECISION
+from cps_sorter.services.novelty_filter import NoveltyFilter
 from asfault import config, experiments
 from asfault.beamer import *
 from asfault.network import *
@@ -10,6 +17,7 @@ from asfault.plotter import *
 from deap import base, creator, tools
 from subprocess import Popen
 import tempfile
+import random
 import csv
 import pandas as pd
 import numpy as np
@@ -33,9 +41,20 @@ def setup_logging(log_file):
     l.info('Started the logging framework writing to file: %s', log_file)
 
 
+def make_test_factory(seed):
+    '''
+    the RoadTestFactory of a generation worker process, seeded independently of the other workers
+    '''
+    ensure_environment(DEFAULT_ENV)
+    generate_factories()
+    random.seed(seed)
+    np.random.seed(seed)
+    return RoadTestFactory(config.ev.bounds)
+
+
 
 class RealTimeExperimentRunner:
-    def __init__(self, temp_dir=None, weka_helper=None, output_dir=None):
+    def __init__(self, temp_dir=None, weka_helper=None, output_dir=None, simulators=None, runner_factory_builder=None):
         setup_logging(DEFAULT_LOG)
         ensure_environment(DEFAULT_ENV)
         generate_factories()
@@ -47,9 +66,14 @@ class RealTimeExperimentRunner:
         self.test_dir = os.mkdir(os.path.join(self.temp_dir.name, 'test_files'))
         self.weka_helper = weka_helper
         self.road_transformer = RoadTransformer()
-        self.runner_factory = gen_beamng_runner_factory(config.ex.get_level_dir(), config.ex.host, config.ex.port, plot=False)
-
-    def run_experiment(self, time_budget, weka_model, bulk_size=10, init_data='', adaptive=True):
+        if not simulators:
+            simulators = [(config.ex.host, config.ex.port)]
+        if not runner_factory_builder:
+            runner_factory_builder = lambda host, port: gen_beamng_runner_factory(config.ex.get_level_dir(), host, port, plot=False)
+        self.simulators = SimulatorPool(simulators, runner_factory_builder)
+
+    def run_experiment(self, time_budget, weka_model, bulk_size=10, init_data='', adaptive=True, pipeline=False, generation_workers=0, precompute_features=True, retraining_policy=None, prioritize=False, candidate_pool=10,
+        active_learning=0.0, target_precision=DEFAULT_TARGET_PRECISION, novelty_radius=0.0):
         results = {
             'generated_tests': 0,
             'tested_files': 0,
@@ -64,18 +88,44 @@ class RealTimeExperimentRunner:
             'time_unsafe_test_run':0,
             'building_model': 0,
             'init_data_time': 0,
+            'explored_tests': 0,
+            'explored_unsafe': 0,
+            'reused_unsafe': 0,
+            'reused_safe': 0,
             'parameters': {
                 'time_budget': '{} mins'.format(time_budget),
                 'weka_model': weka_model,
                 'bulk_size': bulk_size,
-                'init_data': init_data
+                'init_data': init_data,
+                'pipeline': pipeline,
+                'generation_workers': generation_workers,
+                'prioritize': prioritize,
+                'candidate_pool': candidate_pool,
+                'active_learning': active_learning,
+                'target_precision': target_precision,
+                'novelty_radius': novelty_radius
             }
         }
+        # with a novelty radius, tests close to a simulated test get its outcome instead of a simulation
+        novelty = NoveltyFilter(novelty_radius) if novelty_radius else None
+        # with active learning a share of the simulator time goes to uncertain or unusual tests predicted as safe
+        selector = ActiveSelector(active_learning) if adaptive and active_learning else None
+        simulations = 0
+        results['simulations_to_target_precision'] = None
+        # with prioritize the candidates predicted as unsafe are simulated in the order of unsafe findings per simulator second
+        prioritizer = CostAwarePrioritizer(pool_size=candidate_pool) if prioritize else None
+        if retraining_policy is None:
+            retraining_policy = FixedRetraining()
+        results['parameters']['retraining_policy'] = type(retraining_policy).__name__
         init_start_time = datetime.datetime.now()
         self.log_file = open('{}/log_file.txt'.format(self.output_dir), 'w')
         counter = 0
         rounds = []
         test_factory = RoadTestFactory(config.ev.bounds)
+        if generation_workers:
+            # the roads are generated in worker processes, with their features when precompute_features is set
+            features = self.road_transformer.extract_features_for_road_test if precompute_features else None
+            test_factory = GenerationService(make_test_factory, RoadTest.to_dict, RoadTest.from_dict, generation_workers, features=features).start()
         start_time = datetime.datetime.now()
         self.log_file.write('Start Time: {} \n'.format(start_time))
         print('Start time: {}'.format(start_time))
@@ -83,6 +133,9 @@ class RealTimeExperimentRunner:
             self.training_file = '{}/trainings_file.csv'.format(self.output_dir)
             init_tests = self.generate_init_data(3*bulk_size, test_factory)
             self.road_transformer.transform_tests_to_training_data(init_tests, self.training_file, True)
+            if novelty:
+                for row, test in zip(self.road_transformer.tests_to_training_rows(init_tests), init_tests):
+                    novelty.add(row, row['safety'] == 'unsafe', (test.execution.end_time - test.execution.start_time).total_seconds())
             for test in init_tests:
                 with open('{}/test_{}.json'.format(self.output_dir, counter), 'w') as out:
                     out.write(json.dumps(RoadTest.to_dict(test), sort_keys=True, indent=4))
@@ -94,6 +147,12 @@ class RealTimeExperimentRunner:
             self.weka_helper.build_models(self.training_file, self.output_dir, [weka_model])
 
         end_time = datetime.datetime.now() + datetime.timedelta(minutes=time_budget)
+        generate = lambda: self.generate_test_cases(test_factory, bulk_size)
+        predict = lambda to_predict, tests: self.weka_helper.make_bulk_predictions_with_probabilities(weka_model, to_predict, len(tests))
+        # with the pipeline the next batches are generated and predicted while the current one is simulated
+        batches = PredictionPipeline(generate, predict) if pipeline else SequentialBatches(generate, predict)
+        batches.start()
+        loop_start = datetime.datetime.now()
         
         while datetime.datetime.now() < end_time:
             round = {
@@ -103,46 +162,118 @@ class RealTimeExperimentRunner:
                 'num_unsafe': 0,
                 'false_positive': 0,
                 'true_positive': 0,
+                'explored': 0,
+                'explored_unsafe': 0,
+                'reused': 0,
             }
             new_tests = []
-            while len(new_tests) < 20:
+            # the round ends when the retraining policy asks for a new model
+            reason = None
+            while not reason:
                 if datetime.datetime.now() > end_time:
                         break
-                start_generating = datetime.datetime.now()
-                to_predict, test_cases = self.generate_test_cases(test_factory, bulk_size)
                 end_time_generating = datetime.datetime.now()
-                results['time_test_generation'] += (end_time_generating - start_generating).total_seconds()
-                predictions = self.weka_helper.make_bulk_predictions(weka_model, to_predict, bulk_size)
+                batch = batches.get(end_time)
+                if batch is None:
+                    break
+                group = [batch]
+                # with several simulators, batches are taken until every simulator has a test predicted as unsafe,
+                # with prioritize until the pool of candidates is full
+                needed = prioritizer.needed() if prioritizer else self.simulators.size
+                while (prioritizer or self.simulators.size > 1) and sum(prediction == 'unsafe' for batch in group for prediction in batch.predictions) < needed:
+                    batch = batches.get(end_time)
+                    if batch is None:
+                        break
+                    group.append(batch)
+                test_cases = [test for batch in group for test in batch.tests]
+                predictions = [prediction for batch in group for prediction in batch.predictions]
+                probabilities = [probability for batch in group for probability in (batch.probabilities or [None] * len(batch.tests))]
+                feature_rows = [None] * len(test_cases)
+                if prioritizer or selector or novelty:
+                    feature_rows = [row for batch in group for row in self.road_transformer.read_test_bulk(batch.to_predict)[:len(batch.tests)]]
+                if prioritizer:
+                    test_cases, predictions, probabilities, feature_rows = prioritizer.select(test_cases, predictions, probabilities, feature_rows, self.simulators.size)
+                explore = None
+                if selector and selector.due():
+                    explore = selector.pick(predictions, probabilities, feature_rows)
                 end_prediction = datetime.datetime.now()
-                results['time_predictions'] += (end_prediction - end_time_generating).total_seconds()
-                results['generated_tests'] += bulk_size
+                for batch in group:
+                    results['time_test_generation'] += batch.time_generation
+                    results['time_predictions'] += batch.time_prediction
+                results['generated_tests'] += sum(len(batch.tests) for batch in group)
+                reused = {}
+                if novelty:
+                    for c, prediction in enumerate(predictions):
+                        if prediction == 'unsafe' or c == explore:
+                            known = novelty.lookup(feature_rows[c])
+                            if known:
+                                reused[c] = known
+                executions = {c: self.simulators.submit(test_cases[c]) for c, prediction in enumerate(predictions) if (prediction == 'unsafe' or c == explore) and c not in reused}
                 for c, prediction in enumerate(predictions):
                     if datetime.datetime.now() > end_time:
                         break
                     if prediction == 'unsafe':
-                        results['tested_files'] += 1
                         round['num_unsafe_pred'] += 1
-                        test_cases[c].execution = self.run_test(test_cases[c])
-                        new_tests.append(test_cases[c])
-                        results['time_test_run'] += (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds()
-                        res = self.evaluate_test_case(test_cases[c])
+                        if c in reused:
+                            # a near duplicate of a simulated test gets its outcome, it is neither simulated nor trained on
+                            res = self.reuse_outcome(reused[c], round, results)
+                        else:
+                            results['tested_files'] += 1
+                            test_cases[c].execution = executions[c].result()
+                            new_tests.append(test_cases[c])
+                            results['time_test_run'] += (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds()
+                            simulations += 1
+                            if prioritizer:
+                                prioritizer.observe(feature_rows[c], (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds())
+                            if selector:
+                                selector.observe(feature_rows[c], (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds(), False)
+                            res = self.evaluate_test_case(test_cases[c])
+                            if novelty:
+                                novelty.add(feature_rows[c], res == 'unsafe', (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds())
                         if res == 'safe':
                             round['num_safe'] += 1
                             round['false_positive'] += 1
-                            results['safe_cases'] += 1
-                            results['time_safe_test_run'] += (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds()
-                            self.log_file.write('{}: Mistaken Safe Test Case for Unsafe num: {} \n'.format(datetime.datetime.now(), results['safe_cases']))
+                            if c not in reused:
+                                results['safe_cases'] += 1
+                                results['time_safe_test_run'] += (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds()
+                                self.log_file.write('{}: Mistaken Safe Test Case for Unsafe num: {} \n'.format(datetime.datetime.now(), results['safe_cases']))
                         elif res == 'unsafe':
                             round['num_unsafe'] += 1
                             round['true_positive'] += 1
-                            results['unsafe_cases'] += 1
-                            results['time_unsafe_test_run'] += (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds()
-                            self.log_file.write('{}: Found Unsafe Test Case num: {} \n'.format(datetime.datetime.now(), results['unsafe_cases']))
+                            if c not in reused:
+                                results['unsafe_cases'] += 1
+                                results['time_unsafe_test_run'] += (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds()
+                                self.log_file.write('{}: Found Unsafe Test Case num: {} \n'.format(datetime.datetime.now(), results['unsafe_cases']))
+                        retraining_policy.observe(prediction, probabilities[c], res == 'unsafe')
+                        reason = reason or retraining_policy.should_retrain()
                         results['time_test_evaluation'] = (end_prediction - end_time_generating).total_seconds()
                         print('Generated: {} files'.format(results['tested_files']))
                     else:
                         results['predicated_as_safe'] += 1
                         round['num_safe_pred'] += 1
+                        if c == explore and c in reused:
+                            res = self.reuse_outcome(reused[c], round, results)
+                            round['explored'] += 1
+                            round['explored_unsafe'] += int(res == 'unsafe')
+                            retraining_policy.observe(prediction, probabilities[c], res == 'unsafe')
+                            reason = reason or retraining_policy.should_retrain()
+                        elif c == explore:
+                            # simulated for active learning although predicted as safe, an unsafe result is a missed unsafe test
+                            test_cases[c].execution = executions[c].result()
+                            new_tests.append(test_cases[c])
+                            simulations += 1
+                            results['time_test_run'] += (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds()
+                            selector.observe(feature_rows[c], (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds(), True)
+                            res = self.evaluate_test_case(test_cases[c])
+                            if novelty:
+                                novelty.add(feature_rows[c], res == 'unsafe', (test_cases[c].execution.end_time - test_cases[c].execution.start_time).total_seconds())
+                            results['explored_tests'] += 1
+                            round['explored'] += 1
+                            if res == 'unsafe':
+                                results['explored_unsafe'] += 1
+                                round['explored_unsafe'] += 1
+                            retraining_policy.observe(prediction, probabilities[c], res == 'unsafe')
+                            reason = reason or retraining_policy.should_retrain()
                     end_evaluation = datetime.datetime.now()
                     results['time_test_evaluation'] = (end_evaluation-end_prediction).total_seconds()
                     with open('{}/test_{}.json'.format(self.output_dir, counter), 'w') as out:
@@ -153,26 +284,75 @@ class RealTimeExperimentRunner:
                         elapsed_time = datetime.datetime.now() - start_time
                         print("::::::::::::Elapsed Time::::::::: {}".format(str(datetime.timedelta(seconds=elapsed_time.total_seconds()))))
                         print("Tempresult: {}".format(results))
+                # tests not started before the time budget ran out are dropped
+                for execution in executions.values():
+                    execution.cancel()
+            if not (round['num_safe_pred'] or round['num_unsafe_pred']):
+                # the time budget ran out before a test of the round was processed
+                break
             if adaptive:
                 start_building_time = datetime.datetime.now()
-                self.road_transformer.transform_tests_to_training_data(new_tests, self.training_file, False)
-                self.weka_helper.rebuild_models(self.training_file, self.output_dir, [weka_model])
-                results['building_model'] += (datetime.datetime.now() - start_building_time).total_seconds()
-            round['unsafe_precision'] =  round['true_positive'] / round['num_unsafe_pred']
+                rows = self.road_transformer.tests_to_training_rows(new_tests)
+                self.road_transformer.write_training_rows(rows, self.training_file, False)
+                with batches.updating_model():
+                    self.weka_helper.update_models(self.training_file, self.output_dir, [weka_model], rows)
+                if prioritizer:
+                    # the candidates waiting in the pool were predicted by the old model
+                    prioritizer.clear()
+                round['building_time'] = (datetime.datetime.now() - start_building_time).total_seconds()
+                results['building_model'] += round['building_time']
+                retraining_policy.retrained(reason or 'end', round['building_time'])
+                self.log_file.write('{}: Retrained ({}) in {}s \n'.format(datetime.datetime.now(), reason or 'end', round['building_time']))
+            else:
+                retraining_policy.reset()
+            round['unsafe_precision'] = round['true_positive'] / round['num_unsafe_pred'] if round['num_unsafe_pred'] else None
+            # learning curve: the precision after this many simulations, the miss rate among the explored tests
+            round['simulations'] = simulations
+            round['explored_miss_rate'] = round['explored_unsafe'] / round['explored'] if round['explored'] else None
+            if results['simulations_to_target_precision'] is None and round['unsafe_precision'] is not None and round['unsafe_precision'] >= target_precision:
+                results['simulations_to_target_precision'] = simulations
             rounds.append(round)
             print("Round: {}".format(round))
-            self.log_file.write('{}: Testprediction: {} \n'.format(datetime.datetime.now(), round['true_positive']/round['num_unsafe_pred']))
+            self.log_file.write('{}: Testprediction: {} \n'.format(datetime.datetime.now(), round['unsafe_precision']))
+        batches.stop()
+        if generation_workers:
+            test_factory.stop()
+        results['time_waiting_for_tests'] = batches.time_waiting
+        # share of the time budget the simulators were busy
+        results['simulator_utilization'] = results['time_test_run'] / max((datetime.datetime.now() - loop_start).total_seconds() * self.simulators.size, 1e-9)
+        results['simulators'] = self.simulators.stats()
         results['rounds'] = rounds
+        if prioritizer:
+            results['prioritizer'] = prioritizer.stats()
+        if selector:
+            results['active_learning'] = selector.stats()
+        if novelty:
+            results['novelty_filter'] = novelty.stats()
+        results['retrain_events'] = retraining_policy.events
+        # the loop runs until the time budget is spent, so the time not spent retraining went into simulation
+        results['retraining_time_saved'] = retraining_policy.time_saved()
         return results
 
 
 
+    def reuse_outcome(self, known, round, results):
+        '''
+        counts the outcome (unsafe, seconds) of the simulated near duplicate of a test for the test, returns it as the result
+        '''
+        unsafe, seconds = known
+        res = 'unsafe' if unsafe else 'safe'
+        round['reused'] += 1
+        results['reused_{}'.format(res)] += 1
+        self.log_file.write('{}: Reused {} Outcome of a Near Duplicate num: {} \n'.format(datetime.datetime.now(), res.capitalize(), round['reused']))
+        return res
+
     def generate_init_data(self, bulk_size, factory):
         tests = []
         while len(tests) < bulk_size:
-            test = factory.generate_random_test()
-            test.execution = self.run_test(test)
-            tests.append(test)
+            tests.append(factory.generate_random_test())
+        executions = [self.simulators.submit(test) for test in tests]
+        for test, execution in zip(tests, executions):
+            test.execution = execution.result()
         return tests
 
     # def generate_tests(self, time_budget, weka_model, bulk_size=1):
@@ -251,6 +431,11 @@ class RealTimeExperimentRunner:
 
                 
     def generate_test_cases(self, factory, bulk_size=1):
+        if isinstance(factory, GenerationService):
+            tests, rows = factory.get_batch(bulk_size)
+            if rows and all(row is not None for row in rows):
+                return self.road_transformer.convert_features_to_test_bulk(rows), tests
+            return self.road_transformer.convert_to_test_bulk(tests), tests
         tests = []
         while len(tests) < bulk_size:
             test = factory.generate_random_test()
@@ -274,19 +459,8 @@ class RealTimeExperimentRunner:
 
 
     def run_test(self, test):
-        while True:
-            # Test Runner is bound to the test. We need to configure the factory to return a new instance of a runner
-            # configured to use the available BeamNG
-            runner = self.runner_factory(test)
-            try:
-                execution = runner.run()
-                return execution
-            except Exception as e:
-                l.error('Error running test %s', test)
-                l.exception(e)
-                sleep(30.0)
-            finally:
-                runner.close()
+        # Test Runner is bound to the test, the pool makes a runner for the first free BeamNG that is healthy
+        return self.simulators.run(test)
 
     def write_result_to(self, result, output):
         with open('{}/results.json'.format(output), 'w') as outfile:
@@ -0,0 +1,135 @@
+import collections
+import datetime
+
+DEFAULT_ROUND_SIZE = 20
+DEFAULT_DRIFT_THRESHOLD = 0.25
+DEFAULT_MAX_STALENESS = 200
+DEFAULT_MIN_TESTS = 50
+RETRAIN_POLICIES = ['fixed', 'drift']
+
+
+def precision(window):
+    '''
+    share of the tests predicted as unsafe that were unsafe, None without such tests
+    '''
+    predicted = [unsafe for prediction, probability, unsafe in window if prediction == 'unsafe']
+    if not predicted:
+        return None
+    return sum(predicted) / len(predicted)
+
+
+def calibration_gap(window):
+    '''
+    distance between the mean predicted unsafe probability and the observed unsafe rate, None without probabilities
+    '''
+    known = [(probability, unsafe) for prediction, probability, unsafe in window if probability is not None]
+    if not known:
+        return None
+    return abs(sum(probability for probability, unsafe in known) / len(known) - sum(unsafe for probability, unsafe in known) / len(known))
+
+
+class FixedRetraining:
+    '''
+    retrains after every round_size simulated tests, the schedule of the original experiments
+    '''
+    def __init__(self, round_size=DEFAULT_ROUND_SIZE):
+        self.round_size = round_size
+        self.observed = 0
+        self.since_retrain = 0
+        self.events = []
+
+    def observe(self, prediction, probability, unsafe):
+        self.observed += 1
+        self.since_retrain += 1
+
+    def should_retrain(self):
+        if self.since_retrain >= self.round_size:
+            return 'round'
+        return None
+
+    def _event(self, reason, cost):
+        return {'tests': self.observed, 'since_retrain': self.since_retrain, 'reason': reason, 'cost': cost,
+            'time': str(datetime.datetime.now())}
+
+    def reset(self):
+        '''
+        starts the next round without retraining
+        '''
+        self.since_retrain = 0
+
+    def retrained(self, reason, cost):
+        self.events.append(self._event(reason, cost))
+        self.reset()
+
+    def time_saved(self):
+        '''
+        estimated retraining time saved against retraining after every round_size tests
+        '''
+        if not self.events:
+            return 0.0
+        mean_cost = sum(event['cost'] for event in self.events) / len(self.events)
+        return max(0, self.observed // self.round_size - len(self.events)) * mean_cost
+
+
+class DriftRetraining(FixedRetraining):
+    '''
+    retrains when the model drifted or got stale. After every retraining the first window simulated tests are the
+    reference, afterwards the precision and the calibration gap of the last window tests are compared with it.
+    The drift is the larger of both differences, a retraining is due when it reaches threshold (and at least
+    min_tests were simulated since the last retraining) or after max_staleness tests. The window defaults to
+    half of min_tests, so that the drift is known once min_tests tests were simulated
+    '''
+    def __init__(self, window=None, threshold=DEFAULT_DRIFT_THRESHOLD, max_staleness=DEFAULT_MAX_STALENESS, min_tests=DEFAULT_MIN_TESTS):
+        FixedRetraining.__init__(self)
+        if window is None:
+            window = max(1, min_tests // 2)
+        self.window = window
+        self.threshold = threshold
+        self.max_staleness = max_staleness
+        self.min_tests = min_tests
+        self.reference = []
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, prediction, probability, unsafe):
+        FixedRetraining.observe(self, prediction, probability, unsafe)
+        if len(self.reference) < self.window:
+            self.reference.append((prediction, probability, unsafe))
+        else:
+            self.recent.append((prediction, probability, unsafe))
+
+    def drift(self):
+        if len(self.recent) < self.window:
+            return 0.0
+        differences = [0.0]
+        for statistic in (precision, calibration_gap):
+            reference, recent = statistic(self.reference), statistic(self.recent)
+            if reference is not None and recent is not None:
+                differences.append(abs(recent - reference))
+        return max(differences)
+
+    def should_retrain(self):
+        if self.max_staleness and self.since_retrain >= self.max_staleness:
+            return 'staleness'
+        if self.since_retrain >= self.min_tests and self.drift() >= self.threshold:
+            return 'drift'
+        return None
+
+    def _event(self, reason, cost):
+        event = FixedRetraining._event(self, reason, cost)
+        event['drift'] = self.drift()
+        event['precision'] = precision(self.recent or self.reference)
+        event['calibration_gap'] = calibration_gap(self.recent or self.reference)
+        return event
+
+    def reset(self):
+        FixedRetraining.reset(self)
+        self.reference = []
+        self.recent.clear()
+
+
+def make_retraining_policy(name, threshold=DEFAULT_DRIFT_THRESHOLD, max_staleness=DEFAULT_MAX_STALENESS, min_tests=DEFAULT_MIN_TESTS):
+    if name == 'fixed':
+        return FixedRetraining()
+    if name == 'drift':
+        return DriftRetraining(threshold=threshold, max_staleness=max_staleness, min_tests=min_tests)
+    raise ValueError('unknown retraining policy {}, use one of {}'.format(name, ', '.join(RETRAIN_POLICIES)))
@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
 import cps_sorter.services.utility as utility
+from cps_sorter.services.dataset_builder import DatasetBuilder, DEFAULT_CHUNK_SIZE
+from cps_sorter.services.columnar_dataset import ColumnarDataset, is_columnar
 import tempfile
 import csv
 import json
@@ -9,6 +11,33 @@ from asfault.tests import RoadTest
 import random
 from scipy.spatial.distance import directed_hausdorff
 
+FULLROAD_FEATURES = ['direct_distance', 'road_distance', 'num_l_turns','num_r_turns','num_straights','median_angle','total_angle','mean_angle','std_angle',
+    'max_angle','min_angle','median_pivot_off','mean_pivot_off','std_pivot_off','max_pivot_off','min_pivot_off']
+COUNT_FEATURES = ['num_l_turns', 'num_r_turns', 'num_straights']
+SEGMENT_FEATURES = ['is_start_seg', 'is_last_seg','prev_is_right_turn', 'prev_is_left_turn', 'prev_is_straight', 'prev_angles', 'prev_pivot_off', 'prev_actual_length','prev_direct_length', 'prev_directed_hausdorff',
+    'seg_is_right_turn', 'seg_is_left_turn', 'seg_is_straight','seg_angles', 'seg_pivot_off', 'seg_actual_length','seg_direct_length',
+    'next_is_right_turn', 'next_is_left_turn', 'next_is_straight', 'next_angles', 'next_pivot_off', 'next_actual_length','next_direct_length', 'next_directed_hausdorff']
+MISSING_SEGMENT_FEATURE = {
+    'angles': -1,
+    'is_right_turn': 0,
+    'is_left_turn': 0,
+    'is_straight': 0,
+    'pivot_off': -1,
+    'actual_length': -1,
+    'direct_length': -1,
+    'directed_hausdorff': -1
+}
+FEATURESET_COLUMNS = {
+    'fullroad': [(name, np.int64 if name in COUNT_FEATURES else np.float64) for name in FULLROAD_FEATURES],
+    'roadsegment': [(name, np.int64 if name.startswith('is_') or '_is_' in name else np.float64) for name in SEGMENT_FEATURES]
+}
+SEGMENT_ATTRIBUTES = ('roadtype', 'angle', 'pivot_off', 'x', 'y')
+ROADTYPE_CODES = {
+    'straight': 0,
+    'l_turn': 1,
+    'r_turn': 2
+}
+
 
 class Point:
     def __init__(self,x_init,y_init):
@@ -30,7 +59,140 @@ class Point:
 
     def __ne__(self, other):
         return not self.__eq__(other)
+
+
+class RoadBatch:
+    '''
+    path nodes of many roads packed into flat arrays, road i owns the nodes offsets[i]:offsets[i+1]
+    '''
+    def __init__(self, roadtypes, angles, pivot_offs, xs, ys, offsets):
+        self.roadtypes = roadtypes
+        self.angles = angles
+        self.pivot_offs = pivot_offs
+        self.xs = xs
+        self.ys = ys
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_tests(cls, tests):
+        roadtypes = []
+        angles = []
+        pivot_offs = []
+        xs = []
+        ys = []
+        counts = []
+        for data in tests:
+            nodes = data['network']['nodes']
+            segs = [nodes[str(seg_id)] for seg_id in data['path']]
+            roadtypes.extend([ROADTYPE_CODES.get(seg['roadtype'], -1) for seg in segs])
+            angles.extend([seg['angle'] for seg in segs])
+            pivot_offs.extend([seg['pivot_off'] for seg in segs])
+            xs.extend([seg['x'] for seg in segs])
+            ys.extend([seg['y'] for seg in segs])
+            counts.append(len(segs))
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(np.array(roadtypes, dtype=np.int8), np.array(angles, dtype=np.float64), np.array(pivot_offs, dtype=np.float64),
+            np.array(xs, dtype=np.float64), np.array(ys, dtype=np.float64), offsets)
+
+
+def segmented_stats(values, counts):
+    '''
+    median, sum, mean, std, max and min of every segment of a flat array, NaN for empty segments.
+    Segments of equal length are reduced together along rows so each value matches the
+    corresponding np.median/np.sum/... call on the segment alone bit for bit.
+    '''
+    stats = np.full((6, len(counts)), np.nan)
+    starts = np.cumsum(counts) - counts
+    for length in np.unique(counts):
+        if length == 0:
+            continue
+        rows = np.flatnonzero(counts == length)
+        block = values[starts[rows, None] + np.arange(length)]
+        stats[0, rows] = np.median(block, axis=1)
+        stats[1, rows] = np.sum(block, axis=1)
+        stats[2, rows] = np.mean(block, axis=1)
+        stats[3, rows] = np.std(block, axis=1)
+        stats[4, rows] = np.max(block, axis=1)
+        stats[5, rows] = np.min(block, axis=1)
+    return stats
+
+
+def polyline_length(points):
+    return np.sum(np.hypot(np.diff(points[:, 0]), np.diff(points[:, 1])))
+
+
+def lane_edges(segment):
+    l_edge = np.array([(p[0], p[1]) for p in segment['l_lanes'][0]['l_edge']], dtype=np.float64)
+    r_edge = np.array([(p[0], p[1]) for p in segment['r_lanes'][0]['r_edge']], dtype=np.float64)
+    return l_edge, r_edge
+
+
+def batched_directed_hausdorff(sources, targets):
+    '''
+    directed_hausdorff(sources[i], targets[i])[0] for every pair, computed in one padded pass
+    '''
+    num_pairs = len(sources)
+    if not num_pairs:
+        return np.empty(0)
+    source_size = max(len(source) for source in sources)
+    target_size = max(len(target) for target in targets)
+    padded_sources = np.zeros((num_pairs, source_size, 2))
+    padded_targets = np.full((num_pairs, target_size, 2), np.inf)
+    source_valid = np.zeros((num_pairs, source_size), dtype=bool)
+    for i, (source, target) in enumerate(zip(sources, targets)):
+        padded_sources[i, :len(source)] = source
+        padded_targets[i, :len(target)] = target
+        source_valid[i, :len(source)] = True
+    deltas = padded_sources[:, :, None, :] - padded_targets[:, None, :, :]
+    nearest = np.min(np.sum(deltas * deltas, axis=3), axis=2)
+    nearest[~source_valid] = -np.inf
+    return np.sqrt(np.max(nearest, axis=1))
+
+
+class RoadSegment:
+    '''
+    the attributes of a live path node that the fullroad features read, indexable like the node dicts of RoadTest.to_dict
+    '''
+    __slots__ = SEGMENT_ATTRIBUTES
+
+    def __init__(self, node):
+        for attribute in SEGMENT_ATTRIBUTES:
+            setattr(self, attribute, getattr(node, attribute))
+
+    def __getitem__(self, attribute):
+        return getattr(self, attribute)
+
+
+def road_test_segments(test):
+    '''
+    the path nodes of a live RoadTest as RoadSegments, None when the path or its nodes do not carry the attributes
+    '''
+    path = getattr(test, 'path', None)
+    if not path:
+        return None
+    network = getattr(test, 'network', None)
+    segs = []
+    try:
+        for node in path:
+            if not hasattr(node, 'roadtype'):
+                # a path of segment ids
+                node = network.nodes[node]
+            seg = RoadSegment(node)
+            if not isinstance(seg.roadtype, str):
+                return None
+            segs.append(seg)
+    except (AttributeError, KeyError, TypeError):
+        return None
+    return segs
+
+
 class RoadTransformer:
+    def __init__(self, feature_cache=None):
+        self.feature_cache = feature_cache
 
     label_map = {
         'unsafe': 0,
@@ -65,6 +227,37 @@ class RoadTransformer:
 
 
     def convert_to_test_bulk(self, tests, exclude_features=[]):
+        return self._write_test_bulk([self.extract_features_for_road_test(test, exclude_features) for test in tests], exclude_features)
+
+    def convert_features_to_test_bulk(self, features_list):
+        '''
+        one prediction file for feature rows that were extracted before, e.g. by the generation workers
+        '''
+        return self._write_test_bulk(features_list)
+
+    def read_test_bulk(self, to_test):
+        '''
+        the feature rows of a prediction file, without the safety
+        '''
+        with open(to_test, newline='') as csv_file:
+            return [{feature: float(value) for feature, value in row.items() if feature != 'safety'} for row in csv.DictReader(csv_file)]
+
+    def convert_files_to_test_bulk(self, file_paths):
+        '''
+        one prediction file for many scenario files, the features go through the DatasetBuilder and its feature cache.
+        Returns the file and the scenario files it has rows for, in row order
+        '''
+        features = []
+        converted = []
+        for file_path, rows, error in DatasetBuilder(self).iter_rows(file_paths, 'fullroad'):
+            if error or not rows:
+                print('{}: {}'.format(file_path, error or 'no execution'))
+                continue
+            features.append({feature: rows[0][feature] for feature in FULLROAD_FEATURES})
+            converted.append(file_path)
+        return self._write_test_bulk(features), converted
+
+    def _write_test_bulk(self, features_list, exclude_features=[]):
         to_test = tempfile.NamedTemporaryFile(delete=False)
         fieldnames = ['direct_distance', 'road_distance', 'num_l_turns','num_r_turns','num_straights','median_angle','total_angle','mean_angle','std_angle',
         'max_angle','min_angle','median_pivot_off','mean_pivot_off','std_pivot_off','max_pivot_off','min_pivot_off', 'safety']
@@ -75,9 +268,9 @@ class RoadTransformer:
             writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
             writer.writeheader()
             counter = 0
-            for test in tests:       
-                features = self.extract_features_for_test_case(RoadTest.to_dict(test), False, exclude_features)
-                if len(tests) == 1:
+            # weka needs both class values in the file, the labels of the rows are not used for the prediction
+            for features in features_list:
+                if len(features_list) == 1:
                     features['safety'] = 'safe'
                     writer.writerow(features)
                     features['safety'] = 'unsafe'
@@ -102,30 +295,69 @@ class RoadTransformer:
 
     def extract_features_for_test_case(self, test, is_file=False, exclude_features=[]):
         try:
-            if is_file:
-                with open(test) as json_file:
-                    test = json.load(json_file)
-            features = self.extract_features(test)
+            if is_file and self.feature_cache:
+                features = self._cached_features(test)
+            else:
+                if is_file:
+                    with open(test) as json_file:
+                        test = json.load(json_file)
+                features = self.extract_features(test)
             for f in exclude_features:
                 features.pop(f, None)        
             return features
         except Exception as e:
                 print(e)
 
+    def _cached_features(self, test_file):
+        content_hash = self.feature_cache.key(test_file)
+        entry = self.feature_cache.get(content_hash, 'fullroad')
+        if entry is None:
+            with open(test_file) as json_file:
+                row = self.extract_training_rows([json.load(json_file)])[0]
+            if isinstance(row, Exception):
+                raise row
+            entry = row
+            self.feature_cache.put(content_hash, 'fullroad', entry)
+        elif 'error' in entry:
+            raise ValueError(entry['error'])
+        return {feature: entry[feature] for feature in FULLROAD_FEATURES}
+
     def extract_features(self, data):
+        nodes = data['network']['nodes']
+        return self._path_features([nodes[str(seg_id)] for seg_id in data['path']])
+
+    def extract_road_test_features(self, test):
+        '''
+        the features of a live RoadTest, read from its path nodes without serializing the network.
+        Tests whose nodes do not carry the attributes go through RoadTest.to_dict
+        '''
+        segs = road_test_segments(test)
+        if segs is None:
+            return self.extract_features(RoadTest.to_dict(test))
+        return self._path_features(segs)
+
+    def extract_features_for_road_test(self, test, exclude_features=[]):
+        try:
+            features = self.extract_road_test_features(test)
+            for f in exclude_features:
+                features.pop(f, None)
+            return features
+        except Exception as e:
+                print(e)
+
+    def _path_features(self, segs):
+        '''
+        segs are the path nodes in path order, dicts or RoadSegments with roadtype, angle, pivot_off, x and y
+        '''
         angles = []
-        path = data['path']
-        path_used = []
         road_distance = 0
         pivot_offs = []
-        points = {}
+        points = []
         l_turns = 0
         r_turns = 0
         straight = 0
-        road_distance = 0
 
-        for seg_id in path:
-            seg = data['network']['nodes'][str(seg_id)]
+        for seg in segs:
             if seg['roadtype'] == 'r_turn':
                 r_turns += 1
             elif seg['roadtype'] == 'l_turn':
@@ -133,15 +365,15 @@ class RoadTransformer:
             elif seg['roadtype'] == 'straight':
                 straight += 1
 
-            if seg['angle'] < 0:
-                seg['angle'] += 360
-            if seg['angle'] > 0:
-                angles.append(seg['angle'])
+            angle = seg['angle']
+            if angle < 0:
+                angle += 360
+            if angle > 0:
+                angles.append(angle)
             if seg['pivot_off'] > 0:
                 pivot_offs.append(seg['pivot_off'])
 
-            points[seg_id] = utility.Point(seg['x'], seg['y'])
-            path_used.append(seg_id)
+            points.append(utility.Point(seg['x'], seg['y']))
 
         if not angles:
             pivot_offs.append(0)
@@ -149,9 +381,9 @@ class RoadTransformer:
         if not pivot_offs:
             pivot_offs.append(0)   
 
-        for i in range(0, len(path_used)-1):
-            road_distance += utility.get_distance(points[path_used[i]], points[path_used[i+1]])
-        direct_distance = utility.get_distance(points[path_used[0]], points[path_used[-1]])
+        for i in range(0, len(points)-1):
+            road_distance += utility.get_distance(points[i], points[i+1])
+        direct_distance = utility.get_distance(points[0], points[-1])
 
 
 
@@ -177,58 +409,166 @@ class RoadTransformer:
 
         return result
 
-    def transform_to_training_data(self, directory, outputfile, ai_type='beamng'): 
+    def extract_features_batch(self, tests):
         '''
-        creates a csv file out of json files from beamng data
+        fullroad features of many parsed tests as a (len(tests), 16) matrix ordered like FULLROAD_FEATURES.
+        Roads without any turn angle are rejected by extract_features, their rows are NaN.
+        '''
+        batch = tests if isinstance(tests, RoadBatch) else RoadBatch.from_tests(tests)
+        num_roads = len(batch)
+        counts = np.diff(batch.offsets)
+        road_ids = np.repeat(np.arange(num_roads), counts)
+        features = np.empty((num_roads, len(FULLROAD_FEATURES)))
+
+        angles = np.where(batch.angles < 0, batch.angles + 360, batch.angles)
+        angle_mask = angles > 0
+        pivot_mask = batch.pivot_offs > 0
+        angle_stats = segmented_stats(angles[angle_mask], np.bincount(road_ids[angle_mask], minlength=num_roads))
+        pivot_stats = segmented_stats(batch.pivot_offs[pivot_mask], np.bincount(road_ids[pivot_mask], minlength=num_roads))
+        pivot_stats[:, np.isnan(pivot_stats[0])] = 0.0
+        pivot_stats[:, np.isnan(angle_stats[0])] = np.nan
+
+        # squares go through the float power of python like utility.get_distance does, numpy's x*x
+        # rounds differently in the last bit. The per-road code also adds up the node distances one
+        # after another, so do the same step by step for all roads at once.
+        steps = np.sqrt(self._square(np.diff(batch.xs)) + self._square(np.diff(batch.ys)))
+        step_counts = np.maximum(counts - 1, 0)
+        road_distance = np.zeros(num_roads)
+        for i in range(int(step_counts.max(initial=0))):
+            has_step = step_counts > i
+            road_distance[has_step] += steps[batch.offsets[:-1][has_step] + i]
+        direct_distance = np.full(num_roads, np.nan)
+        has_nodes = counts > 0
+        first = batch.offsets[:-1][has_nodes]
+        last = batch.offsets[1:][has_nodes] - 1
+        direct_distance[has_nodes] = np.sqrt(self._square(batch.xs[first] - batch.xs[last]) + self._square(batch.ys[first] - batch.ys[last]))
+
+        features[:, 0] = direct_distance
+        features[:, 1] = road_distance
+        features[:, 2] = np.bincount(road_ids[batch.roadtypes == ROADTYPE_CODES['l_turn']], minlength=num_roads)
+        features[:, 3] = np.bincount(road_ids[batch.roadtypes == ROADTYPE_CODES['r_turn']], minlength=num_roads)
+        features[:, 4] = np.bincount(road_ids[batch.roadtypes == ROADTYPE_CODES['straight']], minlength=num_roads)
+        features[:, 5:11] = angle_stats.T
+        features[:, 11:16] = pivot_stats[[0, 2, 3, 4, 5]].T
+        return features
+
+    def _square(self, values):
+        return np.array([value ** 2 for value in values.tolist()], dtype=np.float64)
+
+    def features_to_rows(self, features, labels=None):
+        '''
+        turns a feature matrix back into the dict rows written by the csv writers
+        '''
+        rows = []
+        for i, values in enumerate(features.tolist()):
+            row = dict(zip(FULLROAD_FEATURES, values))
+            for feature in COUNT_FEATURES:
+                row[feature] = int(row[feature])
+            if labels is not None:
+                row['safety'] = labels[i]
+            rows.append(row)
+        return rows
+
+    def transform_to_training_data(self, directory, outputfile, ai_type='beamng', workers=1, chunk_size=DEFAULT_CHUNK_SIZE): 
+        '''
+        creates a csv file or a columnar dataset (.cols) out of json files from beamng data.
+        directory is a scenario directory or a list of scenario files, e.g. SplitManifest.training
         '''
-        file_pairs = utility.search_files(directory)
         counter = 0
         # outputfile = '{}/{}'.format(self.output_folder, outputfile)
         # outputfile = '{}_{}'.format(ai_type, outputfile)
+        if isinstance(directory, (list, tuple)):
+            file_paths = list(directory)
+        else:
+            file_pairs = utility.search_files(directory)
+            file_paths = [paths['exec_file'] for filename, paths in file_pairs[ai_type].items()]
+        builder = DatasetBuilder(self, workers=workers, chunk_size=chunk_size)
+        if is_columnar(outputfile):
+            dataset = ColumnarDataset.create(outputfile, FEATURESET_COLUMNS['fullroad'])
+            block = []
+            for file_path, rows, error in builder.iter_rows(file_paths, 'fullroad'):
+                if error:
+                    print('test file {}: {}'.format(file_path, error))
+                    continue
+                block.extend(rows or [])
+                if len(block) >= chunk_size:
+                    dataset.append_rows(block)
+                    block = []
+            dataset.append_rows(block)
+            print('files: {}'.format(len(dataset)))
+            return outputfile
+
         with open(outputfile, 'w', newline='') as csv_file:
-            # fieldnames = ['direct_distance', 'road_distance', 'num_l_turns','num_r_turns','num_straights','median_angle','total_angle','mean_angle','std_angle',
-            # 'max_angle','min_angle','median_pivot_off','mean_pivot_off','std_pivot_off','max_pivot_off','min_pivot_off', 'ai', 'safety']
-            fieldnames = ['direct_distance', 'road_distance', 'num_l_turns','num_r_turns','num_straights','median_angle','total_angle','mean_angle','std_angle',
-            'max_angle','min_angle','median_pivot_off','mean_pivot_off','std_pivot_off','max_pivot_off','min_pivot_off', 'safety']
+            fieldnames = FULLROAD_FEATURES + ['safety']
             writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
             writer.writeheader()
-            # ais = ['beamng', 'driver_ai']
-            # for ai_type in ais:
-            for filename, file_paths in file_pairs[ai_type].items():
-                with open(file_paths['exec_file']) as json_file:
-                    try:
-                        data = json.load(json_file)
-                        if not 'execution' in data.keys():
-                            continue
-                        test_data = self.extract_test_data(data)
-                        print('file: {}'.format(counter))
-                        # test_data['ai'] = ai_type
-                        counter += 1
-                        writer.writerow(test_data)
-                    except Exception as e:
-                        print(e)
-            
+            for file_path, rows, error in builder.iter_rows(file_paths, 'fullroad'):
+                if error:
+                    print('test file {}: {}'.format(file_path, error))
+                    continue
+                for row in rows or []:
+                    print('file: {}'.format(counter))
+                    counter += 1
+                    writer.writerow(row)
+
         return outputfile
 
+    def extract_training_rows(self, tests):
+        '''
+        extract_test_data for many tests at once, failing tests give their exception instead of a row.
+        Tests without execution get None as safety.
+        '''
+        if not tests:
+            return []
+        labels = [self._safety(test) for test in tests]
+        try:
+            features = self.extract_features_batch(tests)
+        except Exception:
+            rows = []
+            for test, label in zip(tests, labels):
+                try:
+                    row = self.extract_features(test)
+                    row['safety'] = label
+                    rows.append(row)
+                except Exception as e:
+                    rows.append(e)
+            return rows
+        rows = self.features_to_rows(features, labels)
+        for i in np.flatnonzero(np.isnan(features).any(axis=1)):
+            rows[i] = ValueError('road has no turn angles')
+        return rows
+
+    def _safety(self, test):
+        if not 'execution' in test.keys():
+            return None
+        if test['execution']['oobs'] > 0:
+            return 'unsafe'
+        return 'safe'
+
     def transform_tests_to_training_data(self, tests, outputfile, with_header=False): 
         '''
         creates a csv file out of json files from beamng data
         '''
+        return self.write_training_rows(self.tests_to_training_rows(tests), outputfile, with_header)
+
+    def tests_to_training_rows(self, tests):
+        '''
+        the features of executed RoadTests with their safety
+        '''
+        rows = []
+        for test in tests:
+            features = self.extract_road_test_features(test)
+            features['safety'] = 'unsafe' if test.execution.oobs > 0 else 'safe'
+            rows.append(features)
+        return rows
+
+    def write_training_rows(self, rows, outputfile, with_header=False):
         if with_header:
             mode = 'w'
         else:
             mode = 'a+'
-        unsafe_tests = []
-        safe_tests = []
-        for test in tests:
-            test = RoadTest.to_dict(test)
-            features = self.extract_features(test)
-            if test['execution']['oobs'] > 0:
-                features['safety'] = 'unsafe'
-                unsafe_tests.append(features)
-            else:
-                features['safety'] = 'safe'
-                safe_tests.append(features)
+        safe_tests = [row for row in rows if row['safety'] == 'safe']
+        unsafe_tests = [row for row in rows if row['safety'] == 'unsafe']
 
         combined_tests = safe_tests[1:]+unsafe_tests
         random.shuffle(combined_tests)
@@ -321,6 +661,8 @@ class RoadTransformer:
         return result
     
     def create_training_test(self, data_set, output_folder):
+        if is_columnar(data_set):
+            return self._create_columnar_training_test(data_set, output_folder)
         df = pd.read_csv(data_set)
         df['safety'] = df['safety'].map(self.label_map)
 
@@ -363,104 +705,105 @@ class RoadTransformer:
 
         return training_path
 
+    def _create_columnar_training_test(self, data_set, output_folder):
+        dataset = ColumnarDataset(data_set)
+        labels = dataset.labels()
+        safe = np.flatnonzero(labels == 'safe')
+        not_safe = np.flatnonzero(labels == 'unsafe')
+        num_sample = min(len(safe), len(not_safe))
+        # same rows as DataFrame.sample(n=num_sample, random_state=1) of the csv path
+        sample_safe = safe[np.random.RandomState(1).choice(len(safe), size=num_sample, replace=False)]
+        sample_unsafe = not_safe[np.random.RandomState(1).choice(len(not_safe), size=num_sample, replace=False)]
+        training_path = '{}/training.cols'.format(output_folder)
+        dataset.take(np.concatenate([sample_safe, sample_unsafe]), training_path)
+        return training_path
+
     def extract_segment_features_rows(self, data):
-            rows = []
-            num_oobs = data['execution']['oobs']
-            path = data['path']
-            stop_at_last_oob = True
-            if data['execution']['reason'] == 'goal_reached':
-                stop_at_last_oob = False
+        '''
+        roadsegment features of one test as a column block: SEGMENT_FEATURES plus safety, one entry per segment
+        '''
+        num_oobs = data['execution']['oobs']
+        path = data['path']
+        stop_at_last_oob = True
+        if data['execution']['reason'] == 'goal_reached':
+            stop_at_last_oob = False
+        segments = [data['network']['nodes'][str(seg_id)] for seg_id in path]
+        num_segments = len(segments)
+
+        is_oob = np.array([seg['key'] in data['execution']['seg_oob_count'].keys() for seg in segments], dtype=bool)
+        remaining_oobs = num_oobs - np.cumsum(is_oob)
+        reached = np.flatnonzero(remaining_oobs == 0)
+        num_rows = num_segments
+        if stop_at_last_oob and reached.size:
+            num_rows = int(reached[0]) + 1
+
+        # every lane edge is converted once and shared between the seg, prev and next columns
+        edges = [lane_edges(seg) for seg in segments[:num_rows + 1]]
+        seg_columns = self._segment_columns(segments[:num_rows + 1], edges)
+        prev_pairs = range(1, num_rows)
+        next_pairs = range(0, min(num_rows, num_segments - 1))
+        hausdorff = batched_directed_hausdorff([edges[i][0] for i in prev_pairs] + [edges[i][0] for i in next_pairs],
+            [edges[i - 1][0] for i in prev_pairs] + [edges[i + 1][0] for i in next_pairs])
+
+        block = {}
+        rows = np.arange(num_rows)
+        block['is_start_seg'] = (rows == 0).astype(np.int64)
+        block['is_last_seg'] = (rows == num_segments - 1).astype(np.int64)
+        for name, values in seg_columns.items():
+            block['seg_{}'.format(name)] = values[:num_rows]
+            prev_values = np.full(num_rows, MISSING_SEGMENT_FEATURE[name], dtype=values.dtype)
+            prev_values[1:] = values[:num_rows - 1]
+            block['prev_{}'.format(name)] = prev_values
+            next_values = np.full(num_rows, MISSING_SEGMENT_FEATURE[name], dtype=values.dtype)
+            next_values[:len(next_pairs)] = values[1:len(next_pairs) + 1]
+            block['next_{}'.format(name)] = next_values
+        block['prev_directed_hausdorff'] = np.full(num_rows, MISSING_SEGMENT_FEATURE['directed_hausdorff'], dtype=np.float64)
+        block['prev_directed_hausdorff'][1:] = hausdorff[:len(prev_pairs)]
+        block['next_directed_hausdorff'] = np.full(num_rows, MISSING_SEGMENT_FEATURE['directed_hausdorff'], dtype=np.float64)
+        block['next_directed_hausdorff'][:len(next_pairs)] = hausdorff[len(prev_pairs):]
+        block['safety'] = np.where(is_oob[:num_rows], 'unsafe', 'safe').astype(object)
+        return block
+
+    def _segment_columns(self, segments, edges):
+        roadtypes = [seg['roadtype'] for seg in segments]
+        l_lengths = np.array([polyline_length(l_edge) for l_edge, r_edge in edges])
+        r_lengths = np.array([polyline_length(r_edge) for l_edge, r_edge in edges])
+        l_direct = np.array([np.hypot(*(l_edge[0] - l_edge[-1])) for l_edge, r_edge in edges])
+        r_direct = np.array([np.hypot(*(r_edge[0] - r_edge[-1])) for l_edge, r_edge in edges])
+        return {
+            'angles': np.array([seg['angle'] for seg in segments], dtype=np.float64),
+            'is_right_turn': np.array([roadtype == 'r_turn' for roadtype in roadtypes], dtype=np.int64),
+            'is_left_turn': np.array([roadtype == 'l_turn' for roadtype in roadtypes], dtype=np.int64),
+            'is_straight': np.array([roadtype == 'straight' for roadtype in roadtypes], dtype=np.int64),
+            'pivot_off': np.array([seg['pivot_off'] for seg in segments], dtype=np.float64),
+            'actual_length': (r_lengths + l_lengths) / 2,
+            'direct_length': (l_direct + r_direct) / 2
+        }
+
+    def block_to_rows(self, block):
+        '''
+        turns a column block of extract_segment_features_rows into the dict rows written by the csv writers
+        '''
+        columns = [(name, block[name].tolist()) for name in SEGMENT_FEATURES + ['safety']]
+        return [dict(zip([name for name, values in columns], row)) for row in zip(*[values for name, values in columns])]
 
-            for i in range(0, len(path)):
-            
-                row = {
-                    'is_start_seg': 0,
-                    'is_last_seg': 0,
-                }
-                seg_id = path[i]
-                seg = data['network']['nodes'][str(seg_id)]
-                prev_seg = next_seg = None
-                if i == 0:
-                    row['is_start_seg'] = 1
-                else:
-                    prev_seg = data['network']['nodes'][str(path[i-1])]
-                if i == len(path)-1:
-                    row['is_last_seg'] = 1
-                else:
-                    next_seg = data['network']['nodes'][str(path[i+1])]
-                row.update(self.segment_to_feature(seg, prev_seg, next_seg))
-                if seg['key'] in data['execution']['seg_oob_count'].keys(): #fix is seg in oob
-                    row['safety'] = 'unsafe'
-                    num_oobs += -1
-                else:
-                    row['safety'] = 'safe'
-                rows.append(row)
-                if num_oobs == 0 and stop_at_last_oob:
-                    break
-            return rows
     def segment_to_feature(self,segment, prev_seg={}, next_seg={}):
         prev_seg_feature = next_seg_feature = {}
-        seg_l_lane =  np.array([(p[0], p[1]) for p in segment['l_lanes'][0]['l_edge']])
+        seg_l_lane, seg_r_lane = lane_edges(segment)
         if prev_seg:
             prev_seg_feature = self.segment_extract_feature(prev_seg, 'prev')
-            prev_l_lane = np.array([(p[0], p[1]) for p in prev_seg['l_lanes'][0]['l_edge']])
-            prev_seg_feature['prev_directed_hausdorff'] = directed_hausdorff(seg_l_lane, prev_l_lane)[0]
-
+            prev_seg_feature['prev_directed_hausdorff'] = directed_hausdorff(seg_l_lane, lane_edges(prev_seg)[0])[0]
         else:
-            prev_seg_feature = {
-            'prev_angles': -1,
-            'prev_is_right_turn': 0,
-            'prev_is_left_turn': 0,
-            'prev_is_straight': 0,
-            'prev_pivot_off': -1,
-            'prev_actual_length': -1,
-            'prev_direct_length': -1,
-            'prev_directed_hausdorff': -1
-        }
+            prev_seg_feature = {'prev_{}'.format(name): value for name, value in MISSING_SEGMENT_FEATURE.items()}
         if next_seg:
             next_seg_feature = self.segment_extract_feature(next_seg, 'next')
-            next_seg_l_lane =  np.array([(p[0], p[1]) for p in next_seg['l_lanes'][0]['l_edge']])
-            next_seg_feature['next_directed_hausdorff'] = directed_hausdorff(seg_l_lane, next_seg_l_lane)[0]
-
-
+            next_seg_feature['next_directed_hausdorff'] = directed_hausdorff(seg_l_lane, lane_edges(next_seg)[0])[0]
         else:
-            next_seg_feature = {
-            'next_angles': -1,
-            'next_is_right_turn': 0,
-            'next_is_left_turn': 0,
-            'next_is_straight': 0,
-            'next_pivot_off': -1,
-            'next_actual_length': -1,
-            'next_direct_length': -1,
-            'next_directed_hausdorff': -1
-
-        }
+            next_seg_feature = {'next_{}'.format(name): value for name, value in MISSING_SEGMENT_FEATURE.items()}
         seg_feature = self.segment_extract_feature(segment, 'seg')
         result = {**seg_feature, **prev_seg_feature, **next_seg_feature}
         return result
 
     def segment_extract_feature(self, segment, prefix):
-        l_lane = [Point(p[0], p[1]) for p in segment['l_lanes'][0]['l_edge']]
-        r_lane = [Point(point[0], point[1]) for point in segment['r_lanes'][0]['r_edge']]
-
-        l_lane_distance = sum([self.get_distance(x,y) for x,y in zip(l_lane[:-1], l_lane[1:])]) 
-        r_lane_distance = sum([self.get_distance(x,y) for x,y in zip(r_lane[:-1], r_lane[1:])])
-        direct_distance = (self.get_distance(l_lane[0], l_lane[-1]) + self.get_distance(r_lane[0], r_lane[-1])) / 2
-        is_right_turn = is_left_turn = is_straight = 0
-        if segment['roadtype'] == 'l_turn':
-            is_left_turn = 1
-        elif segment['roadtype'] == 'r_turn':
-            is_right_turn = 1
-        elif segment['roadtype'] == 'straight':
-            is_straight = 1
-
-        segment_feature = {
-            '{}_angles'.format(prefix): segment['angle'],
-            '{}_is_right_turn'.format(prefix): is_right_turn,
-            '{}_is_left_turn'.format(prefix): is_left_turn,
-            '{}_is_straight'.format(prefix): is_straight,
-            '{}_pivot_off'.format(prefix): segment['pivot_off'],
-            '{}_actual_length'.format(prefix): (r_lane_distance+l_lane_distance)/2,
-            '{}_direct_length'.format(prefix): direct_distance
-        }
-        return segment_feature
\ No newline at end of file
+        columns = self._segment_columns([segment], [lane_edges(segment)])
+        return {'{}_{}'.format(prefix, name): values.tolist()[0] for name, values in columns.items()}
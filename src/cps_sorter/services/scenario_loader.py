@@ -0,0 +1,184 @@
+import json
+import re
+
+EXECUTION = 'execution'
+PATH = 'path'
+LANES = 'lanes'
+
+EXECUTION_KEYS = ['oobs', 'reason', 'start_time', 'end_time', 'seg_oob_count']
+NODE_KEYS = ['roadtype', 'angle', 'pivot_off', 'x', 'y', 'key', 'seg_id']
+LANE_KEYS = ['l_lanes', 'r_lanes']
+
+READ_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+# everything up to the next bracket outside of a string
+_skipped = re.compile(r'(?:"[^"\\]*(?:\\.[^"\\]*)*"|[^\[\]{}"]+)*')
+
+
+class ScenarioReader:
+    '''
+    reads the top level members of a scenario json object one after another, only pulling as much
+    of the file as the members read so far need
+    '''
+    def __init__(self, json_file, read_size=READ_SIZE):
+        self.json_file = json_file
+        self.read_size = read_size
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _fill(self, grow=True):
+        chunk = self.json_file.read(self.read_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        # values larger than the read size are pulled in growing steps instead of retried per block
+        if grow:
+            self.read_size *= 2
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer) or not self._fill():
+                return
+
+    def _expect(self, characters):
+        self._skip_whitespace()
+        if self.position >= len(self.buffer) or self.buffer[self.position] not in characters:
+            raise ValueError('expected one of {!r} at {}'.format(characters, self.position))
+        character = self.buffer[self.position]
+        self.position += 1
+        return character
+
+    def peek(self):
+        self._skip_whitespace()
+        return self.buffer[self.position:self.position + 1]
+
+    def value(self):
+        return self._value()
+
+    def _value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+                # a number at the end of the buffer could continue in the next block
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def skip_value(self):
+        '''
+        moves past the next value without decoding it, objects and arrays are scanned for their closing bracket
+        and the scanned part of the buffer is dropped
+        '''
+        if self.peek() not in ('{', '['):
+            self._value()
+            return
+        depth = 0
+        while True:
+            self.position = _skipped.match(self.buffer, self.position).end()
+            # the buffer ends before the next bracket or in the middle of a string
+            if self.position >= len(self.buffer) or self.buffer[self.position] == '"':
+                if not self._fill(grow=False):
+                    raise ValueError('unexpected end of the scenario file')
+                continue
+            depth += 1 if self.buffer[self.position] in '{[' else -1
+            self.position += 1
+            if depth == 0:
+                return
+
+    def keys(self):
+        '''
+        yields the keys of the object at the current position, the caller reads (value, keys) or skips
+        (skip_value) the value of every key before asking for the next one
+        '''
+        self._expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def members(self):
+        '''
+        yields (key, value) of the top level object
+        '''
+        for key in self.keys():
+            yield key, self._value()
+
+
+def project_execution(execution):
+    return {key: execution[key] for key in EXECUTION_KEYS if key in execution}
+
+
+def read_execution(reader):
+    '''
+    the execution summary of the object at the position of reader, the other members (the states of the run)
+    are skipped without being decoded
+    '''
+    if reader.peek() != '{':
+        value = reader.value()
+        return project_execution(value) if isinstance(value, dict) else value
+    execution = {}
+    for key in reader.keys():
+        if key in EXECUTION_KEYS:
+            execution[key] = reader.value()
+        else:
+            reader.skip_value()
+    return execution
+
+
+def project_network(network, keys):
+    nodes = {}
+    for seg_id, node in network['nodes'].items():
+        nodes[seg_id] = {key: node[key] for key in keys if key in node}
+    return {'nodes': nodes}
+
+
+def load_scenario(file_path, parts=(EXECUTION, PATH, LANES)):
+    '''
+    loads only the requested parts of a scenario file:
+    EXECUTION the execution summary (oobs, reason, start and end time, oob segments)
+    PATH the path and the node attributes used by the fullroad features
+    LANES the path and the node attributes including the lane edges of the roadsegment features
+    Reading stops as soon as the top level members holding the parts are read. Members that are not needed,
+    like the states of the execution, are skipped without being decoded.
+    '''
+    wanted = set()
+    if EXECUTION in parts:
+        wanted.add('execution')
+    if PATH in parts or LANES in parts:
+        wanted.update(['path', 'network'])
+    node_keys = NODE_KEYS + LANE_KEYS if LANES in parts else NODE_KEYS
+
+    scenario = {}
+    with open(file_path) as json_file:
+        reader = ScenarioReader(json_file)
+        for key in reader.keys():
+            if key not in wanted:
+                reader.skip_value()
+                continue
+            if key == 'execution':
+                scenario[key] = read_execution(reader)
+            elif key == 'network':
+                scenario[key] = project_network(reader.value(), node_keys)
+            else:
+                scenario[key] = reader.value()
+            if len(scenario) == len(wanted):
+                break
+    return scenario
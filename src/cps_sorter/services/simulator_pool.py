@@ -0,0 +1,189 @@
+import datetime
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BACKOFF = 30.0
+DEFAULT_MAX_BACKOFF = 300.0
+DEFAULT_MAX_FAILURES = 10
+
+
+class SimulatorPoolError(Exception):
+    '''
+    every simulator of the pool failed too often in a row
+    '''
+
+
+def parse_endpoints(endpoints):
+    '''
+    "host:port,host:port" as a list of (host, port)
+    '''
+    parsed = []
+    for endpoint in endpoints.split(','):
+        host, port = endpoint.strip().rsplit(':', 1)
+        parsed.append((host, int(port)))
+    return parsed
+
+
+class SimulatorEndpoint:
+    '''
+    one simulator and its health: after a failure it is not used for backoff seconds, doubling with every
+    further failure in a row, and it is retired after max_failures failures in a row
+    '''
+    def __init__(self, host, port, runner_factory):
+        self.host = host
+        self.port = port
+        self.runner_factory = runner_factory
+        self.runs = 0
+        self.failures = 0
+        self.total_failures = 0
+        self.busy_time = 0.0
+        self.available_at = 0.0
+        self.retired = False
+
+    def succeeded(self, duration):
+        self.runs += 1
+        self.failures = 0
+        self.busy_time += duration
+
+    def failed(self, duration, backoff, max_backoff, max_failures):
+        self.failures += 1
+        self.total_failures += 1
+        self.busy_time += duration
+        self.available_at = time.time() + min(backoff * 2 ** (self.failures - 1), max_backoff)
+        if max_failures and self.failures >= max_failures:
+            self.retired = True
+
+    def stats(self):
+        return {'host': self.host, 'port': self.port, 'runs': self.runs, 'failures': self.total_failures,
+            'busy_time': self.busy_time, 'retired': self.retired}
+
+
+class SimulatorPool:
+    '''
+    runs tests on the first free healthy simulator of several host/port endpoints. runner_factory_builder(host, port)
+    returns a factory that makes a runner for a test, the runner has run() returning the execution and close().
+    A test whose simulator fails is run again on the next free simulator
+    '''
+    def __init__(self, endpoints, runner_factory_builder, backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, max_failures=DEFAULT_MAX_FAILURES):
+        self.endpoints = [SimulatorEndpoint(host, port, runner_factory_builder(host, port)) for host, port in endpoints]
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self.idle = list(self.endpoints)
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=len(self.endpoints))
+        # the futures of the submitted tests that did not finish yet, cancelled on close
+        self._pending = set()
+
+    @property
+    def size(self):
+        return len(self.endpoints)
+
+    def _acquire(self):
+        with self.condition:
+            while True:
+                if all(endpoint.retired for endpoint in self.endpoints):
+                    raise SimulatorPoolError('all {} simulators failed {} times in a row'.format(self.size, self.max_failures))
+                now = time.time()
+                ready = [endpoint for endpoint in self.idle if not endpoint.retired and endpoint.available_at <= now]
+                if ready:
+                    self.idle.remove(ready[0])
+                    return ready[0]
+                waiting = [endpoint.available_at - now for endpoint in self.idle if not endpoint.retired]
+                self.condition.wait(min(waiting) if waiting else None)
+
+    def _release(self, endpoint):
+        with self.condition:
+            self.idle.append(endpoint)
+            self.condition.notify_all()
+
+    def run(self, test):
+        '''
+        the execution of test, blocks until a simulator is free
+        '''
+        while True:
+            endpoint = self._acquire()
+            start = time.time()
+            runner = None
+            try:
+                runner = endpoint.runner_factory(test)
+                execution = runner.run()
+                endpoint.succeeded(time.time() - start)
+                return execution
+            except Exception as e:
+                endpoint.failed(time.time() - start, self.backoff, self.max_backoff, self.max_failures)
+                print('SimulatorPool: {}:{} failed ({} in a row): {}'.format(endpoint.host, endpoint.port, endpoint.failures, e))
+            finally:
+                if runner is not None:
+                    try:
+                        runner.close()
+                    except Exception as e:
+                        print('SimulatorPool: closing the runner of {}:{} failed: {}'.format(endpoint.host, endpoint.port, e))
+                self._release(endpoint)
+
+    def submit(self, test):
+        '''
+        runs test in the background, returns a future of its execution
+        '''
+        future = self.executor.submit(self.run, test)
+        with self.condition:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.condition:
+            self._pending.discard(future)
+
+    def stats(self):
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def close(self):
+        '''
+        drops the tests that did not start yet and waits for the running ones
+        '''
+        with self.condition:
+            pending = list(self._pending)
+        for future in pending:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+
+class FakeExecution:
+    def __init__(self, start_time, end_time, unsafe):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.oobs = 1 if unsafe else 0
+        self.reason = 'off_track' if unsafe else 'goal_reached'
+
+
+class FakeRunner:
+    def __init__(self, test, latency, unsafe_probability, failure_probability, rng):
+        self.test = test
+        self.latency = latency
+        self.unsafe_probability = unsafe_probability
+        self.failure_probability = failure_probability
+        self.rng = rng
+
+    def run(self):
+        start_time = datetime.datetime.now()
+        time.sleep(self.latency)
+        if self.rng.random() < self.failure_probability:
+            raise ConnectionError('fake simulator failed')
+        return FakeExecution(start_time, datetime.datetime.now(), self.rng.random() < self.unsafe_probability)
+
+    def close(self):
+        pass
+
+
+def fake_runner_factory_builder(latency=1.0, unsafe_probability=0.5, failure_probability=0.0, seed=None):
+    '''
+    stands in for gen_beamng_runner_factory, the runners wait latency seconds instead of driving BeamNG
+    '''
+    rng = random.Random(seed)
+
+    def builder(host, port):
+        return lambda test: FakeRunner(test, latency, unsafe_probability, failure_probability, rng)
+    return builder
@@ -0,0 +1,113 @@
+import json
+import os
+import random
+
+
+def sample_split(safe_files, unsafe_files, train_test_ratio, unsafe_ratio, rng=random):
+    '''
+    balanced training set and a test set with unsafe_ratio unsafe tests out of the remaining files
+    '''
+    if len(safe_files) < len(unsafe_files):
+        num_to_sample = int(train_test_ratio * len(safe_files))
+    else:
+        num_to_sample = int(train_test_ratio * len(unsafe_files))
+
+    safe_training = rng.sample(safe_files, num_to_sample)
+    sampled = set(safe_training)
+    safe_files = [safe_file for safe_file in safe_files if safe_file not in sampled]
+
+    unsafe_training  = rng.sample(unsafe_files, num_to_sample)
+    sampled = set(unsafe_training)
+    unsafe_files = [unsafe_file for unsafe_file in unsafe_files if unsafe_file not in sampled]
+    training_set = safe_training + unsafe_training
+
+    total_sum = len(unsafe_files) + len(safe_files)
+    len_unsafe = len(unsafe_files)
+    len_safe = len(safe_files)
+    num_unsafe_sample = int(unsafe_ratio * total_sum)
+    num_safe_sample = int((1-unsafe_ratio)*total_sum)
+
+    if num_safe_sample > len_safe:
+        num_safe_sample  = len_safe
+        num_unsafe_sample = int(num_safe_sample / (1-unsafe_ratio) * unsafe_ratio)
+        if num_unsafe_sample > len_unsafe:
+            num_unsafe_sample = len_unsafe
+            num_safe_sample = int(len_safe / unsafe_ratio * (1-unsafe_ratio))
+
+    if num_unsafe_sample > len(unsafe_files):
+        num_unsafe_sample = len_unsafe
+        num_safe_sample  = int(num_unsafe_sample / unsafe_ratio * (1-unsafe_ratio))
+        if num_safe_sample > len_safe:
+            num_safe_sample = len_safe
+            num_unsafe_sample = int(len_safe /  (1-unsafe_ratio) * unsafe_ratio)
+
+    safe_test = rng.sample(safe_files,num_safe_sample)
+    unsafe_test = rng.sample(unsafe_files,num_unsafe_sample)
+    test_set = safe_test + unsafe_test
+    return training_set, test_set
+
+
+class SplitManifest:
+    '''
+    a training/test split of a scenario directory as lists of paths, together with the seed and
+    ratios that produced it. Nothing is copied, materialize() links the files when a tool needs directories.
+    '''
+    def __init__(self, directory, training, test, seed=None, train_test_ratio=None, unsafe_ratio=None):
+        self.directory = directory
+        self.training = list(training)
+        self.test = list(test)
+        self.seed = seed
+        self.train_test_ratio = train_test_ratio
+        self.unsafe_ratio = unsafe_ratio
+
+    def to_dict(self):
+        return {
+            'directory': self.directory,
+            'seed': self.seed,
+            'train_test_ratio': self.train_test_ratio,
+            'unsafe_ratio': self.unsafe_ratio,
+            'training': self.training,
+            'test': self.test
+        }
+
+    def save(self, manifest_file):
+        with open(manifest_file, 'w') as outfile:
+            json.dump(self.to_dict(), outfile, indent=4)
+        return manifest_file
+
+    @classmethod
+    def load(cls, manifest_file):
+        with open(manifest_file) as infile:
+            data = json.load(infile)
+        return cls(data['directory'], data['training'], data['test'], data['seed'], data['train_test_ratio'], data['unsafe_ratio'])
+
+    def materialize(self, out_dir, link='hardlink'):
+        '''
+        creates out_dir/training and out_dir/test with hard links (or symlinks) to the scenario files
+        '''
+        training_dir_path = '{}/training'.format(out_dir)
+        test_dir_path = '{}/test'.format(out_dir)
+        for dir_path, files in [(training_dir_path, self.training), (test_dir_path, self.test)]:
+            os.mkdir(dir_path)
+            for file_path in files:
+                target = '{}/{}'.format(dir_path, os.path.basename(file_path))
+                if link == 'hardlink':
+                    try:
+                        os.link(file_path, target)
+                        continue
+                    except OSError:
+                        pass
+                os.symlink(os.path.abspath(file_path), target)
+        return training_dir_path, test_dir_path
+
+
+def split_corpus(corpus_index, train_test_ratio, unsafe_ratio, seed=None):
+    '''
+    splits the scenarios of a CorpusIndex like split_data does, without touching the files
+    '''
+    if seed is None:
+        seed = random.randrange(2**32)
+    safe_files = [path for path, valid, is_unsafe in zip(corpus_index.paths, corpus_index.valid, corpus_index.is_unsafe) if valid and not is_unsafe]
+    unsafe_files = [path for path, valid, is_unsafe in zip(corpus_index.paths, corpus_index.valid, corpus_index.is_unsafe) if valid and is_unsafe]
+    training_set, test_set = sample_split(safe_files, unsafe_files, train_test_ratio, unsafe_ratio, random.Random(seed))
+    return SplitManifest(corpus_index.directory, training_set, test_set, seed, train_test_ratio, unsafe_ratio)
@@ -0,0 +1,119 @@
+import numpy as np
+from cps_sorter.services.native_models import standardization
+from cps_sorter.services.road_transformer import FULLROAD_FEATURES
+
+DEFAULT_CANDIDATE_POOL = 10
+DEFAULT_TIME_RIDGE = 1.0
+DEFAULT_MIN_RUNS = 10
+DEFAULT_TIME_REFIT_EVERY = 10
+DEFAULT_EXECUTION_TIME = 60.0
+
+
+class ExecutionTimeModel:
+    '''
+    ridge regression of the execution time (seconds) of a test on its feature row, fitted on the executions seen
+    so far and refitted every refit_every executions. Until min_runs executions were seen every test gets their
+    mean time (default_time without executions)
+    '''
+    def __init__(self, features=FULLROAD_FEATURES, ridge=DEFAULT_TIME_RIDGE, min_runs=DEFAULT_MIN_RUNS, refit_every=DEFAULT_TIME_REFIT_EVERY,
+        default_time=DEFAULT_EXECUTION_TIME):
+        self.features = features
+        self.ridge = ridge
+        self.min_runs = min_runs
+        self.refit_every = refit_every
+        self.default_time = default_time
+        self.rows = []
+        self.times = []
+        self.weights = None
+        self.absolute_errors = []
+
+    def _matrix(self, rows):
+        return np.array([[float(row[feature]) for feature in self.features] for row in rows])
+
+    def fit(self):
+        matrix = self._matrix(self.rows)
+        self.mean, self.std = standardization(matrix)
+        standardized = np.column_stack([np.ones(len(matrix)), (matrix - self.mean) / self.std])
+        penalty = self.ridge * np.eye(standardized.shape[1])
+        # the intercept is not penalized
+        penalty[0, 0] = 0
+        self.weights = np.linalg.solve(standardized.T @ standardized + penalty, standardized.T @ np.array(self.times))
+
+    def predict(self, rows):
+        '''
+        the predicted seconds of the rows, at least a tenth of the shortest execution seen
+        '''
+        if self.weights is None:
+            mean = np.mean(self.times) if self.times else self.default_time
+            return np.full(len(rows), mean)
+        standardized = np.column_stack([np.ones(len(rows)), (self._matrix(rows) - self.mean) / self.std])
+        return np.maximum(standardized @ self.weights, min(self.times) / 10)
+
+    def observe(self, row, seconds):
+        if row is None:
+            return
+        if self.weights is not None:
+            self.absolute_errors.append(abs(self.predict([row])[0] - seconds))
+        self.rows.append(row)
+        self.times.append(seconds)
+        if len(self.times) >= self.min_runs and (self.weights is None or len(self.times) % self.refit_every == 0):
+            self.fit()
+
+    def stats(self):
+        return {'runs': len(self.times), 'mean_time': float(np.mean(self.times)) if self.times else None,
+            'mean_absolute_error': float(np.mean(self.absolute_errors)) if self.absolute_errors else None}
+
+
+class CostAwarePrioritizer:
+    '''
+    keeps a pool of candidates predicted as unsafe and hands out the ones with the most expected unsafe findings
+    per simulator second first: the predicted unsafe probability (1 when the predictor gives none) divided by the
+    execution time predicted by time_model. The pool is refilled up to pool_size candidates before every pick,
+    candidates that are not picked wait for the next one. After a model update the predictions of the pool are
+    stale and the pool is cleared
+    '''
+    def __init__(self, time_model=None, pool_size=DEFAULT_CANDIDATE_POOL):
+        self.time_model = time_model or ExecutionTimeModel()
+        self.pool_size = pool_size
+        self.pool = []
+        self.picked = 0
+        self.dropped = 0
+
+    def needed(self):
+        '''
+        the number of candidates predicted as unsafe missing in the pool
+        '''
+        return self.pool_size - len(self.pool)
+
+    def select(self, tests, predictions, probabilities, rows, count):
+        '''
+        adds the candidates of a batch group to the pool and returns the tests, predictions, probabilities and rows
+        to go on with: the tests predicted as safe followed by the count best candidates in the order of their score
+        '''
+        rest = []
+        for test, prediction, probability, row in zip(tests, predictions, probabilities, rows):
+            if prediction == 'unsafe':
+                self.pool.append((test, prediction, probability, row))
+            else:
+                rest.append((test, prediction, probability, row))
+        if self.pool:
+            found = np.array([1.0 if probability is None else probability for test, prediction, probability, row in self.pool])
+            seconds = self.time_model.predict([row for test, prediction, probability, row in self.pool])
+            order = np.argsort(-found / seconds, kind='stable')
+            best = [self.pool[i] for i in order[:count]]
+            self.pool = [self.pool[i] for i in order[count:]]
+            self.picked += len(best)
+            rest += best
+        if not rest:
+            return [], [], [], []
+        return [list(values) for values in zip(*rest)]
+
+    def observe(self, row, seconds):
+        self.time_model.observe(row, seconds)
+
+    def clear(self):
+        self.dropped += len(self.pool)
+        self.pool = []
+
+    def stats(self):
+        return {'picked': self.picked, 'dropped': self.dropped, 'waiting': len(self.pool), 'execution_time_model': self.time_model.stats()}
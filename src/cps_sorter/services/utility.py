@@ -1,4 +1,5 @@
 import numpy as np
+import datetime
 import os
 import re
 
@@ -28,10 +29,31 @@ def get_distance(point_a, point_b):
     return np.sqrt( ((point_a.x-point_b.x)**2)+((point_a.y-point_b.y)**2))
 
 
+def get_execution_time(execution):
+    return (datetime.datetime.strptime(execution['end_time'], '%Y-%m-%dT%H:%M:%S.%f') - datetime.datetime.strptime(execution['start_time'], '%Y-%m-%dT%H:%M:%S.%f')).total_seconds()
+
+
+def is_scenario_file(filename):
+    # hidden files (editor and OS metadata) are not scenarios
+    return not os.path.basename(filename).startswith('.')
+
+
+beamng_pattern = re.compile(r".*beamng.*")
+deepdrive_pattern = re.compile(r".*deepdrive.*")
+driver_ai_pattern = re.compile(r".*driver_ai.*")
+
+
+def get_ai_type(filepath):
+    if beamng_pattern.match(filepath):
+        return 'beamng'
+    elif deepdrive_pattern.match(filepath):
+        return 'deepdrive'
+    elif driver_ai_pattern.match(filepath):
+        return 'driver_ai'
+    return 'default'
+
+
 def search_files(folder):
-    beamng_pattern = re.compile(r".*beamng.*")
-    deepdrive_pattern = re.compile(r".*deepdrive.*")
-    driver_ai_pattern = re.compile(r".*driver_ai.*")
     # default_pattern = re.compile(r".*")
     file_pairs = {
         'beamng': {},
@@ -41,17 +63,12 @@ def search_files(folder):
     }
     for subdir, dirs, files in os.walk(folder):
         for filename in files:
+            if not is_scenario_file(filename):
+                continue
             splited_subdir = subdir.split('\\')
             dir_name = splited_subdir[-1]
             filepath = subdir + os.sep + filename
             # if dir_name in ['execs', 'tests', 'final']:
-            if beamng_pattern.match(filepath):
-                file_pairs['beamng'].setdefault('{}-{}'.format(splited_subdir[-1],filename), {}).update({'exec_file': filepath})
-            elif deepdrive_pattern.match(filepath):
-                file_pairs['deepdrive'].setdefault('{}-{}'.format(splited_subdir[-1],filename), {}).update({'exec_file': filepath})
-            elif driver_ai_pattern.match(filepath):
-                file_pairs['driver_ai'].setdefault('{}-{}'.format(splited_subdir[-1],filename), {}).update({'exec_file': filepath})
-            else:
-                file_pairs['default'].setdefault('{}-{}'.format(splited_subdir[-1],filename), {}).update({'exec_file': filepath})
+            file_pairs[get_ai_type(filepath)].setdefault('{}-{}'.format(splited_subdir[-1],filename), {}).update({'exec_file': filepath})
 
     return file_pairs
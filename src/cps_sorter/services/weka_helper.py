@@ -1,40 +1,252 @@
 import subprocess
 import re
 import tempfile
+import csv
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile
 import os
+from cps_sorter.services.columnar_dataset import weka_file
+from cps_sorter.services.portable_model import parse_weka_model, portable_model_file, load_portable_model, DEFAULT_PROBABILITY_TOLERANCE
+from cps_sorter.services.model_registry import jar_version
+from cps_sorter.services.incremental_models import IncrementalLearner
 
 DEFAULT_PREDICTION_JAR = '{}/jars/makePrediction.jar'.format(os.path.dirname(os.path.realpath(__file__)))
 DEFAULT_PREDICTION_BULK_JAR = '{}/jars/makeBatchPrediction.jar'.format(os.path.dirname(os.path.realpath(__file__)))
 DEFAULT_MODEL_BUILDING_JAR ='{}/jars/train_models.jar'.format(os.path.dirname(os.path.realpath(__file__)))
 DEFAULT_MODEL_EVALUATOR_JAR = '{}/jars/ModelEvaluator.jar'.format(os.path.dirname(os.path.realpath(__file__)))
+# not part of the package like the other jars: prints the toString() of the weka model file given as its argument
+DEFAULT_MODEL_PRINT_JAR = '{}/jars/printModel.jar'.format(os.path.dirname(os.path.realpath(__file__)))
+VERIFICATION_ROWS = 1000
+# one training job per model
+DEFAULT_TRAINING_WORKERS = 3
 class WekaHelper:
-    def __init__(self, prediction_jar=DEFAULT_PREDICTION_JAR, model_building_jar=DEFAULT_MODEL_BUILDING_JAR, temp_dir=None, model_evaluator_jar=DEFAULT_MODEL_EVALUATOR_JAR):
+    def __init__(self, prediction_jar=DEFAULT_PREDICTION_JAR, model_building_jar=DEFAULT_MODEL_BUILDING_JAR, temp_dir=None, model_evaluator_jar=DEFAULT_MODEL_EVALUATOR_JAR, prediction_pool=None,
+        portable_models=False, model_print_jar=DEFAULT_MODEL_PRINT_JAR, backend=None, training_workers=DEFAULT_TRAINING_WORKERS, model_registry=None, incremental=None):
         self.prediction_jar = prediction_jar
+        self.backend = backend
+        self.prediction_pool = prediction_pool
+        self.portable_models = portable_models
+        self.model_print_jar = model_print_jar
+        self.scorers = {}
         self.bulk_prediction_jar = DEFAULT_PREDICTION_BULK_JAR
         self.model_building_jar = model_building_jar
         self.model_evaluator_jar = model_evaluator_jar
         self.models = {}
+        self.training_workers = training_workers
+        self.model_registry = model_registry
+        # keyword arguments of the IncrementalLearners, None rebuilds the models on every update
+        self.incremental = incremental
+        self.learners = {}
+        # one entry per training job: its models, the seconds it took and the models restored from the registry
+        self.training_times = []
         if not temp_dir:
             temp_dir = tempfile.TemporaryDirectory()
         self.temp_dir = temp_dir.name
     
-    def build_models(self, trainings_file, temp_dir, models=['J48.model', 'RandomForest.model', 'Logistic.model']):
-        subprocess.call(['java', '-jar', self.model_building_jar, trainings_file, temp_dir])
+    def build_models(self, trainings_file, temp_dir, models=['J48.model', 'RandomForest.model', 'Logistic.model'], verification_file=None):
+        for future in self.build_models_async(trainings_file, temp_dir, models, verification_file):
+            future.result()
+        if self.prediction_pool:
+            # workers that died while the models trained are restarted before they are asked for predictions
+            self.prediction_pool.health_check()
+
+    def rebuild_models(self, trainings_file, temp_dir, models=['J48.model', 'RandomForest.model', 'Logistic.model'], verification_file=None):
+        if not self.backend:
+            for model in models:
+                try:
+                    os.remove(self.models[model])
+                except Exception as e:
+                    print(e)
+        self.build_models(trainings_file, temp_dir, models, verification_file)
+
+    def update_models(self, trainings_file, temp_dir, models, rows):
+        '''
+        applies newly labelled rows, which were already appended to trainings_file, to the models. With incremental
+        set the models are native models updated in memory by IncrementalLearners, the first update trains them
+        on trainings_file. Otherwise the models are rebuilt on trainings_file
+        '''
+        if not self.incremental:
+            return self.rebuild_models(trainings_file, temp_dir, models)
         for model in models:
-            self.models[model] = '{}/{}'.format(temp_dir, model)
+            if model in self.learners:
+                portable = self.learners[model].update(rows)
+            else:
+                self.learners[model] = IncrementalLearner.from_file(model, trainings_file, **self.incremental)
+                portable = self.learners[model].model
+            self.models[model] = portable.save(portable_model_file('{}/{}'.format(temp_dir, model)))
+            self.scorers[model] = portable
+
+    def build_models_async(self, trainings_file, temp_dir, models=['J48.model', 'RandomForest.model', 'Logistic.model'], verification_file=None):
+        '''
+        schedules the training on a pool of training_workers threads and returns one future per training job,
+        it resolves to the list of models the job trained. Native models are trained one job per model, weka models
+        in one job by the training jar whatever the number of workers, so that they are the models of the original
+        experiments. A model is in get_models() as soon as its job finished
+        '''
+        if self.backend:
+            jobs = [[model] for model in models]
+        else:
+            jobs = [list(models)]
+        if not self.backend:
+            # the csv export of a columnar training set is shared by the jobs, it is done once up front
+            weka_file(trainings_file)
+        executor = ThreadPoolExecutor(max_workers=max(1, self.training_workers))
+        futures = [executor.submit(self._train, trainings_file, temp_dir, job, verification_file) for job in jobs]
+        executor.shutdown(wait=False)
+        return futures
+
+    def _train(self, trainings_file, temp_dir, models, verification_file=None):
+        start = time.time()
+        keys = {}
+        if self.model_registry:
+            keys = {model: self.model_registry.key(trainings_file, model, self._trainer(model)) for model in models}
+        restored = [model for model in keys if self.model_registry.get(keys[model], self._model_file(temp_dir, model))]
+        missing = [model for model in models if model not in restored]
+        if restored:
+            print('Restored {} from the model registry'.format(', '.join(restored)))
+        if self.backend:
+            if missing:
+                self._build_native_models(trainings_file, temp_dir, missing)
+            for model in restored:
+                self.models[model] = self._model_file(temp_dir, model)
+                self.scorers[model] = load_portable_model(self.models[model])
+        else:
+            if missing:
+                subprocess.call(['java', '-jar', self.model_building_jar, weka_file(trainings_file), temp_dir])
+            for model in models:
+                self.models[model] = self._model_file(temp_dir, model)
+            self._update_scorers(trainings_file, models, verification_file)
+        for model in missing:
+            if model in keys:
+                self.model_registry.put(keys[model], self.models[model])
+        self.training_times.append({'models': list(models), 'seconds': time.time() - start, 'restored': restored})
+        return models
+
+    def _model_file(self, temp_dir, model):
+        if self.backend:
+            return portable_model_file('{}/{}'.format(temp_dir, model))
+        return '{}/{}'.format(temp_dir, model)
 
-    def rebuild_models(self, trainings_file, temp_dir, models=['J48.model', 'RandomForest.model', 'Logistic.model']):
+    def _trainer(self, model):
+        '''
+        what the model registry keys a trained model by besides the training data
+        '''
+        if self.backend:
+            return self.backend.fingerprint(model)
+        return {'jar': jar_version(self.model_building_jar)}
+
+    def _build_native_models(self, trainings_file, temp_dir, models):
+        '''
+        trains the models in process, they are stored as portable models and scored without a jvm
+        '''
+        for model, portable in self.backend.build_models(trainings_file, models).items():
+            self.models[model] = portable.save(self._model_file(temp_dir, model))
+            self.scorers[model] = portable
+
+    def _update_scorers(self, trainings_file, models, verification_file=None):
         for model in models:
-            try:
-                os.remove(self.models[model])
-            except Exception as e:
-                print(e)
-        subprocess.call(['java', '-jar', self.model_building_jar, trainings_file, temp_dir])
+            self.scorers.pop(model, None)
+        if not self.portable_models:
+            return
+        if not os.path.exists(self.model_print_jar):
+            print('WekaHelper: {} is missing, the models are not exported'.format(self.model_print_jar))
+            self.portable_models = False
+            return
+        with open(weka_file(trainings_file), newline='') as csv_file:
+            reader = csv.DictReader(csv_file)
+            features = [feature for feature in reader.fieldnames if feature != 'safety']
+            classes = []
+            for row in reader:
+                if row['safety'] not in classes:
+                    classes.append(row['safety'])
         for model in models:
-            self.models[model] = '{}/{}'.format(temp_dir, model)
+            self.export_model(model, features, classes, verification_file or trainings_file)
+
+    def export_model(self, model, features, classes, verification_file):
+        '''
+        exports the weka model to a portable model next to the model file, predictions are then scored
+        in process. The printed model is rounded, the model is only used when it agrees with the jar on every
+        row of verification_file that is not within the rounding of a split or a tie of the class probabilities
+        '''
+        try:
+            text = subprocess.check_output(['java', '-jar', self.model_print_jar, self.models[model]], universal_newlines=True)
+            portable = parse_weka_model(text, features, classes)
+            agreement = self.verify_portable_model(model, portable, verification_file)
+            if agreement < 1:
+                print('{}: the portable model agrees with the jar on {:.1%} of the verification rows, using the jar'.format(model, agreement))
+                return None
+            portable.save(portable_model_file(self.models[model]))
+            self.scorers[model] = portable
+            return portable
+        except Exception as e:
+            print('WekaHelper: export of {} failed: {}'.format(model, e))
+            return None
+
+    def verify_portable_model(self, model, portable, verification_file):
+        '''
+        the share of the first VERIFICATION_ROWS rows of verification_file where portable predicts what the jar predicts,
+        a different label counts as agreement on a row where the rounding of the printed model may decide it
+        '''
+        rows = self._read_rows(weka_file(verification_file), VERIFICATION_ROWS)
+        if not rows:
+            return 0.0
+        to_test = self._write_rows(rows, portable.features)
+        expected = self.make_bulk_predictions(model, to_test, len(rows))
+        os.remove(to_test)
+        if not expected or len(expected) != len(rows):
+            return 0.0
+        labels, probabilities = portable.predict_rows(rows)
+        uncertain = portable.uncertain(portable.matrix(rows), DEFAULT_PROBABILITY_TOLERANCE)
+        different = [i for i, (label, jar_label) in enumerate(zip(labels, expected)) if label != jar_label]
+        if different:
+            print('{}: {} of {} rows are labelled differently than by the jar, {} of them within the rounding of the printed model'.format(
+                model, len(different), len(rows), sum(bool(uncertain[i]) for i in different)))
+        return 1 - sum(not uncertain[i] for i in different) / len(rows)
+
+    def _read_rows(self, to_test, bulk_size):
+        with open(to_test, newline='') as csv_file:
+            return [{feature: float(value) for feature, value in row.items() if feature != 'safety'}
+                for row in itertools.islice(csv.DictReader(csv_file), bulk_size)]
+
+    def _write_rows(self, rows, features):
+        to_test = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        to_test.close()
+        with open(to_test.name, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=features + ['safety'])
+            writer.writeheader()
+            # both class values have to be in the file, a single row is written twice
+            for i, row in enumerate(rows if len(rows) > 1 else rows * 2):
+                writer.writerow(dict(row, safety='safe' if i % 2 else 'unsafe'))
+        return to_test.name
+
+    def predict_rows(self, model, rows):
+        '''
+        labels and class probabilities of rows (dicts of feature values), from the portable model when it
+        was exported, otherwise from the warm workers of the prediction pool
+        '''
+        if model in self.scorers:
+            return self.scorers[model].predict_rows(rows)
+        return self.prediction_pool.predict(self.models[model], rows)
+
+    def _fast_predictions(self, model, to_test, bulk_size):
+        labels, probabilities = self._fast_probabilities(model, to_test, bulk_size)
+        return labels
+
+    def _fast_probabilities(self, model, to_test, bulk_size):
+        if model not in self.scorers and not self.prediction_pool:
+            return None, None
+        try:
+            return self.predict_rows(model, self._read_rows(to_test, bulk_size))
+        except Exception as e:
+            print('WekaHelper: {}, using the prediction jar'.format(e))
+            return None, None
 
     def make_prediction(self, model, to_test):
+        labels = self._fast_predictions(model, to_test, 1)
+        if labels:
+            return labels[0]
         try:
             csv_name = '{}.csv'.format(to_test)
             csv_file = copyfile(to_test, csv_name)
@@ -53,7 +265,20 @@ class WekaHelper:
             print(e)
 
 
+    def make_bulk_predictions_with_probabilities(self, model, to_test, bulk_size=1):
+        '''
+        the labels and the unsafe probabilities of the rows of to_test, the probabilities are None when the
+        prediction jar predicted the labels
+        '''
+        labels, probabilities = self._fast_probabilities(model, to_test, bulk_size)
+        if labels:
+            return labels, [probability.get('unsafe', 0.0) for probability in probabilities]
+        return self.make_bulk_predictions(model, to_test, bulk_size), None
+
     def make_bulk_predictions(self, model, to_test, bulk_size=1):
+        labels = self._fast_predictions(model, to_test, bulk_size)
+        if labels:
+            return labels
         try:
             predictions = []
             csv_name = '{}.csv'.format(to_test)
@@ -75,10 +300,14 @@ class WekaHelper:
             print(e)
 
     def evaluate_models(self, dataset_name, trainings_set, test_set, output_file):
+        '''
+        runs the model evaluator jar until it finished, it appends its rows to output_file. Returns the exit code
+        '''
         try:
-            process = subprocess.Popen(['java', '-jar', self.model_evaluator_jar, trainings_set, test_set, dataset_name, output_file])
+            return subprocess.call(['java', '-jar', self.model_evaluator_jar, weka_file(trainings_set), weka_file(test_set), dataset_name, output_file])
         except Exception as e:
             print('WekaHelper:{}'.format(e))
+            return None
 
     def get_models(self):
         return self.models
\ No newline at end of file